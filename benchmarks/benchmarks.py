@@ -0,0 +1,265 @@
+"""
+Benchmarks of the vectorised pipeline steps against the implementations they replaced (see tests/baseline.py), and of
+parallel enrichment against serial, on synthetic data of the order of the production tables. Each benchmark also
+checks the new implementation gives the same output.
+
+Run with: python benchmarks/benchmarks.py [benchmark names]  (all of them by default)
+"""
+import pathlib
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# the modules live at the repository root, which isn't a package, and the functions they replaced with the tests
+ROOT = pathlib.Path(__file__).absolute().parent.parent
+sys.path[:0] = [str(ROOT), str(ROOT / 'tests')]
+
+import baseline
+from etlw import calculate_vote_stats_for_content, calculate_vote_stats_for_users, enrich_collections
+from karmametric import run_vote_algorithm, agg_votes_to_period, build_karma_cube, get_period_labels, sweep_karma_metric
+from schema import decode_dtypes
+from utils import print_and_log
+
+# row counts of the order of production
+BENCHMARK_VOTES = 2000000
+BENCHMARK_DOCUMENTS = 200000
+BENCHMARK_USERS = 50000
+BENCHMARK_VIEWS = 5000000
+
+BENCHMARK_PROCESSES = (1, 2, 4, 8)
+BENCHMARK_SWEEP_VARIANTS = [(exponent, multiplier) for exponent in (1, 1.2, 1.5) for multiplier in (1, 4, 8)]
+
+
+def make_votes(num_votes=BENCHMARK_VOTES, num_documents=BENCHMARK_DOCUMENTS, num_users=BENCHMARK_USERS, seed=0):
+    """Returns a synthetic votes dataframe with the dtypes of a cleaned one (interned ids, categories, int8s)."""
+
+    rng = np.random.RandomState(seed)
+    id_dtype = pd.api.types.CategoricalDtype(pd.Index(['{:017x}'.format(i) for i in range(num_documents + num_users)]))
+    vote_types = ['smallUpvote', 'smallDownvote', 'bigUpvote', 'bigDownvote']
+    vote_type = rng.choice(len(vote_types), num_votes, p=[0.8, 0.1, 0.08, 0.02])
+    document_code = rng.randint(0, num_documents, num_votes)
+
+    return pd.DataFrame({
+        'afPower': np.zeros(num_votes, dtype='int8'),
+        'collectionName': pd.Categorical.from_codes((document_code % 5 == 0).astype('int8'),
+                                                   categories=['Comments', 'Posts']),
+        'documentId': pd.Categorical.from_codes(document_code, dtype=id_dtype),
+        'legacy': np.zeros(num_votes, dtype=bool),
+        'power': np.array([1, -1, 5, -5], dtype='int8')[vote_type],
+        'userId': pd.Categorical.from_codes(rng.randint(num_documents, num_documents + num_users, num_votes),
+                                            dtype=id_dtype),
+        'voteType': pd.Categorical.from_codes(vote_type, categories=vote_types),
+        'votedAt': pd.Timestamp('2009-03-01') + pd.to_timedelta(rng.randint(0, 11 * 365 * 86400, num_votes), unit='s'),
+        'cancelled': np.zeros(num_votes, dtype=bool),
+        'isUnvote': np.zeros(num_votes, dtype=bool)
+    }).sort_values('votedAt').reset_index(drop=True)
+
+
+def make_collections(num_votes=BENCHMARK_VOTES, num_views=BENCHMARK_VIEWS, num_documents=BENCHMARK_DOCUMENTS,
+                     num_users=BENCHMARK_USERS, seed=0):
+    """
+    Returns synthetic users, posts, comments, votes and views dataframes with the columns enrichment reads and the
+    dtypes of cleaned ones. Documents are posts or comments as in make_votes, and all ids share its id dictionary.
+    """
+
+    rng = np.random.RandomState(seed)
+    votes = make_votes(num_votes, num_documents, num_users, seed)
+    id_dtype = votes['documentId'].dtype
+    post_codes = np.arange(0, num_documents, 5)
+    comment_codes = np.setdiff1d(np.arange(num_documents), post_codes)
+    user_codes = np.arange(num_documents, num_documents + num_users)
+
+    def ids(codes):
+        return pd.Categorical.from_codes(codes, dtype=id_dtype)
+
+    def times(num):
+        return pd.Timestamp('2009-03-01') + pd.to_timedelta(rng.randint(0, 11 * 365 * 86400, num), unit='s')
+
+    def user_agents(num):
+        return rng.choice(['Mozilla/5.0', 'Drakma/2.0'], num, p=[0.95, 0.05])
+
+    users = pd.DataFrame({
+        '_id': ids(user_codes),
+        'username': ['user{}'.format(i) for i in range(num_users)],
+        'displayName': ['User {}'.format(i) for i in range(num_users)],
+        'createdAt': times(num_users)
+    })
+    posts = pd.DataFrame({
+        '_id': ids(post_codes),
+        'userId': ids(rng.choice(user_codes, len(post_codes))),
+        'postedAt': times(len(post_codes)),
+        'draft': rng.rand(len(post_codes)) < 0.05,
+        'frontpageDate': pd.Series(times(len(post_codes))).where(rng.rand(len(post_codes)) < 0.3),
+        'userAgent': user_agents(len(post_codes))
+    })
+    comments = pd.DataFrame({
+        '_id': ids(comment_codes),
+        'userId': ids(rng.choice(user_codes, len(comment_codes))),
+        'postId': ids(rng.choice(post_codes, len(comment_codes))),
+        'postedAt': times(len(comment_codes)),
+        'deleted': rng.rand(len(comment_codes)) < 0.02,
+        'parentCommentId': ids(np.where(rng.rand(len(comment_codes)) < 0.5, -1,
+                                        rng.choice(comment_codes, len(comment_codes)))),
+        'userAgent': user_agents(len(comment_codes))
+    })
+    views = pd.DataFrame({
+        'userId': ids(rng.choice(user_codes, num_views)),
+        'documentId': ids(rng.choice(post_codes, num_views)),
+        'createdAt': times(num_views)
+    }).sort_values('createdAt').reset_index(drop=True)
+
+    return {'users': users, 'posts': posts, 'comments': comments, 'votes': votes, 'views': views}
+
+
+def legacy_run_incremental_vote_algorithm(votes, exponent=1.2):
+    """baseline.run_incremental_vote_algorithm with the exponent, fixed at 1.2 there, as a parameter, so sweeps of
+    it can be compared against the loop."""
+
+    def fancy_power(x, power):
+        return np.sign(x) * np.abs(x) ** power
+
+    baseScoresD4 = {}
+    docScores = {}
+    voteEffects = {}
+
+    for vote in votes.itertuples(index=False, name='Vote'):
+        oldScore = fancy_power(baseScoresD4.get(vote.documentId, 0), exponent)
+        newScore = fancy_power(baseScoresD4.get(vote.documentId, 0) + vote.power_d4, exponent)
+        voteEffects[vote.voteId] = newScore - oldScore
+
+        baseScoresD4[vote.documentId] = baseScoresD4.get(vote.documentId, 0) + vote.power_d4
+        docScores[vote.documentId] = newScore
+
+    return baseScoresD4, docScores, voteEffects
+
+
+def rerun_karma_metric_per_variant(votes, variants, pr='D'):
+    """What sweep_karma_metric replaces: running the original vote loop (see legacy_run_incremental_vote_algorithm)
+    again for each variant and summing the effects per period."""
+
+    votes = votes.assign(voteId=np.arange(votes.shape[0]))
+    series = []
+    for exponent, multiplier in variants:
+        variant_votes = votes.assign(power_d4=votes['power'].where(votes['power'] >= 0, votes['power'] * multiplier))
+        vote_effects = legacy_run_incremental_vote_algorithm(variant_votes, exponent)[2]
+        effects = [vote_effects[vote_id] for vote_id in votes['voteId']]
+        effect = pd.Series(effects).groupby(get_period_labels(votes['votedAt'], pr).values).sum()
+        series.append(pd.DataFrame({'exponent': exponent, 'downvote_multiplier': multiplier,
+                                    'votedAt': effect.index, 'effect': effect.values}))
+
+    return pd.concat(series, ignore_index=True)
+
+
+def time_call(func, *args, **kwargs):
+    """Returns the wall time of func(*args, **kwargs) in seconds and its result."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def assert_same_output(result, expected):
+    """Checks two aggregates are the same, whether or not their index is categorical (i.e. ids interned, and sorted
+    by their codes rather than the ids)."""
+    pd.testing.assert_frame_equal(result.set_index(result.index.astype(object)).sort_index(),
+                                  expected.set_index(expected.index.astype(object)).sort_index(), check_names=False)
+
+
+def report(name, legacy_seconds, new_seconds, num_rows):
+    print_and_log('{}: {:.2f}s -> {:.2f}s ({:.0f}x faster) on {:,} rows'.format(
+        name, legacy_seconds, new_seconds, legacy_seconds / new_seconds, num_rows))
+
+
+def benchmark_vote_stats(num_votes=BENCHMARK_VOTES):
+    votes = make_votes(num_votes)
+
+    for new_func, legacy_func in [(calculate_vote_stats_for_content, baseline.calculate_vote_stats_for_content),
+                                  (calculate_vote_stats_for_users, baseline.calculate_vote_stats_for_users)]:
+        legacy_seconds, expected = time_call(legacy_func, decode_dtypes(votes))
+        new_seconds, result = time_call(new_func, votes)
+        assert_same_output(result, expected)
+        report(new_func.__name__, legacy_seconds, new_seconds, num_votes)
+
+
+def benchmark_karma_engine(num_votes=BENCHMARK_VOTES):
+    """Times run_vote_algorithm against the loop it replaced, checking the scores and effects are exactly the same."""
+
+    votes = make_votes(num_votes)
+    votes['power_d4'] = votes['power'].where(votes['power'] >= 0, votes['power'] * 4)
+    votes['voteId'] = np.arange(num_votes)
+
+    legacy_seconds, (expected_base_scores, expected_scores, expected_effects) = time_call(
+        baseline.run_incremental_vote_algorithm, decode_dtypes(votes))
+    new_seconds, (base_scores, scores, effects) = time_call(run_vote_algorithm, votes)
+    assert base_scores.to_dict() == expected_base_scores and scores.to_dict() == expected_scores
+    assert np.array_equal(effects, [expected_effects[vote_id] for vote_id in votes['voteId']])
+    report('run_vote_algorithm', legacy_seconds, new_seconds, num_votes)
+
+
+def sort_period_rows(df):
+    """Sorts per-document period rows by their (string) keys, as the two aggregations' categories are ordered
+    differently."""
+    df = df.astype({'collectionName': str, 'documentId': str})
+    return df.sort_values(['collectionName', 'documentId', 'votedAt']).reset_index(drop=True)
+
+
+def benchmark_period_aggregation(num_votes=BENCHMARK_VOTES // 10, periods=('D', 'W')):
+    """
+    Times agg_votes_to_period, including building the karma cube it rolls up, against resampling the votes of each
+    document, checking each period gives the same frame. Fewer votes by default, as resampling each document takes
+    minutes on all of them.
+    """
+
+    colls_dfs = make_collections(num_votes, num_views=0)
+    votes = colls_dfs['votes']
+    votes['power_d4'] = votes['power'].where(votes['power'] >= 0, votes['power'] * 4)
+    votes['downvote'] = votes['power'] < 0
+    votes['effect'] = run_vote_algorithm(votes)[2]
+
+    for pr in periods:
+        legacy_seconds, expected = time_call(baseline.agg_votes_to_period, decode_dtypes(votes), pr)
+        new_seconds, result = time_call(lambda: agg_votes_to_period(
+            build_karma_cube(votes, colls_dfs['posts'], colls_dfs['comments']), pr))
+        pd.testing.assert_frame_equal(sort_period_rows(result), sort_period_rows(expected), check_dtype=False)
+        report('agg_votes_to_period({!r})'.format(pr), legacy_seconds, new_seconds, num_votes)
+
+
+def benchmark_parallel_enrichment(processes=BENCHMARK_PROCESSES, num_views=BENCHMARK_VIEWS):
+    """Times enrich_collections with each number of processes, checking each gives exactly the serial output."""
+
+    colls_dfs = make_collections(num_views=num_views)
+    date_str = colls_dfs['views']['createdAt'].max().strftime('%Y-%m-%d')
+
+    serial_seconds, expected = time_call(enrich_collections, dict(colls_dfs), date_str)
+    for num_processes in processes:
+        seconds, result = time_call(enrich_collections, dict(colls_dfs), date_str, processes=num_processes)
+        for coll_name in expected:
+            pd.testing.assert_frame_equal(result[coll_name], expected[coll_name], check_exact=True)
+        print_and_log('enrich_collections with {} process(es): {:.2f}s ({:.1f}x serial) on {:,} views'.format(
+            num_processes, seconds, serial_seconds / seconds, num_views))
+
+
+def benchmark_karma_sweep(num_votes=BENCHMARK_VOTES // 10, variants=BENCHMARK_SWEEP_VARIANTS):
+    """Times sweep_karma_metric against rerunning the original vote loop for each variant, checking the daily series
+    are the same. Fewer votes by default, as the loop takes a while on all of them for each variant."""
+
+    votes = make_votes(num_votes)
+    legacy_seconds, expected = time_call(rerun_karma_metric_per_variant, votes, variants)
+    new_seconds, result = time_call(sweep_karma_metric, votes, variants)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    report('sweep_karma_metric ({} variants)'.format(len(variants)), legacy_seconds, new_seconds, num_votes)
+
+
+BENCHMARKS = {
+    'vote_stats': benchmark_vote_stats,
+    'karma_engine': benchmark_karma_engine,
+    'period_aggregation': benchmark_period_aggregation,
+    'karma_sweep': benchmark_karma_sweep,
+    'parallel_enrichment': benchmark_parallel_enrichment
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
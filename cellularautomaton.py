@@ -1,6 +1,17 @@
 import pandas as pd
 from gspread_pandas import Spread, Client
 from utils import timed, get_config_field
+from schema import decode_dtypes
+
+# enriched columns the sheets read, so only those need computing (see etlw.get_snapshot)
+SHEETS_COLUMNS = {
+    'users': ['days_since_active', 'most_recent_activity', 'num_days_present_last_30_days',
+              'num_distinct_posts_viewed_last_30_days', 'num_votes_last_30_days', 'num_comments_last_30_days',
+              'num_posts_last_30_days', 'num_views_last_180_days', 'num_votes_last_180_days',
+              'num_comments_last_180_days', 'num_posts_last_180_days'],
+    'posts': ['smallUpvote', 'bigUpvote', 'username', 'frontpaged', 'num_comments_rederived', 'num_distinct_viewers',
+              'num_votes', 'percent_downvotes', 'viewCountLogged'],
+}
 
 def create_and_update_user_sheet(dfu, spreadsheet, num_rows=None):
     data = dfu[~dfu['banned']].sort_values('karma', ascending=False)
@@ -96,9 +107,10 @@ def create_and_update_votes_sheet(dfv, spreadsheet, num_days=180):
 
 @timed
 def create_and_update_all_sheets(dfs, spreadsheet_name):
-    dfu = dfs['users']
-    dfp = dfs['posts']
-    dfv = dfs['votes']
+    # sheets get plain values (ids as strings etc.)
+    dfu = decode_dtypes(dfs['users'])
+    dfp = decode_dtypes(dfs['posts'])
+    dfv = decode_dtypes(dfs['votes'])
 
     s = Spread(get_config_field('GSHEETS', 'user'), spreadsheet_name, sheet='Users', create_spread=True, create_sheet=True)
     _ = create_and_update_user_sheet(dfu, s)
@@ -1,20 +1,21 @@
 """
 ea version of etlw
 """
-from etlw import get_collections_cleaned, enrich_collections
-from losttheplotly import run_plotline
-from measuringmarea import run_ea_metric_pipeline
+from etlw import get_snapshot, combine_columns, SNAPSHOT_MAX_AGE
+from losttheplotly import run_plotline, PLOTLINE_COLUMNS
+from measuringmarea import run_ea_metric_pipeline, EA_METRIC_COLUMNS
 from neweametric import run_new_ea_metric_pipeline
 from eadash import plot_ea_dashboard_other
 from utils import timed
 
 
 @timed
-def run(plot=True, metric=True, limit=None, online=True):
-    dfs_cleaned = get_collections_cleaned(limit=limit)
-    # treat max date in collections as "today"
-    today = dfs_cleaned['views']['createdAt'].max().strftime('%Y-%m-%d')
-    dfs_enriched = enrich_collections(dfs_cleaned, date_str=today)
+def run(plot=True, metric=True, limit=None, online=True, max_age=SNAPSHOT_MAX_AGE):
+    # reuses the snapshot of an etlw run (or an earlier run of this) if it's younger than max_age. Only the enriched
+    # columns of what runs are needed (the EA dashboard reads downloaded columns only), all of them if nothing does
+    sink_columns = [columns for sink, columns in [(metric, EA_METRIC_COLUMNS), (plot, PLOTLINE_COLUMNS)] if sink]
+    today, dfs_enriched = get_snapshot(limit=limit, max_age=max_age,
+                                       columns=combine_columns(*sink_columns) if sink_columns else None)
     if metric:
         run_ea_metric_pipeline(dfs_enriched, plot=plot, online=online)
         run_new_ea_metric_pipeline(plot=plot, online=online)
@@ -3,36 +3,161 @@ import datetime
 import numpy as np
 
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 import pathlib
 import html2text
-
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import contextlib
+import fcntl
+import itertools
+import json
+import operator
 import os
-
-from losttheplotly import run_plotline
-from karmametric import run_metric_pipeline
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from losttheplotly import run_plotline, build_unique_user_sketches, PLOTLINE_COLUMNS
+from karmametric import run_metric_pipeline, METRIC_COLUMNS
+from cellularautomaton import create_and_update_all_sheets, SHEETS_COLUMNS
 from flipthetable import run_pg_pandas_transfer
 
-from utils import timed, print_and_log, get_config_field
+from utils import timed, print_and_log, get_config_field, get_peak_memory_mb, map_in_threads
+from schema import (COLLECTION_SCHEMAS, INTERNED_ID_COLUMNS, ID_COLUMN_NAMES, DATETIME_COLUMNS, EXPORT_COLUMNS,
+                    get_columns, cast_to_schema, is_nullable_int, decode_dtypes)
+from sketches import build_sketches, estimate_distinct, get_precision, get_registers, merge_sketches
 
 MONGO_DB_NAME = get_config_field('MONGODB', 'db_name')
 MONGO_DB_URL = get_config_field('MONGODB', 'prod_db_url')
 BASE_PATH = get_config_field('PATHS', 'base')
 ENV = get_config_field('ENV', 'env')
 
+DOWNLOAD_BATCH_SIZE = 50000  # documents per streamed chunk when downloading collections
+
+# fields used as high-watermarks for incremental downloads. LW _ids are random strings and posts, comments and users
+# have no modified time, so createdAt stands in for them and changed documents are picked up by reconciling (see
+# get_collections_incremental)
+WATERMARK_FIELDS = {
+    'votes': 'votedAt',
+    'views': 'createdAt',
+    'logins': 'createdAt',
+    'comments': 'createdAt',
+    'posts': 'createdAt',
+    'users': 'createdAt'
+}
+MUTABLE_COLLECTIONS = ('comments', 'posts', 'users')  # in reconcile order
+WATERMARK_OVERLAP = pd.Timedelta(1, unit='h')
+
+DOWNLOAD_THREADS = 5  # collections downloaded concurrently; network-bound, so threads are enough
+
+# users get counts of their posts, comments, votes and views over each of these numbers of days before "today"
+ACTIVITY_WINDOWS = (30, 180)
+
+# whether posts' distinct commenters leave out users whose only comments on the post were deleted
+EXCLUDE_DELETED_COMMENTERS = False
+
+# the largest collections are split into ranges of this field and the ranges downloaded in parallel
+PARTITION_FIELDS = {'views': 'createdAt', 'logins': 'createdAt'}
+DOWNLOAD_PARTITIONS = 8
+PARTITION_RETRIES = 3
+
+mongo_client = None
+mongo_client_lock = threading.Lock()
+
+# snapshots of processed collections are written to processed/<date>/<coll>.parquet, compressed and filterable. The
+# event collections every pipeline loads are also written as uncompressed arrow (IPC) files, for memory-mapping
+MAPPED_COLLECTIONS = ('votes', 'views')
+SNAPSHOT_COMPRESSION = 'snappy'
+SNAPSHOT_ROW_GROUP_SIZE = 500000
+SNAPSHOT_SORT_COLUMNS = {'votes': 'votedAt', 'views': 'createdAt', 'logins': 'createdAt'}
+# collections that can be enriched out of core, streamed from the download (see download_and_enrich_out_of_core) or
+# back from the snapshot (see enrich_collections_out_of_core) in chunks taking at most a share of the memory budget
+OUT_OF_CORE_COLLECTIONS = ('votes', 'views')
+ENRICHMENT_MEMORY_BUDGET_MB = 1024
+RAW_DOCUMENT_BYTES = 1500  # rough size of a downloaded vote or view as a python dict, to size streamed chunks by
+
+# with a sketch_error, distinct view counts are estimated from these daily sketches (see get_view_stats_sketched),
+# saved with snapshots. Each takes at most SKETCH_BUDGET_MB, at a lower precision if need be
+VIEW_SKETCHES = ('post_viewer_sketches', 'user_post_sketches')
+SKETCH_BUDGET_MB = 512
+
+# enriched snapshots are shared between pipelines (see get_snapshot); one younger than this is reused rather than
+# downloading everything again
+SNAPSHOT_MAX_AGE = pd.Timedelta(12, unit='h')
+snapshot_cache = {}  # (date_str, limit, sketch_error) -> (created, dfs) for snapshots built or loaded by this process
+snapshot_lock = threading.RLock()
+snapshot_lock_file = None
+
+
+def get_mongo_client():
+    """
+    Returns the MongoClient shared by the whole process, download threads included, creating it on first use.
+    Weird bug: creating a second client times out on the DNS lookup.
+    """
+    global mongo_client
+    with mongo_client_lock:
+        if mongo_client is None:
+            mongo_client = MongoClient(MONGO_DB_URL)
+    return mongo_client
+
 
 def get_mongo_db_object():
-    # Weird bug: this next line times out on the DNS lookup if it's already been run
-    client = MongoClient(MONGO_DB_URL)
-    db = client[MONGO_DB_NAME]
+    db = get_mongo_client()[MONGO_DB_NAME]
     return db
 
 
-def get_collection(coll_name, db, projection=None, query_filter=None, limit=None):
+def iter_batches(cursor, batch_size):
+    """Yields lists of at most batch_size documents from a pymongo cursor."""
+    while True:
+        batch = list(itertools.islice(cursor, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def concat_chunks(chunks):
+    """
+    Concatenates dataframe chunks. Categories are unioned and all-missing datetime columns re-cast first, which plain
+    pd.concat would turn into object columns.
+    """
+    chunks = [chunk for chunk in chunks if chunk.shape[0] > 0] or chunks[:1]
+    if not chunks:
+        return pd.DataFrame()
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+
+    columns = chunks[0].columns
+    cat_cols = [col for col in columns if any(pd.api.types.is_categorical_dtype(chunk[col]) for chunk in chunks)]
+    dt_cols = [col for col in columns if any(pd.api.types.is_datetime64_any_dtype(chunk[col]) for chunk in chunks)]
+
+    for col in cat_cols:
+        categories = pd.Index(pd.api.types.union_categoricals(
+            [chunk[col].astype('category').values for chunk in chunks], ignore_order=True).categories)
+        chunks = [chunk.assign(**{col: chunk[col].astype(pd.api.types.CategoricalDtype(categories))})
+                  for chunk in chunks]
+
+    coll_df = pd.concat(chunks, ignore_index=True, sort=False)
+
+    for col in dt_cols:
+        if not pd.api.types.is_datetime64_any_dtype(coll_df[col]):
+            coll_df[col] = pd.to_datetime(coll_df[col])
+
+    return coll_df
+
+
+def get_collection(coll_name, db, projection=None, query_filter=None, limit=None, batch_size=None,
+                   chunk_func=None, chunk_sink=None):
     """
     Downloads and returns single collection from MongoDB and returns dataframe.
 
     Optional query filter can be applied (useful for downloading logins post-views from events table.
-    Returns a dataframe.
+    With batch_size, the cursor is read in batches, each turned into a dataframe and passed through chunk_func as it
+    arrives. With chunk_sink too, each chunk is given to it instead, and only the (empty) columns are returned.
     """
 
     kwargs = {} # necessary because pymongo function doesn't accept limit=None
@@ -40,136 +165,113 @@ def get_collection(coll_name, db, projection=None, query_filter=None, limit=None
         kwargs.update({'limit':limit})
 
     print_and_log('{} download started at {}. . .'.format(coll_name, datetime.datetime.today()))
-    coll_list = db[coll_name].find(query_filter, projection=projection, **kwargs)
-    coll_df = pd.DataFrame(list(coll_list))
-    print_and_log('{} download completed at {}!'.format(coll_name, datetime.datetime.today()))
+    start = time.time()
+    cursor = db[coll_name].find(query_filter, projection=projection, **kwargs)
+
+    if batch_size:
+        cursor = cursor.batch_size(batch_size)
+        chunks, num_rows = [], 0
+        for batch in iter_batches(cursor, batch_size):
+            chunk = pd.DataFrame(batch)
+            chunk = chunk_func(chunk) if chunk_func else chunk
+            num_rows += chunk.shape[0]
+            if chunk_sink:
+                chunk_sink(chunk)
+            else:
+                chunks.append(chunk)
+            del batch, chunk
+        if not chunks:  # nothing matched (or it all went to chunk_sink), but the (empty) columns should still come out
+            chunks.append(chunk_func(pd.DataFrame()) if chunk_func else pd.DataFrame())
+        coll_df = concat_chunks(chunks)
+        if chunk_sink:
+            coll_df = coll_df.iloc[:0]
+    else:
+        coll_df = pd.DataFrame(list(cursor))
+        if chunk_func:
+            coll_df = chunk_func(coll_df)
+        num_rows = coll_df.shape[0]
+
+    elapsed = time.time() - start
+    # the peak is the whole process's so far (see get_peak_memory_mb), not this download's
+    print_and_log('{} download completed at {}! {} rows in {:.1f}s ({:.0f} rows/sec), process peak memory {:.0f} MB'
+                  .format(coll_name, datetime.datetime.today(), num_rows, elapsed, num_rows / max(elapsed, 1e-6),
+                          get_peak_memory_mb()))
 
     return coll_df
 
 
+def get_field_range(coll_name, db, field, query_filter=None):
+    """Returns the smallest and largest value of field over documents matching query_filter, or (None, None)."""
+
+    def extreme(direction):
+        docs = list(db[coll_name].find({'$and': [query_filter or {}, {field: {'$ne': None}}]},
+                                       projection={field: 1, '_id': 0}).sort(field, direction).limit(1))
+        return docs[0][field] if docs else None
+
+    return extreme(1), extreme(-1)
+
+
+def get_partition_edges(lower, upper, partitions):
+    """
+    Splits the datetime range [lower, upper] into up to partitions equal-width ranges, no narrower than a millisecond.
+    Returns the list of range edges, at least two.
+    """
+
+    edges = pd.to_datetime(np.linspace(pd.Timestamp(lower).value, pd.Timestamp(upper).value, partitions + 1))
+    edges = list(edges.floor('ms').unique())  # mongo stores milliseconds, so edges finer than that would overlap
+    # the final range must include upper itself. The last floored edge is replaced by the end of upper's millisecond,
+    # unless it's the only one (lower and upper in the same millisecond)
+    return edges[:max(len(edges) - 1, 1)] + [pd.Timestamp(upper).floor('ms') + pd.Timedelta(1, unit='ms')]
+
+
+def get_collection_partitioned(coll_name, db, field, partitions, projection=None, query_filter=None,
+                               batch_size=None, chunk_func=None, chunk_sink=None, num_threads=DOWNLOAD_PARTITIONS):
+    """
+    Downloads a collection over up to num_threads cursors in parallel, one per equal-width range of a datetime field
+    plus one for documents without it. A failed range is retried on its own, up to PARTITION_RETRIES times, unless it
+    had a chunk_sink, which can't take back the chunks it was given (and is called from several threads).
+    """
+
+    lower, upper = get_field_range(coll_name, db, field, query_filter)
+    if lower is None:
+        return get_collection(coll_name, db, projection=projection, query_filter=query_filter,
+                              batch_size=batch_size, chunk_func=chunk_func, chunk_sink=chunk_sink)
+
+    edges = get_partition_edges(lower, upper, partitions)
+    range_filters = [{field: {'$gte': start.to_pydatetime(), '$lt': end.to_pydatetime()}}
+                     for start, end in zip(edges[:-1], edges[1:])] + [{field: None}]
+
+    def get_partition(range_filter):
+        for attempt in range(1, PARTITION_RETRIES + 1):
+            try:
+                return get_collection(coll_name, db, projection=projection,
+                                      query_filter={'$and': [query_filter or {}, range_filter]},
+                                      batch_size=batch_size, chunk_func=chunk_func, chunk_sink=chunk_sink)
+            except PyMongoError as e:
+                if attempt == PARTITION_RETRIES or chunk_sink:
+                    raise
+                print_and_log('{} partition {} failed ({}), retrying {}/{}'.format(
+                    coll_name, range_filter, e, attempt, PARTITION_RETRIES - 1))
+                time.sleep(2 ** attempt)
+
+    print_and_log('Downloading {} in {} partitions of {}'.format(coll_name, len(range_filters), field))
+
+    return concat_chunks(map_in_threads(get_partition, range_filters, num_threads=num_threads))
+
+
 @timed
-def get_collection_cleaned(coll_name, db,
-                           limit=None):  # (name of collection, MongoDB object, read/write arg bundle) -> dataframe
+def get_collection_cleaned(coll_name, db, limit=None, batch_size=None,
+                           query_filter=None, partitions=None, chunk_sink=None):  # (name of collection, MongoDB object) -> dataframe
     """
     Downloads, *processes* and returns single collection from MongoDB.
 
-     Processing retains only some columns, fills in missing values, and casts datatypes.
-     Processing is performed using a custom function for each collection.
+     Processing retains only the columns in the collection's schema and casts them to the schema's dtypes (see
+     schema.COLLECTION_SCHEMAS), then applies a custom function for each collection.
      Collection must be one of ['post', 'comments', 'users', 'votes', 'views' (lwevents with post-view filter)
-
-     Optionally writes to file based on io_config argument bundle.
+     batch_size, query_filter and chunk_sink are as for get_collection, partitions as for get_collection_partitioned.
 
      Returns a dataframe.
-
-     """
-
-    selected_columns = {
-        'posts': [
-            'af',
-            '_id',
-            'userId',
-            'title',
-            'postedAt',
-            'excerpt',
-            # 'contents', #not using at present, is large.
-            'baseScore',
-            'afBaseScore',
-            'score',
-            'viewCount',
-            'clickCount',
-            'commentCount',
-            'wordCount',
-            'commenters',
-            'createdAt',
-            'frontpageDate',
-            'curatedDate',
-            'draft',
-            'url',
-            'slug',
-            'legacy',
-            'question',
-            'userAgent',
-            'canonicalCollectionSlug',
-            # 'moderationGuidelinesHtmlBody',
-            # 'deleted', #there's only a single post with this flag, remove so as make sampling posts not fail
-            'legacySpam',
-            'isEvent',
-            'plaintextExcerpt',
-            'website',
-            'authorIsUnreviewed',
-            'status'
-        ],
-        'comments': [
-            '_id',
-            'af',
-            'userId',
-            'postId',
-            'postedAt',
-            'createdAt',
-            'baseScore',
-            'afBaseScore',
-            'score',
-            'deleted',
-            'parentCommentId',
-            'legacy',
-            'draft',
-            'answer',
-            'parentAnswerId',
-            'userAgent',
-            'wordCount',
-            # 'contents'
-        ],
-        'users': [
-            '_id',
-            'username',
-            'displayName',
-            'createdAt',
-            'postCount',
-            'commentCount',
-            'frontpagePostCount',
-            'karma',
-            'legacyKarma',
-            'bio',
-            'deleted',
-            'banned',
-            'email',
-            'legacy',
-            'afKarma',
-            'moderationGuidelinesHtmlBody',
-            'subscribers',
-            'shortformFeedId',
-            'signUpReCaptchaRating',
-            'reviewedByUserId'
-        ],
-        'votes': [
-            'afPower',
-            'collectionName',
-            'documentId',
-            'legacy',
-            'power',
-            'userId',
-            'voteType',
-            'votedAt',
-            'cancelled',
-            'isUnvote'
-        ],
-        'views': [
-            'userId',
-            'documentId',
-            'createdAt',
-            # 'name',
-            # 'legacy',
-            # 'important',
-            # 'intercom',
-        ],
-        'logins': [
-            '_id',
-            'userId',
-            'properties',
-            'createdAt',
-            'schema'
-        ]
-    }
+    """
 
     cleaning_functions = {
         'users': clean_raw_users,
@@ -189,57 +291,467 @@ def get_collection_cleaned(coll_name, db,
         else:
             return coll_name
 
-    raw_collection_df = get_collection(
-        db=db,
-        coll_name=name_check(coll_name),
-        projection=selected_columns[coll_name],
-        query_filter=query_filters.get(coll_name),
-        limit=limit
-    )
-    # when number of items pulled is small, some fields aren't present in any  of the items returned, which causes errors when you try to manipulate that column.
-    for col in selected_columns[coll_name]:
-        if col not in raw_collection_df.columns:
-            raw_collection_df.loc[:, col] = np.nan
-
-    cleaned_collection_df = cleaning_functions[coll_name](raw_collection_df)
-
-    # if io_config is not None:
-    #
-    #     if functions_and_filters[coll_name][1] is not None:
-    #         if functions_and_filters[coll_name][1]['name'] == 'post-view':
-    #             coll_name = 'views'  # haven't figured out a more elegant way to do this
-    #
-    #     write_collection(
-    #         coll_name=coll_name,
-    #         coll_df=df,
-    #         io_config=io_config
-    #     )
+    def clean_chunk(raw_df):
+        # every column is cast to its schema dtype here, once; missing fields are added as missing columns
+        return cleaning_functions[coll_name](cast_to_schema(raw_df, coll_name))
+
+    collection_filter = dict(query_filters.get(coll_name, {}), **(query_filter or {})) or None
+
+    if partitions and coll_name in PARTITION_FIELDS and not limit:
+        cleaned_collection_df = get_collection_partitioned(
+            db=db,
+            coll_name=name_check(coll_name),
+            field=PARTITION_FIELDS[coll_name],
+            partitions=partitions,
+            projection=get_columns(coll_name),
+            query_filter=collection_filter,
+            batch_size=batch_size,
+            chunk_func=clean_chunk,
+            chunk_sink=chunk_sink
+        )
+    else:
+        cleaned_collection_df = get_collection(
+            db=db,
+            coll_name=name_check(coll_name),
+            projection=get_columns(coll_name),
+            query_filter=collection_filter,
+            limit=limit,
+            batch_size=batch_size,
+            chunk_func=clean_chunk,
+            chunk_sink=chunk_sink
+        )
 
     return cleaned_collection_df
 
 
 @timed
-def get_collections_cleaned(coll_names=('comments', 'views', 'votes', 'posts', 'users'), limit=None):
+def get_collections_cleaned(coll_names=('comments', 'views', 'votes', 'posts', 'users'), limit=None,
+                            batch_size=DOWNLOAD_BATCH_SIZE, incremental=False, reconcile='full',
+                            num_threads=DOWNLOAD_THREADS, partitions=DOWNLOAD_PARTITIONS, interned=True):
+    """
+    For all collections in argument, downloads and cleans them, up to num_threads at a time, in batches of
+    batch_size documents and views and logins in partitions ranges (see get_collection_cleaned).
+    With incremental=True only documents newer than the stored watermarks are downloaded (see
+    get_collections_incremental) and limit is ignored. Unless interned is False, ids are interned (see intern_ids).
+    """
+    if incremental:
+        colls_dict = get_collections_incremental(coll_names, batch_size=batch_size, reconcile=reconcile,
+                                                 num_threads=num_threads, partitions=partitions)
+    else:
+        db = get_mongo_db_object()
+        colls = map_in_threads(lambda name: get_collection_cleaned(name, db, limit, batch_size=batch_size,
+                                                                   partitions=partitions),
+                               coll_names, num_threads=num_threads)
+        colls_dict = dict(zip(coll_names, colls))
+
+    if interned:
+        colls_dict = intern_ids(colls_dict)
+
+    return colls_dict
+
+
+def aggregate_to_frame(db, coll_name, pipeline, index_name):
+    """Runs an aggregation pipeline on MongoDB and returns the results as a dataframe indexed by the group _id."""
+
+    results = pd.DataFrame(list(db[coll_name].aggregate(pipeline, allowDiskUse=True)))
+    if results.shape[0] == 0:
+        return pd.DataFrame(index=pd.Index([], name=index_name))
+
+    results = results[results['_id'].notnull()].set_index('_id')  # pandas groupbys drop null keys too
+    results.index.name = index_name
+
+    return results
+
+
+@timed
+def get_view_stats_pushdown(db, date_str, latest_view, windows=ACTIVITY_WINDOWS):
+    """
+    Computes the post and user view statistics with aggregation pipelines on MongoDB instead of downloading views.
+    Views are first grouped by (documentId, userId) pair, so distinct counts are counts of pairs.
+
+    Returns a dict of dataframes as calc_post_view_stats ('post_view_stats'), calc_user_view_stats
+    ('user_view_stats', the 30 days present counted back from latest_view) and the view columns of
+    calc_user_recent_activity ('user_recent_view_stats', windows before date_str) return them.
+    """
+
+    match = {'name': 'post-view'}
+    present_date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    cutoffs = {n: present_date - datetime.timedelta(days=n) for n in windows}
+
+    def not_null(field):
+        return {'$cond': [{'$ifNull': [field, False]}, 1, 0]}
+
+    post_view_stats = aggregate_to_frame(db, 'lwevents', [
+        {'$match': match},
+        {'$group': {'_id': {'documentId': '$documentId', 'userId': '$userId'},
+                    'n': {'$sum': 1}, 'last': {'$max': '$createdAt'}}},
+        {'$group': {'_id': '$_id.documentId',
+                    'most_recent_view_logged': {'$max': '$last'},
+                    'viewCountLogged': {'$sum': '$n'},
+                    'num_distinct_viewers': {'$sum': not_null('$_id.userId')}}}
+    ], index_name='documentId')
+
+    # num_views counts createdAt, as calc_user_view_stats does, so views without one aren't counted
+    user_view_stats = aggregate_to_frame(db, 'lwevents', [
+        {'$match': match},
+        {'$group': {'_id': {'userId': '$userId', 'documentId': '$documentId'},
+                    'n': {'$sum': not_null('$createdAt')}, 'first': {'$min': '$createdAt'}, 'last': {'$max': '$createdAt'}}},
+        {'$group': {'_id': '$_id.userId',
+                    'num_views': {'$sum': '$n'},
+                    'most_recent_view': {'$max': '$last'},
+                    'earliest_view': {'$min': '$first'},
+                    'num_distinct_posts_viewed': {'$sum': not_null('$_id.documentId')}}}
+    ], index_name='userId')
+
+    view_presence_stats = aggregate_to_frame(db, 'lwevents', [
+        {'$match': dict(match, createdAt={'$gte': latest_view - datetime.timedelta(days=30 - 1)})},
+        {'$group': {'_id': {'userId': '$userId',
+                            'date': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$createdAt'}}}}},
+        {'$group': {'_id': '$_id.userId', 'num_days_present_last_30_days': {'$sum': 1}}}
+    ], index_name='userId')
+
+    user_view_stats = user_view_stats.merge(view_presence_stats, left_index=True, right_index=True, how='outer')
+
+    window_counts = {'n_{}'.format(n): {'$sum': {'$cond': [{'$gt': ['$createdAt', cutoff]}, 1, 0]}}
+                     for n, cutoff in cutoffs.items()}
+    window_stats = {}
+    for n in windows:
+        window_stats['num_views_last_{}_days'.format(n)] = {'$sum': '$n_{}'.format(n)}
+        window_stats['num_distinct_posts_viewed_last_{}_days'.format(n)] = {'$sum': {'$cond': [
+            {'$and': [{'$gt': ['$n_{}'.format(n), 0]}, {'$ifNull': ['$_id.documentId', False]}]}, 1, 0]}}
+
+    user_recent_view_stats = aggregate_to_frame(db, 'lwevents', [
+        {'$match': dict(match, createdAt={'$gt': min(cutoffs.values())})},
+        {'$group': dict({'_id': {'userId': '$userId', 'documentId': '$documentId'}}, **window_counts)},
+        {'$group': dict({'_id': '$_id.userId'}, **window_stats)}
+    ], index_name='userId')
+
+    return {
+        'post_view_stats': post_view_stats,
+        'user_view_stats': user_view_stats,
+        'user_recent_view_stats': user_recent_view_stats
+    }
+
+
+def build_id_dictionary(colls_dfs, id_dictionary=None):
+    """
+    Returns the global id dictionary (a pd.Index of Mongo ids whose positions are the codes) extended with any ids in
+    colls_dfs it doesn't have yet. New ids are appended, so codes stay stable from run to run.
+    """
+    if id_dictionary is None:
+        id_dictionary = pd.Index([], dtype=object)
+
+    ids = [np.asarray(df[col].dropna().unique(), dtype=object)
+           for coll_name, df in colls_dfs.items() for col in INTERNED_ID_COLUMNS.get(coll_name, []) if col in df]
+    new_ids = pd.Index(np.concatenate(ids) if ids else [], dtype=object).unique().difference(id_dictionary)
+
+    return id_dictionary.append(new_ids)
+
+
+@timed
+def intern_ids(colls_dfs, id_dictionary=None):
+    """
+    Replaces the Mongo id columns of every collection (see INTERNED_ID_COLUMNS) with categoricals sharing one id
+    dictionary, built on id_dictionary (or the one saved with the latest snapshot), so merges and isin between
+    collections work on integer codes. Decode them with schema.decode_dtypes for output.
+    """
+    if id_dictionary is None:
+        id_dictionary = load_id_dictionary()
+    id_dtype = pd.api.types.CategoricalDtype(build_id_dictionary(colls_dfs, id_dictionary))
+
+    interned_dfs = {}
+    for coll_name, df in colls_dfs.items():
+        cols = [col for col in INTERNED_ID_COLUMNS.get(coll_name, []) if col in df]
+        interned_dfs[coll_name] = df.assign(**{col: df[col].astype(id_dtype) for col in cols}) if cols else df
+    print_and_log('Interned ids: {} in dictionary.'.format(len(id_dtype.categories)))
+
+    return interned_dfs
+
+
+def get_id_dtype(dfs):
+    """Returns the shared id categorical dtype of a dict of interned dataframes, or None if ids aren't interned."""
+    for coll_name, df in dfs.items():
+        for col in INTERNED_ID_COLUMNS.get(coll_name, []):
+            if col in df and pd.api.types.is_categorical_dtype(df[col]):
+                return df[col].dtype
+    return None
+
+
+def load_id_dictionary(date_str=None):
+    """
+    Loads the id dictionary saved with a snapshot (by default the most recent one that has one).
+    Returns a pd.Index of ids, empty if there is none.
+    """
+    date_strs = [date_str] if date_str else [os.path.basename(folder) for folder in get_list_of_dates()]
+    for date_str in date_strs:
+        path = get_snapshot_directory(date_str) + '/ids.parquet'
+        if os.path.exists(path):
+            return pd.Index(pq.read_table(path).column('id').to_pandas(), dtype=object)
+
+    return pd.Index([], dtype=object)
+
+
+def get_incremental_path(file_name):
+    directory = BASE_PATH + '{folder}'.format(folder='incremental')
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+    return directory + '/' + file_name
+
+
+def load_watermarks():
+    """Loads the per-collection high-watermarks saved by the last incremental run. Returns a dict of timestamps."""
+    path = get_incremental_path('watermarks.json')
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return {coll_name: pd.Timestamp(ts) for coll_name, ts in json.load(f).items()}
+
+
+def save_watermarks(watermarks):
+    with open(get_incremental_path('watermarks.json'), 'w') as f:
+        json.dump({coll_name: ts.isoformat() for coll_name, ts in watermarks.items() if pd.notnull(ts)}, f, indent=2)
+
+
+def load_incremental_snapshot(coll_name):
+    """Loads the locally stored copy of a cleaned collection, or None if there isn't one yet."""
+    path = get_incremental_path('{}.pkl'.format(coll_name))
+    if not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+
+def save_incremental_snapshot(coll_name, coll_df):
+    path = get_incremental_path('{}.pkl'.format(coll_name))
+    coll_df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)  # never leave a half-written snapshot behind
+
+
+def get_collection_since(coll_name, db, watermark, batch_size=None, partitions=None):
+    """Downloads and cleans the documents of a collection that are newer than the watermark."""
+
+    field = WATERMARK_FIELDS[coll_name]
+    # re-read a little before the watermark in case documents were written slightly out of order; they're deduped
+    since = (watermark - WATERMARK_OVERLAP).to_pydatetime()
+    print_and_log('Fetching {} with {} after {}'.format(coll_name, field, since))
+
+    return get_collection_cleaned(coll_name, db, batch_size=batch_size, query_filter={field: {'$gt': since}},
+                                  partitions=partitions)
+
+
+def get_collection_by_ids(coll_name, db, ids, batch_size=None, ids_per_query=10000):
+    """Downloads and cleans the documents of a collection with the given _ids."""
+
+    ids = list(ids)
+    chunks = [get_collection_cleaned(coll_name, db, batch_size=batch_size,
+                                     query_filter={'_id': {'$in': ids[i:i + ids_per_query]}})
+              for i in range(0, len(ids), ids_per_query)]
+
+    return concat_chunks(chunks)
+
+
+def get_unvotes_since(db, watermark):
+    """Downloads the unvotes placed after the watermark. These are needed to drop the votes they cancelled."""
+
+    since = (watermark - WATERMARK_OVERLAP).to_pydatetime()
+    unvotes = get_collection('votes', db, projection=['documentId', 'userId', 'voteType', 'votedAt'],
+                             query_filter={'isUnvote': True, 'votedAt': {'$gt': since}})
+    for col in ['documentId', 'userId', 'voteType', 'votedAt']:
+        if col not in unvotes.columns:
+            unvotes[col] = np.nan
+
+    return unvotes
+
+
+def remove_unvoted(votes, unvotes):
+    """
+    Drops votes that were later cancelled: any vote by the same user of the same type on the same document placed
+    before one of unvotes (the watermark never sees the cancelled vote itself again).
+    """
+    if unvotes.shape[0] == 0:
+        return votes
+
+    keys = ['documentId', 'userId', 'voteType']
+    last_unvote = unvotes.assign(voteType=unvotes['voteType'].astype(str)).groupby(keys)['votedAt'].max()
+    last_unvote = pd.to_datetime(last_unvote).to_frame('unvotedAt')
+
+    unvoted_at = votes[keys].assign(voteType=votes['voteType'].astype(str)).merge(
+        last_unvote, left_on=keys, right_index=True, how='left')['unvotedAt'].values
+    cancelled = votes['votedAt'].values < unvoted_at  # NaT compares False
+    print_and_log('Removing {} votes cancelled since last run.'.format(cancelled.sum()))
+
+    return votes[~cancelled]
+
+
+def upsert_documents(snapshot, updates):
+    """Replaces documents in snapshot which also appear in updates and appends the rest, matching on _id."""
+    if snapshot is None:
+        return updates
+    if updates.shape[0] == 0:
+        return snapshot
+
+    return concat_chunks([snapshot[~snapshot['_id'].isin(updates['_id'])], updates])
+
+
+def get_touched_ids(coll_name, new_docs, snapshots):
+    """
+    Returns the _ids of documents in a mutable collection that new votes, comments and views may have changed (scores,
+    comment and view counts, karma and post counts).
+    """
+
+    def col_values(coll, col, mask=None):
+        df = new_docs.get(coll)
+        if df is None or col not in df.columns:
+            return set()
+        values = df[col] if mask is None else df.loc[mask(df), col]
+        return set(values.dropna())
+
+    if coll_name == 'posts':
+        return (col_values('votes', 'documentId', lambda df: df['collectionName'] == 'Posts') |
+                col_values('comments', 'postId') | col_values('views', 'documentId'))
+    if coll_name == 'comments':
+        return col_values('votes', 'documentId', lambda df: df['collectionName'] == 'Comments')
+    if coll_name == 'users':
+        voted_on = col_values('votes', 'documentId')
+        authors = set()
+        for coll in ('posts', 'comments'):
+            for df in (snapshots.get(coll), new_docs.get(coll)):
+                if df is not None:
+                    authors |= set(df.loc[df['_id'].isin(voted_on), 'userId'].dropna())
+        return authors | col_values('posts', 'userId') | col_values('comments', 'userId')
+
+    return set()
+
+
+@timed
+def get_collections_incremental(coll_names=('comments', 'views', 'votes', 'posts', 'users'),
+                                batch_size=DOWNLOAD_BATCH_SIZE, reconcile='full', num_threads=DOWNLOAD_THREADS,
+                                partitions=DOWNLOAD_PARTITIONS):
     """
-    For all collections in argument, downloads and cleans them.
-    Returns a dict of dataframes.
+    Brings the locally stored snapshot of each collection up to date and returns it as a dict of dataframes.
+
+    Documents newer than the saved watermark (see WATERMARK_FIELDS) are downloaded and upserted on _id, and cancelled
+    votes removed. Posts, comments and users are then reconciled: reconcile='full' downloads them again, 'touched'
+    only what new events may have changed (see get_touched_ids), missing changes that come without any.
     """
+
     db = get_mongo_db_object()
-    colls_dict = {name: get_collection_cleaned(name, db, limit) for name in coll_names}
+    watermarks = load_watermarks()
+    snapshots = {name: load_incremental_snapshot(name) for name in coll_names}
+
+    def download_new(name):
+        if snapshots[name] is None or name not in watermarks or (reconcile == 'full' and name in MUTABLE_COLLECTIONS):
+            print_and_log('{}: no usable snapshot, downloading in full.'.format(name))
+            snapshots[name] = None
+            return get_collection_cleaned(name, db, batch_size=batch_size, partitions=partitions)
+        return get_collection_since(name, db, watermarks[name], batch_size=batch_size, partitions=partitions)
+
+    new_docs = dict(zip(coll_names, map_in_threads(download_new, coll_names, num_threads=num_threads)))
+
+    # mutable collections are reconciled against the new events, in order since users depend on posts and comments
+    for name in MUTABLE_COLLECTIONS:
+        if name in coll_names and snapshots[name] is not None:
+            touched_ids = get_touched_ids(name, new_docs, snapshots) - set(new_docs[name]['_id'])
+            print_and_log('{}: refreshing {} documents touched by new activity.'.format(name, len(touched_ids)))
+            new_docs[name] = concat_chunks([new_docs[name],
+                                            get_collection_by_ids(name, db, touched_ids, batch_size=batch_size)])
+
+    if 'votes' in coll_names and snapshots['votes'] is not None:
+        snapshots['votes'] = remove_unvoted(snapshots['votes'], get_unvotes_since(db, watermarks['votes']))
+
+    colls_dict = {}
+    for name in coll_names:
+        colls_dict[name] = upsert_documents(snapshots[name], new_docs[name])
+        print_and_log('{}: {} new or updated documents, {} in total.'.format(
+            name, new_docs[name].shape[0], colls_dict[name].shape[0]))
+        save_incremental_snapshot(name, colls_dict[name])
+        watermarks[name] = colls_dict[name][WATERMARK_FIELDS[name]].max()
+
+    save_watermarks(watermarks)
 
     return colls_dict
 
 
+def prepare_for_parquet(coll_df):
+    """
+    Converts a dataframe to an arrow table for writing to parquet. Object columns mixing types arrow can't store as
+    one column are stored as strings, and nullable ints as arrow ints with nulls.
+    """
+
+    nullable_cols = [col for col in coll_df.columns if is_nullable_int(coll_df[col])]
+    if nullable_cols:
+        nullable_arrays = {col: pa.array(coll_df[col].fillna(0).astype(coll_df[col].dtype.numpy_dtype).values,
+                                         mask=coll_df[col].isnull().values) for col in nullable_cols}
+        coll_df = coll_df.assign(**{col: coll_df[col].astype(float) for col in nullable_cols})
+
+    try:
+        table = pa.Table.from_pandas(coll_df, preserve_index=False)
+    except (pa.ArrowException, TypeError, ValueError):
+        coll_df = coll_df.copy(deep=False)
+        for col in coll_df.columns[coll_df.dtypes == object]:
+            try:
+                pa.array(coll_df[col], from_pandas=True)
+            except (pa.ArrowException, TypeError, ValueError):
+                print_and_log('Storing mixed-type column {} as strings.'.format(col))
+                coll_df[col] = coll_df[col].where(coll_df[col].isnull(), coll_df[col].astype(str))
+        table = pa.Table.from_pandas(coll_df, preserve_index=False)
+
+    for col in nullable_cols:
+        i = table.schema.get_field_index(col)
+        table = table.set_column(i, pa.field(col, nullable_arrays[col].type), nullable_arrays[col])
+
+    return table
+
+
+def write_arrow_file(table, path):
+    """Writes an arrow table to an uncompressed arrow IPC file. The file is swapped in whole so readers never see
+    half of it."""
+    writer = pa.ipc.new_file(path + '.tmp', table.schema)
+    writer.write_table(table)
+    writer.close()
+    os.replace(path + '.tmp', path)
+
+
+def read_arrow_mapped(path, columns=None):
+    """
+    Memory-maps an arrow IPC file and returns it as a dataframe. Fixed-width columns without nulls are views onto the
+    mapped pages, shared with every other process mapping them; strings and lists are still materialised.
+    """
+
+    table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    if columns is not None:
+        fields = [table.schema.field(col) for col in columns]
+        table = pa.Table.from_arrays([table.column(col) for col in columns],
+                                     schema=pa.schema(fields, metadata=table.schema.metadata))
+
+    return table.to_pandas(split_blocks=True)
+
+
+def get_snapshot_directory(date_str):
+    return BASE_PATH + '{folder}/{date}'.format(folder='processed', date=date_str)  # vestigial folder structure
+
+
 @timed
 def write_collection(coll_name, coll_df, date_str):  # (string, df, arg_bundle) -> None
-    # hardcoded to write to db directory. wonderful hardcoding
-    # this function really needs some cleanin'
+    """
+    Writes a collection to processed/<date>/<coll_name>.parquet, and .arrow too for MAPPED_COLLECTIONS. Event
+    collections are sorted by time first, so load_from_file can skip row groups when filtering on time.
+    """
 
     print_and_log('Writing {} to disk.'.format(coll_name))
 
-    directory = BASE_PATH + '{folder}/{date}'.format(folder='processed', date=date_str)  # vestigial folder structure
-    pathlib.Path(directory).mkdir(exist_ok=True)
-    coll_df.to_csv(directory + '/{}.csv'.format(coll_name), index=False)
+    directory = get_snapshot_directory(date_str)
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+    if SNAPSHOT_SORT_COLUMNS.get(coll_name) in coll_df.columns:
+        coll_df = coll_df.sort_values(SNAPSHOT_SORT_COLUMNS[coll_name], kind='mergesort')
+    # interned ids are stored as their codes, the dictionary is written once by write_collections
+    coll_df = coll_df.assign(**{col: coll_df[col].cat.codes for col in coll_df.columns
+                                if col in ID_COLUMN_NAMES and pd.api.types.is_categorical_dtype(coll_df[col])})
+    table = prepare_for_parquet(coll_df)
+    path = directory + '/{}.parquet'.format(coll_name)
+    pq.write_table(table, path + '.tmp', compression=SNAPSHOT_COMPRESSION, row_group_size=SNAPSHOT_ROW_GROUP_SIZE)
+    os.replace(path + '.tmp', path)  # swapped in whole, like the arrow file
+    if coll_name in MAPPED_COLLECTIONS:
+        write_arrow_file(table, directory + '/{}.arrow'.format(coll_name))
 
     print_and_log('Writing {} to disk completed.\n'.format(coll_name))
 
@@ -247,11 +759,24 @@ def write_collection(coll_name, coll_df, date_str):  # (string, df, arg_bundle)
 
 
 def write_collections(dfs, date_str):  # dict[{string: df}] -> None
-    """Writes all dataframes in dataframe dictionary to file."""
+    """Writes all dataframes in dataframe dictionary to file, plus the id dictionary if ids are interned."""
     [write_collection(coll_name, coll_df, date_str) for coll_name, coll_df in dfs.items()]
+
+    id_dtype = get_id_dtype(dfs)
+    if id_dtype is not None:
+        write_id_dictionary(id_dtype.categories, date_str)
     return None
 
 
+def write_id_dictionary(id_dictionary, date_str):
+    """Writes the id dictionary (see build_id_dictionary) interned id columns are stored as codes into to
+    processed/<date>/ids.parquet."""
+    path = get_snapshot_directory(date_str) + '/ids.parquet'
+    pq.write_table(pa.Table.from_pandas(pd.DataFrame({'id': id_dictionary}), preserve_index=False),
+                   path + '.tmp', compression=SNAPSHOT_COMPRESSION)
+    os.replace(path + '.tmp', path)
+
+
 def get_list_of_dates():
     """Searches folder path for list of folders by dates with data downloads
 
@@ -267,50 +792,341 @@ def get_list_of_dates():
 
 @timed
 def clean_up_old_files(days_to_keep=1):
-    """Function for deleting old file downloads. Accepts """
+    """
+    Deletes all but the days_to_keep most recent snapshots, on disk and in the snapshot cache, and the arrow copies of
+    all but the most recent one. Metadata goes first, so no reader picks up a snapshot being deleted.
+    """
+
+    with locked_snapshots():
+        folders = get_list_of_dates()
+        for folder in folders[days_to_keep:]:
+            date_str = os.path.basename(folder)
+            for key in [key for key in snapshot_cache if key[0] == date_str]:
+                del snapshot_cache[key]
+            if os.path.exists(folder + '/snapshot.json'):
+                os.remove(folder + '/snapshot.json')
+            shutil.rmtree(folder, ignore_errors=True)
+            print_and_log('Deleted snapshot {}.'.format(date_str))
+        for folder in folders[1:days_to_keep]:
+            for path in pathlib.Path(folder).glob('*.arrow'):
+                path.unlink()
+
+
+FILTER_OPERATORS = {
+    '==': operator.eq, '!=': operator.ne, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+    'in': lambda col, values: col.isin(values), 'not in': lambda col, values: ~col.isin(values)
+}
+
+
+PARQUET_TIME_UNITS = {'milliseconds': 'ms', 'microseconds': 'us', 'nanoseconds': 'ns'}
+
+
+def get_statistics_bounds(stats):
+    """
+    Returns the min and max of a parquet column chunk's statistics, or None if it has none. Timestamps come back as
+    naive pd.Timestamps, however pyarrow gives them.
+    """
+
+    if stats is None or not stats.has_min_max:
+        return None
+
+    bounds = [stats.min, stats.max]
+    unit = re.search(r'timeUnit=(\w+)', str(stats.logical_type))
+    if unit and unit.group(1) in PARQUET_TIME_UNITS:
+        bounds = [pd.Timestamp(bound, unit=PARQUET_TIME_UNITS[unit.group(1)]) if isinstance(bound, (int, np.integer))
+                  else pd.Timestamp(bound) for bound in bounds]
+        bounds = [bound.tz_convert(None) if bound.tz is not None else bound for bound in bounds]
+
+    return bounds
+
+
+def row_group_may_match(row_group, filters):
+    """Uses a parquet row group's min/max statistics to check whether any of its rows can pass the filters."""
+
+    columns = {row_group.column(i).path_in_schema: row_group.column(i) for i in range(row_group.num_columns)}
+    for col, op, value in filters:
+        bounds = get_statistics_bounds(columns[col].statistics) if col in columns else None
+        if bounds is None or op not in ('==', '<', '<=', '>', '>=', 'in'):
+            continue
+        try:
+            lower, upper = bounds
+            values = value if op == 'in' else [value]
+            if ((op in ('==', 'in') and all(v < lower or v > upper for v in values)) or
+                    (op == '<' and not lower < value) or (op == '<=' and not lower <= value) or
+                    (op == '>' and not upper > value) or (op == '>=' and not upper >= value)):
+                return False
+        except (TypeError, ValueError):  # statistics not comparable with the value, so can't rule anything out
+            continue
+
+    return True
+
 
-    date_folders = get_list_of_dates()
+def read_parquet_filtered(path, columns=None, filters=None):
+    """
+    Reads a parquet file into a dataframe, optionally only columns and only rows passing filters, a list of (column,
+    operator, value), e.g. [('votedAt', '>', '2019-06-01')]. Row groups whose statistics rule them out aren't read.
+    """
+
+    parquet_file = pq.ParquetFile(path)
+    filters = [(col, op, pd.Timestamp(value) if col in DATETIME_COLUMNS and not isinstance(value, (list, tuple))
+                else value) for col, op, value in filters or []]
+    filter_cols = [col for col, _, _ in filters]
+    read_cols = None if columns is None else list(dict.fromkeys(list(columns) + filter_cols))
+
+    row_groups = [i for i in range(parquet_file.num_row_groups)
+                  if row_group_may_match(parquet_file.metadata.row_group(i), filters)]
+    if filters:  # so a filter that never rules out a row group (e.g. its statistics are unusable) shows up
+        print_and_log('Reading {} of {} row groups of {} for filters {}'.format(
+            len(row_groups), parquet_file.num_row_groups, path, filters))
+    if row_groups:
+        table = pa.concat_tables([parquet_file.read_row_group(i, columns=read_cols, use_pandas_metadata=True)
+                                  for i in row_groups])
+    else:
+        table = parquet_file.schema.to_arrow_schema().empty_table()
+    df = table.to_pandas()
+
+    if filters:
+        mask = np.ones(df.shape[0], dtype=bool)
+        for col, op, value in filters:
+            mask &= np.asarray(FILTER_OPERATORS[op](df[col], value))
+        df = df[mask].reset_index(drop=True)
+
+    return df if columns is None else df[list(columns)]
 
 
 @timed
-def load_from_file(date_str, coll_names=('votes', 'views', 'comments', 'posts', 'users')):
-    """Loads database collections from csvs to dataframes, ensures datetimes load correctly."""
+def load_from_file(date_str, coll_names=('votes', 'views', 'comments', 'posts', 'users'), columns=None,
+                   filters=None, memory_map=True):
+    """
+    Loads database collections from a snapshot in processed/<date> to dataframes, ensures datetimes load correctly.
+
+    Collections are memory-mapped from their arrow files where there are any and no filters (see read_arrow_mapped),
+    else read from parquet, or from csv for older snapshots. columns and filters (see read_parquet_filtered) apply to
+    all collections or are dicts by collection, e.g.
+        load_from_file('most_recent', ['votes'], filters={'votes': [('votedAt', '>', '2019-06-01')]})
+    """
+
+    def for_collection(arg, coll_name):
+        return arg.get(coll_name) if isinstance(arg, dict) else arg
+
+    def filters_for_collection(coll_name):
+        # interned ids are stored as codes, so ids in filters are looked up in the dictionary (unknown ids match nothing)
+        coll_filters = []
+        for col, op, value in for_collection(filters, coll_name) or []:
+            if col in ID_COLUMN_NAMES and id_dtype is not None:
+                codes = id_dictionary.get_indexer(value if op in ('in', 'not in') else [value])
+                codes[codes < 0] = -2  # -1 is the code for a missing id
+                value = list(codes) if op in ('in', 'not in') else codes[0]
+            coll_filters.append((col, op, value))
+        return coll_filters
 
     @timed
+    def read_collection(coll_name):
+        print_and_log('Reading {}'.format(coll_name))
+        if (memory_map and not for_collection(filters, coll_name) and
+                os.path.exists(complete_path_to_file(coll_name, 'arrow'))):
+            return read_arrow_mapped(complete_path_to_file(coll_name, 'arrow'),
+                                     columns=for_collection(columns, coll_name))
+        if os.path.exists(complete_path_to_file(coll_name, 'parquet')):
+            return read_parquet_filtered(complete_path_to_file(coll_name, 'parquet'),
+                                         columns=for_collection(columns, coll_name),
+                                         filters=filters_for_collection(coll_name))
+        return read_csv(coll_name)
+
     def read_csv(coll_name):
+        cols = for_collection(columns, coll_name)
+        filter_cols = [col for col, _, _ in for_collection(filters, coll_name) or []]
+        usecols = None if cols is None else list(dict.fromkeys(list(cols) + filter_cols))
+        df = pd.read_csv(complete_path_to_file(coll_name, 'csv'), usecols=usecols)
 
-        print_and_log('Reading {}'.format(coll_name))
-        df = pd.read_csv(complete_path_to_file(coll_name), dtype=read_dtypes_arg[coll_name])
-
-        # read in all datetime types correctly
-        for dt_col in ['postedAt', 'createdAt', 'votedAt', 'startTime', 'endTime',
-                       'earliest_comment', 'most_recent_comment', 'earliest_vote', 'most_recent_vote',
-                       'most_recent_post', 'earliest_post', 'most_recent_activity', 'earliest_activity',
-                       'true_earliest', 'curatedAt', 'earliest_view'
-                       ]:
+        # read in all datetime types correctly, the rest are cast to their schema dtypes by load_collection
+        for dt_col in DATETIME_COLUMNS:
             if dt_col in df.columns:
                 df.loc[:, dt_col] = pd.to_datetime(df[dt_col])
 
-        return df
+        for col, op, value in for_collection(filters, coll_name) or []:
+            if col in DATETIME_COLUMNS and not isinstance(value, (list, tuple)):
+                value = pd.Timestamp(value)
+            df = df[np.asarray(FILTER_OPERATORS[op](df[col], value))]
+
+        return df if cols is None else df[list(cols)]
 
-    def complete_path_to_file(coll_name):
-        return BASE_PATH + '{folder}/{date}/{coll_name}.csv'.format(folder='processed', date=date_str, coll_name=coll_name)
+    def complete_path_to_file(coll_name, extension):
+        return BASE_PATH + '{folder}/{date}/{coll_name}.{ext}'.format(folder='processed', date=date_str,
+                                                                     coll_name=coll_name, ext=extension)
 
     if date_str == 'most_recent':
-        date_str = get_list_of_dates()[0][-8:]
-
-    read_dtypes_arg = {
-        'users': None,
-        'posts': None,
-        'comments': None,
-        'votes': {'collectionName': 'category', 'voteType': 'category', 'afPower': 'int8', 'power': 'int8'},
-        'views': None
-    }
+        date_str = os.path.basename(get_list_of_dates()[0])
+
+    id_dictionary = load_id_dictionary(date_str)
+    id_dtype = pd.api.types.CategoricalDtype(id_dictionary) if len(id_dictionary) else None
+
+    def load_collection(coll_name):
+        return restore_dtypes(read_collection(coll_name), coll_name, id_dtype)
 
     print_and_log("Files to be loaded:")
-    [print(complete_path_to_file(coll_name)) for coll_name in coll_names]
+    [print(get_snapshot_directory(date_str) + '/' + coll_name) for coll_name in coll_names]
+
+    return {coll_name: load_collection(coll_name) for coll_name in coll_names}
+
+
+def restore_dtypes(df, coll_name, id_dtype=None):
+    """Restores the dtypes of a collection read back from a snapshot file (see write_collection): id codes become
+    categoricals of id_dtype and columns the format couldn't keep the dtype of are cast to the collection's schema."""
+
+    # ids were stored as codes into the snapshot's id dictionary. Columns are set in place rather than with
+    # assign, which would copy the memory-mapped columns
+    if id_dtype is not None:
+        for col in df.columns:
+            if col in ID_COLUMN_NAMES and pd.api.types.is_integer_dtype(df[col]):
+                df[col] = pd.Categorical.from_codes(df[col], dtype=id_dtype)
+    # only columns the snapshot format couldn't keep the dtype of (e.g. nullable ints) are actually cast
+    return cast_to_schema(df, coll_name, add_missing=False) if coll_name in COLLECTION_SCHEMAS else df
+
+
+@contextlib.contextmanager
+def locked_snapshots():
+    """
+    Lets one thread of one process at a time build, write or delete snapshots (a file lock covers other processes), so
+    a pipeline asking for a snapshot being built waits for it and reuses it. Re-entrant within a thread.
+    """
+    global snapshot_lock_file
+
+    with snapshot_lock:
+        if snapshot_lock_file is not None:  # already held by this thread
+            yield
+            return
+
+        directory = BASE_PATH + '{folder}'.format(folder='processed')
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        lock_file = open(directory + '/.snapshot.lock', 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        snapshot_lock_file = lock_file
+        try:
+            yield
+        finally:
+            snapshot_lock_file = None
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+
+def save_snapshot_metadata(date_str, limit, coll_names, created, sketch_error=None, columns=None):
+    """
+    Writes processed/<date>/snapshot.json describing a snapshot, including its columns (collection -> column names).
+    It's written last and swapped in whole, so a snapshot only counts as there once all its files are.
+    """
+    path = get_snapshot_directory(date_str) + '/snapshot.json'
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'date': date_str, 'limit': limit, 'collections': list(coll_names),
+                   'created': created.isoformat(), 'sketch_error': sketch_error, 'columns': columns}, f)
+    os.replace(path + '.tmp', path)
+
+
+def add_to_snapshot(coll_name, df, date_str):
+    """
+    Writes a dataframe derived from a snapshot's collections (e.g. the karma cube) into the snapshot in
+    processed/<date>, then lists it in the snapshot's metadata, if it has any.
+    """
+    with locked_snapshots():
+        write_collection(coll_name, df, date_str)
+        metadata = load_snapshot_metadata(date_str)
+        if metadata is None:
+            return
+        coll_names = [name for name in metadata['collections'] if name != coll_name] + [coll_name]
+        columns = metadata.get('columns')
+        if columns is not None:
+            columns = dict(columns, **{coll_name: list(df.columns)})
+        save_snapshot_metadata(date_str, metadata['limit'], coll_names, metadata['created'],
+                               sketch_error=metadata.get('sketch_error'), columns=columns)
+
+
+def load_snapshot_metadata(date_str):
+    """Returns the metadata of the snapshot in processed/<date>, or None if there isn't a complete one."""
+    path = get_snapshot_directory(date_str) + '/snapshot.json'
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        metadata = json.load(f)
+    metadata['created'] = pd.Timestamp(metadata['created'])
+    return metadata
+
+
+def has_columns(snapshot_columns, columns=None):
+    """
+    Whether a snapshot with snapshot_columns (collection -> column names) has all of columns (likewise), or all the
+    enriched columns if None. Snapshots whose columns weren't recorded were fully enriched.
+    """
+    if snapshot_columns is None:
+        return True
+    if columns is None:
+        columns = get_enriched_columns()
+    return all(set(names) <= set(snapshot_columns.get(coll_name, names)) for coll_name, names in columns.items())
+
 
-    return {coll_name: read_csv(coll_name) for coll_name in coll_names}
+def find_fresh_snapshot(limit, coll_names, max_age, sketch_error=None, columns=None):
+    """
+    Returns (date_str, dict of dataframes) of the newest snapshot built with limit and sketch_error, with coll_names
+    and columns and younger than max_age, from this process's cache or else disk, or None if there isn't one.
+    """
+    now = pd.Timestamp.now()
+
+    for (date_str, cached_limit, cached_error), (created, dfs) in sorted(snapshot_cache.items(),
+                                                                          key=lambda item: item[1][0], reverse=True):
+        if ((cached_limit, cached_error) == (limit, sketch_error) and now - created <= max_age and
+                set(coll_names) <= set(dfs) and
+                has_columns({coll_name: list(df.columns) for coll_name, df in dfs.items()}, columns)):
+            print_and_log('Reusing snapshot {} from memory.'.format(date_str))
+            return date_str, dfs
+
+    for folder in get_list_of_dates():
+        metadata = load_snapshot_metadata(os.path.basename(folder))
+        if (metadata is None or metadata['limit'] != limit or metadata.get('sketch_error') != sketch_error or
+                now - metadata['created'] > max_age or not set(coll_names) <= set(metadata['collections']) or
+                not has_columns(metadata.get('columns'), columns)):
+            continue
+        try:
+            dfs = load_from_file(metadata['date'], coll_names=metadata['collections'])
+        except (OSError, pa.ArrowException) as e:  # e.g. deleted by clean_up_old_files in another process
+            print_and_log('Could not load snapshot {}: {}'.format(metadata['date'], e))
+            continue
+        print_and_log('Reusing snapshot {} from disk.'.format(metadata['date']))
+        snapshot_cache[(metadata['date'], limit, sketch_error)] = (metadata['created'], dfs)
+        return metadata['date'], dfs
+
+    return None
+
+
+@timed
+def get_snapshot(limit=None, coll_names=('users', 'posts', 'comments', 'votes', 'views'), max_age=SNAPSHOT_MAX_AGE,
+                 incremental=False, pushdown=False, verify=False, sketch_error=None, columns=None, processes=1,
+                 memory_budget_mb=None):
+    """
+    Returns the data date and a dict of enriched collection dataframes, reusing a fresh snapshot (see
+    find_fresh_snapshot) or else downloading and enriching them (see download_and_enrich) and writing one. Pass
+    max_age=pd.Timedelta(0) to force a download. The dataframes are shallow copies: don't modify values in place.
+    """
+
+    with locked_snapshots():
+        snapshot = find_fresh_snapshot(limit, coll_names, max_age, sketch_error=sketch_error, columns=columns)
+        if snapshot is None:
+            created = pd.Timestamp.now()
+            date_str, dfs = download_and_enrich(limit=limit, incremental=incremental,
+                                                pushdown=pushdown and 'views' not in coll_names, verify=verify,
+                                                sketch_error=sketch_error, columns=columns, processes=processes,
+                                                memory_budget_mb=memory_budget_mb)
+            # collections enriched out of core were written by download_and_enrich already
+            written = OUT_OF_CORE_COLLECTIONS if memory_budget_mb is not None and not incremental else ()
+            write_collections({coll_name: df for coll_name, df in dfs.items() if coll_name not in written},
+                              date_str=date_str)
+            save_snapshot_metadata(date_str, limit, dfs.keys(), created, sketch_error=sketch_error,
+                                   columns={coll_name: list(df.columns) for coll_name, df in dfs.items()})
+            for key in [key for key in snapshot_cache if key[1:] == (limit, sketch_error)]:  # superseded
+                del snapshot_cache[key]
+            snapshot_cache[(date_str, limit, sketch_error)] = (created, dfs)
+            snapshot = date_str, dfs
+
+    date_str, dfs = snapshot
+    return date_str, {coll_name: df.copy(deep=False) for coll_name, df in dfs.items()}
 
 
 def htmlBody2plaintext(html_series, ignore_links=False):
@@ -339,154 +1155,154 @@ def convertContents2Body(df):
 
 def clean_raw_posts(posts):
     """
-    Takes raw dataframe of posts collections and fixes datatypes and similar.
-    Casting important for memory optimization.
+    Takes raw dataframe of posts collections, cast to the posts schema, and fixes anything else.
     """
 
     # posts = remove_mjx(posts)
     # posts = convertContents2Body(posts)
 
-    # ensure proper datetime encoding
-    posts.loc[:, 'postedAt'] = pd.to_datetime(posts['postedAt'])
-    posts.loc[:, 'createdAt'] = pd.to_datetime(posts['createdAt'])
-
-    # fill in missing values and cast to appropriate types
-    for col in ['viewCount', 'clickCount', 'commentCount', 'wordCount']:
-        posts.loc[:, col] = posts.loc[:, col].fillna(0).astype(int)
-    for col in ['draft', 'legacy', 'af', 'question', 'legacySpam', 'isEvent']:
-        posts.loc[:, col] = posts.loc[:, col].fillna(False).astype(bool)
-
     return posts
 
 
 def clean_raw_comments(comments):
-    comments.loc[:, 'postedAt'] = pd.to_datetime(comments['postedAt'])
-    comments.loc[:, 'createdAt'] = pd.to_datetime(comments['createdAt'])
-    for col in ['deleted', 'legacy', 'af', 'answer']:
-        comments.loc[:, col] = comments.loc[:, col].fillna(False).astype(bool)
-
     return comments
 
 
 def clean_raw_users(users):
     """
-    Takes raw dataframe of users collections and returns subset of columns + processes columns.
-    Casting is important for memory optimization.
+    Takes raw dataframe of users collections, cast to the users schema, and processes columns.
     """
-    users.loc[:, 'createdAt'] = pd.to_datetime(users['createdAt'])
-    users.loc[:, 'afKarma'] = users['afKarma'].fillna(0)
-    for col in ['postCount', 'commentCount', 'frontpagePostCount', 'karma', 'legacyKarma']:
-        users.loc[:, col] = users.loc[:, col].fillna(0).astype(int)
-    for col in ['deleted', 'legacy', 'banned']:
-        users.loc[:, col] = users.loc[:, col].fillna(False).astype(bool)
-
     return users
 
 
 def clean_raw_votes(votes):
     """
-    Takes raw dataframe of votes collections and returns subset of columns + processes columns.
-    Casting here *very* important for memory optimization. Use categories and small integer types.
+    Takes raw dataframe of votes collections, cast to the votes schema, and drops cancelled votes. Missing userIds
+    stay missing (not the string 'nan'), so they aren't counted as a user.
     """
 
-    votes.loc[:, 'cancelled'] = votes['cancelled'].fillna(False).astype(bool)
-    votes.loc[:, 'isUnvote'] = votes['isUnvote'].fillna(False).astype(bool)
-    votes = votes.loc[~votes['cancelled'], :]
-
-    votes.loc[:, 'afPower'] = votes['afPower'].fillna(0).astype('int8')
-    votes.loc[:, 'collectionName'] = votes['collectionName'].astype('category')
-    votes.loc[:, 'legacy'] = votes['legacy'].fillna(False).astype(bool)
-    votes.loc[:, 'power'] = votes['power'].astype('int8')
-    votes.loc[:, 'voteType'] = votes['voteType'].astype('category')
-    votes.loc[:, 'votedAt'] = pd.to_datetime(votes['votedAt'])
-    votes.loc[:, 'userId'] = votes['userId'].astype(str)
-
-    return votes
+    return votes.loc[~votes['cancelled'], :]
 
 
 def clean_raw_views(views):
     """Takes raw dataframe of views collection and returns filtered/processed dataframe."""
-
-    views.loc[:, 'createdAt'] = pd.to_datetime(views['createdAt'])
-    # views.loc[:, 'name'] = views['name'].astype('category') #only ever contains "post-view"
-    # views.loc[:, 'legacy'] = views['legacy'].fillna(False).astype(bool) #never use it, but want to remember it's there
-
     return views
 
 
 def clean_raw_logins(logins_df):
     """Takes raw dataframe of logins collection and returns filtered/processed dataframe."""
+    return logins_df
 
-    logins_parsed = logins_df
-    logins_parsed.loc[:, 'createdAt'] = pd.to_datetime(logins_parsed['createdAt'])
 
-    return logins_parsed
+VOTE_TYPES = ['smallUpvote', 'smallDownvote', 'bigUpvote', 'bigDownvote']
 
 
-def calculate_vote_stats_for_content(votes_df):
-    """Accepts dataframe on votes, aggregates to document level and returns stats.
-
-    Returns stats about kinds of votes placed (small/big,up/down) and when last vote was made.
+def aggregate_vote_stats(votes_df, key):
     """
+    Aggregates votes to key (documentId or userId, or a list of columns): a count column per vote type, num_votes,
+    percent_downvotes, percent_bigvotes, most_recent_vote and earliest_vote.
+    """
+
+    keys = key if isinstance(key, list) else [key]
+    vote_type_stats = votes_df.groupby(keys + ['voteType'], observed=True).size().unstack(level='voteType',
+                                                                                          fill_value=0)
+    vote_date_stats = votes_df.groupby(key, observed=True)['votedAt'].agg(['max', 'min'])
 
-    votes_df['voteType'] = votes_df['voteType'].astype(str)
+    return finish_vote_stats(vote_type_stats, vote_date_stats)
 
-    vote_type_stats = votes_df.groupby(['documentId', 'voteType']).size().unstack(level='voteType').fillna(0).astype(
-        int)
 
-    for col in ['smallUpvote', 'smallDownvote', 'bigUpvote', 'bigDownvote']:
+def finish_vote_stats(vote_type_stats, vote_date_stats):
+    """
+    Completes vote statistics from a count column per vote type and the vote dates (max and/or min), indexed by the
+    same key: adds missing vote types, num_votes, the percentages, most_recent_vote and earliest_vote.
+    """
+
+    # plain column names in name order, as when voteType isn't a category, missing vote types included so the
+    # columns are the same whichever votes were aggregated (e.g. a partition of them, see enrich_collections)
+    vote_type_stats.columns = vote_type_stats.columns.astype(str)
+    for col in VOTE_TYPES:
         if col not in vote_type_stats.columns:
             vote_type_stats[col] = 0
+    vote_type_stats = vote_type_stats.sort_index(axis=1)
 
     vote_type_stats['num_votes'] = vote_type_stats.sum(axis=1)
     vote_type_stats['percent_downvotes'] = (
             vote_type_stats[['smallDownvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
     vote_type_stats['percent_bigvotes'] = (
             vote_type_stats[['bigUpvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
-    vote_date_stats = votes_df.groupby('documentId').apply(
-        lambda x: pd.Series(data={'most_recent_vote': x['votedAt'].max()}))
 
-    vote_stats = vote_type_stats.merge(vote_date_stats, left_index=True, right_index=True)
+    vote_date_stats = vote_date_stats.rename(columns={'max': 'most_recent_vote', 'min': 'earliest_vote'})
 
-    return vote_stats
+    return vote_type_stats.merge(vote_date_stats, left_index=True, right_index=True)
 
 
-def calculate_vote_stats_for_users(votes_df):
-    """Accepts dataframe on votes, aggregates to users and returns stats for users.
+def calculate_vote_stats_for_content(votes_df):
+    """Accepts dataframe on votes, aggregates to document level and returns stats.
 
-    Returns stats about kinds of votes placed (small/big,up/down) and when last and earliest votes were made.
+    Returns stats about kinds of votes placed (small/big,up/down) and when last vote was made.
     """
 
-    votes_df['voteType'] = votes_df['voteType'].astype(str)
+    return aggregate_vote_stats(votes_df, 'documentId').drop(columns='earliest_vote')
 
-    vote_date_stats = votes_df.groupby('userId').apply(lambda x: pd.Series(data={ 'most_recent_vote': x['votedAt'].max(),
-                                                                                 'earliest_vote': x['votedAt'].min()}))
 
-    vote_type_stats = votes_df.groupby(['userId', 'voteType']).size().unstack(level='voteType').fillna(0).astype(int)
-    for col in ['smallUpvote', 'smallDownvote', 'bigUpvote', 'bigDownvote']:
-        if col not in vote_type_stats.columns:
-            vote_type_stats[col] = 0
+def calculate_vote_stats_for_documents(votes_df):
+    """As calculate_vote_stats_for_content, but indexed by collectionName and documentId so the posts and comments
+    can each be sliced out (see select_collection)."""
 
-    vote_type_stats['num_votes'] = vote_type_stats.sum(axis=1)
+    return aggregate_vote_stats(votes_df, ['collectionName', 'documentId']).drop(columns='earliest_vote')
 
-    vote_type_stats['percent_downvotes'] = (
-            vote_type_stats[['smallDownvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
-    vote_type_stats['percent_bigvotes'] = (
-            vote_type_stats[['bigUpvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
 
-    vote_stats = vote_date_stats.merge(vote_type_stats, left_index=True, right_index=True)
+def select_collection(document_stats, collection_name):
+    """Returns the rows of an aggregate indexed by collectionName and documentId for one collection, indexed by
+    documentId."""
+
+    is_collection = document_stats.index.get_level_values('collectionName') == collection_name
+    return document_stats[is_collection].reset_index(level='collectionName', drop=True)
+
+
+def get_aggregate(aggregates, name, func, *args):
+    """
+    Returns the aggregate called name, computing it as func(*args) the first time it's asked for, and counts its uses.
+    """
+
+    if name not in aggregates:
+        start = time.time()
+        aggregates[name] = {'result': func(*args), 'seconds': time.time() - start, 'uses': 0}
+    aggregates[name]['uses'] += 1
+
+    return aggregates[name]['result']
+
 
-    return vote_stats
+def log_aggregate_usage(aggregates):
+    for name, aggregate in aggregates.items():
+        print_and_log('Aggregate {}: computed in {:.2f}s, used {} time(s){}'.format(
+            name, aggregate['seconds'], aggregate['uses'], ', reused' if aggregate['uses'] > 1 else ''))
+
+
+def calculate_vote_stats_for_users(votes_df):
+    """Accepts dataframe on votes, aggregates to users and returns stats for users.
+
+    Returns stats about kinds of votes placed (small/big,up/down) and when last and earliest votes were made.
+    """
+
+    return put_vote_dates_first(aggregate_vote_stats(votes_df, 'userId'))
+
+
+def put_vote_dates_first(vote_stats):
+    date_cols = ['most_recent_vote', 'earliest_vote']
+    return vote_stats[date_cols + [col for col in vote_stats.columns if col not in date_cols]]
 
 
 def calc_user_view_stats(views_df):
-    view_date_stats = views_df.groupby('userId')['createdAt'].agg(
+    view_date_stats = views_df.groupby('userId', observed=True)['createdAt'].agg(
         {'num_views': 'count', 'most_recent_view': 'max', 'earliest_view': 'min'})
-    view_post_stats = views_df.groupby('userId')['documentId'].nunique().to_frame('num_distinct_posts_viewed')
+    view_post_stats = views_df.groupby('userId', observed=True)['documentId'].nunique().to_frame(
+        'num_distinct_posts_viewed')
 
-    views_df['date'] = views_df['createdAt'].dt.date
     views_last_30 = views_df[views_df['createdAt'] >= views_df['createdAt'].max() - pd.Timedelta(30 - 1, unit='d')]
-    view_presence_stats = views_last_30.groupby('userId')['date'].nunique().to_frame('num_days_present_last_30_days')
+    view_days = views_last_30['createdAt'].dt.floor('D')
+    view_presence_stats = view_days.groupby(views_last_30['userId'], observed=True).nunique().to_frame(
+        'num_days_present_last_30_days')
     view_presence_stats['num_days_present_last_30_days'] = view_presence_stats['num_days_present_last_30_days'].fillna(
         0)
 
@@ -502,7 +1318,7 @@ def calc_user_view_stats(views_df):
 def calc_user_comment_stats(comments):  # df -> df
     """Calculates aggregates statistics over a user's comments."""
 
-    comment_stats = comments.groupby('userId')['postedAt'].agg({'total_comments': 'size',
+    comment_stats = comments.groupby('userId', observed=True)['postedAt'].agg({'total_comments': 'size',
                                                                 'earliest_comment': 'min',
                                                                 'most_recent_comment': 'max'})
 
@@ -518,8 +1334,10 @@ def calc_user_post_stats(posts):  # df -> df
     # dfp.loc[dfp['body'].str.contains('image/png|image/jpeg') == True, 'characters'] = np.nan
 
     # dfp['frontpageDate'] = dfp['frontpageDate'].replace(0, np.nan) # this should *not* be necessary. Remember to track it upstream.
-    posts['frontpaged'] = posts['frontpageDate'].notnull()
-    postsByUser = posts[~posts['draft']].groupby('userId')
+    # posts isn't modified: frontpaged is added to the posts by enrich_posts
+    published_posts = posts.loc[~posts['draft'], ['userId', 'postedAt', 'draft']].assign(
+        frontpaged=posts['frontpageDate'].notnull())
+    postsByUser = published_posts.groupby('userId', observed=True)
 
     post_date_stats = postsByUser['postedAt'].agg(
         {'total_posts': 'size', 'earliest_post': 'min', 'most_recent_post': 'max'})
@@ -535,193 +1353,1310 @@ def calc_user_post_stats(posts):  # df -> df
     return post_stats
 
 
-def calc_user_recent_activity(posts, comments, votes, views, present_date):
-    def activity_last_n(n, date):
-        # could be made to contain another function called repeatedly, but it's fine. It works.
+def get_window_buckets(times, date, windows):
+    """
+    Returns, for each time, the position in windows (sorted ascending) of the smallest window of days before date that
+    contains it (it's after date - n days), or len(windows) if none does.
+    """
 
-        n_days_ago = date - pd.to_timedelta(n, 'days')
+    edges = np.array([pd.Timedelta(n, unit='d').value for n in windows], dtype='timedelta64[ns]')
+    ages = (date - pd.DatetimeIndex(times)).values
+    buckets = np.searchsorted(edges, ages, side='right')
+    buckets[pd.isnull(ages)] = len(windows)
 
-        comments_ln = comments[(comments['postedAt'] > n_days_ago)].groupby('userId').size().to_frame(
-            'num_comments_last_{}_days'.format(n))
-        posts_ln = posts[(posts['postedAt'] > n_days_ago) & (~posts['draft'])].groupby('userId').size().to_frame(
-            'num_posts_last_{}_days'.format(n))
-        votes_ln = votes[(votes['votedAt'] > n_days_ago)].groupby('userId').size().to_frame(
-            'num_votes_last_{}_days'.format(n))
-        views_ln = views[(views['createdAt'] > n_days_ago)].groupby('userId').size().to_frame(
-            'num_views_last_{}_days'.format(n))
-        distinct_posts_viewed_ln = views[(views['createdAt'] > n_days_ago)].groupby('userId')[
-            'documentId'].nunique().to_frame('num_distinct_posts_viewed_last_{}_days'.format(n))
+    return buckets
 
-        ln_stats = (
-            posts_ln
-                .merge(comments_ln, left_index=True, right_index=True, how='outer')
-                .merge(votes_ln, left_index=True, right_index=True, how='outer')
-                .merge(views_ln, left_index=True, right_index=True, how='outer')
-                .merge(distinct_posts_viewed_ln, left_index=True, right_index=True, how='outer')
 
-        )
+def count_in_windows(keys, times, date, windows):
+    """
+    Counts events per key (e.g. userId) in each of several windows of days before date, in one pass. Returns a
+    dataframe indexed by key with a column per window, in the order of windows, for keys with an event in any.
+    """
 
-        return ln_stats
+    buckets = get_window_buckets(times, date, windows)
+    in_window = buckets < len(windows)
+    counts = (pd.DataFrame({keys.name: keys[in_window].values, 'bucket': buckets[in_window]})
+              .groupby([keys.name, 'bucket'], observed=True).size().unstack(level='bucket', fill_value=0)
+              .reindex(columns=range(len(windows)), fill_value=0)
+              .cumsum(axis=1))
+    counts.columns = list(windows)
 
-    recent_activity = (activity_last_n(30, present_date).merge(activity_last_n(180, present_date),
-                                                               left_index=True, right_index=True, how='outer')
-                       ).fillna(0).astype(int)
+    return counts
 
-    return recent_activity
 
+def count_distinct_in_windows(keys, values, times, date, windows):
+    """
+    Counts the distinct values (e.g. documentId) per key in each of several windows of days before date, as for
+    count_in_windows. A (key, value) pair is in a window if its latest event is.
+    """
 
-def enrich_posts(colls_dfs):
-    users = colls_dfs['users']
-    posts = colls_dfs['posts']
-    comments = colls_dfs['comments']
-    views = colls_dfs['views']
-    votes = colls_dfs['votes']
+    in_window = get_window_buckets(times, date, windows) < len(windows)
+    pairs = pd.DataFrame({keys.name: keys[in_window].values, values.name: values[in_window].values,
+                          'time': times[in_window].values})
+    latest = pairs.groupby([keys.name, values.name], observed=True)['time'].max()
+
+    return count_in_windows(pd.Series(latest.index.get_level_values(keys.name), name=keys.name), latest, date,
+                            windows)
+
+
+def calc_user_recent_activity(posts, comments, votes, views, present_date, view_activity=None, vote_activity=None,
+                              windows=ACTIVITY_WINDOWS):
+    """
+    Counts each user's posts, comments, votes, views and distinct posts viewed over each of windows. If views or votes
+    is None, their counts are taken from view_activity (see get_view_stats_pushdown) or vote_activity (see
+    derive_vote_stats) instead.
+    """
+
+    windows = sorted(windows)
+
+    def named(counts, name):
+        counts.columns = [name.format(n) for n in windows]
+        return counts
+
+    published_posts = posts[~posts['draft']]
+    activity = [
+        named(count_in_windows(published_posts['userId'], published_posts['postedAt'], present_date, windows),
+              'num_posts_last_{}_days'),
+        named(count_in_windows(comments['userId'], comments['postedAt'], present_date, windows),
+              'num_comments_last_{}_days')
+    ]
+    if votes is not None:
+        activity.append(named(count_in_windows(votes['userId'], votes['votedAt'], present_date, windows),
+                              'num_votes_last_{}_days'))
+    else:
+        activity.append(vote_activity[['num_votes_last_{}_days'.format(n) for n in windows]])
+    view_names = ['num_views_last_{}_days', 'num_distinct_posts_viewed_last_{}_days']
+    if views is not None:
+        activity += [
+            named(count_in_windows(views['userId'], views['createdAt'], present_date, windows), view_names[0]),
+            named(count_distinct_in_windows(views['userId'], views['documentId'], views['createdAt'], present_date,
+                                            windows), view_names[1])
+        ]
+    else:
+        activity.append(view_activity[[name.format(n) for name in view_names for n in windows]])
+
+    recent_activity = activity[0]
+    for counts in activity[1:]:
+        recent_activity = recent_activity.merge(counts, left_index=True, right_index=True, how='outer')
+
+    # columns grouped by window
+    names = ['num_posts_last_{}_days', 'num_comments_last_{}_days', 'num_votes_last_{}_days'] + view_names
+    return recent_activity[[name.format(n) for n in windows for name in names]].fillna(0).astype(int)
+
+
+def calc_post_view_stats(views):  # df -> df
+    """Calculates view counts, most recent view and number of distinct viewers for each post."""
+
+    views_by_post = views.groupby('documentId', observed=True)
+    return pd.DataFrame({'most_recent_view_logged': views_by_post['createdAt'].max(),
+                         'viewCountLogged': views_by_post.size(),
+                         'num_distinct_viewers': views_by_post['userId'].nunique()})
+
+
+def calc_post_comment_stats(comments):  # df -> df
+    """Calculates the number of comments on each post and when the most recent one was posted."""
+
+    comments_by_post = comments.groupby('postId', observed=True)
+
+    return pd.DataFrame({'num_comments_rederived': comments_by_post['_id'].nunique(),
+                         'most_recent_comment': comments_by_post['postedAt'].max()})
+
+
+def calc_post_commenter_stats(comments, exclude_deleted=EXCLUDE_DELETED_COMMENTERS):  # df -> df
+    """Counts the distinct users who commented on each post, leaving out deleted comments if exclude_deleted."""
+
+    if exclude_deleted:
+        comments = comments[~comments['deleted'].fillna(False).astype(bool)]
+
+    return comments.groupby('postId', observed=True)['userId'].nunique().to_frame('num_distinct_commenters')
+
+
+def get_usernames(users):  # df -> df
+    return users.set_index('_id')[['username', 'displayName']]
+
+
+# Aggregates shared by the enrichment steps: name -> (function, collection it aggregates, columns of it the function
+# reads, key the collection can be partitioned by or None). A collection can be partitioned if each group of the
+# aggregate only depends on its own rows (the views by user can't: their 30 day window ends at the latest view).
+AGGREGATES = {
+    'posts_by_user': (calc_user_post_stats, 'posts', ['userId', 'postedAt', 'draft', 'frontpageDate'], None),
+    'comments_by_user': (calc_user_comment_stats, 'comments', ['userId', 'postedAt'], 'userId'),
+    'votes_by_user': (calculate_vote_stats_for_users, 'votes', ['userId', 'voteType', 'votedAt'], 'userId'),
+    'views_by_user': (calc_user_view_stats, 'views', ['userId', 'documentId', 'createdAt'], None),
+    'comments_by_post': (calc_post_comment_stats, 'comments', ['postId', '_id', 'postedAt'], 'postId'),
+    'commenters_by_post': (calc_post_commenter_stats, 'comments', ['postId', 'userId', 'deleted'], 'postId'),
+    'votes_by_document': (calculate_vote_stats_for_documents, 'votes',
+                          ['collectionName', 'documentId', 'voteType', 'votedAt'], 'documentId'),
+    'views_by_post': (calc_post_view_stats, 'views', ['documentId', 'userId', 'createdAt'], 'documentId'),
+    'usernames': (get_usernames, 'users', ['_id', 'username', 'displayName'], None),
+}
+
+# aggregates taken from colls_dfs when there instead of computed, e.g. pushed down to MongoDB (see
+# get_view_stats_pushdown): aggregate name -> colls_dfs key
+PUSHED_DOWN_AGGREGATES = {'views_by_post': 'post_view_stats', 'views_by_user': 'user_view_stats'}
+
+
+def get_named_aggregate(aggregates, name, colls_dfs):
+    """Returns the aggregate called name of colls_dfs (see AGGREGATES), computing it the first time it's asked for
+    (see get_aggregate)."""
+    func, coll_name, _, _ = AGGREGATES[name]
+    # the collection is only needed to compute the aggregate, which can be given without it (e.g. derived beforehand)
+    return get_aggregate(aggregates, name, func, *([] if name in aggregates else [colls_dfs[coll_name]]))
+
+
+def add_pushed_down_aggregates(aggregates, colls_dfs):
+    for name, key in PUSHED_DOWN_AGGREGATES.items():
+        if key in colls_dfs and name not in aggregates:
+            aggregates[name] = {'result': colls_dfs[key], 'seconds': 0, 'uses': 0}
+
+
+def merge_stats(df, stats, date_cols=()):
+    """Left merges stats indexed by _id into df, with date_cols of stats as datetimes."""
+    df = df.merge(stats, left_on='_id', right_index=True, how='left')
+    for col in date_cols:
+        df[col] = pd.to_datetime(df[col])
+    return df
+
+
+# Enrichment steps (see ENRICHMENT_STEPS): functions (df, colls_dfs, aggregates, date) -> df that add columns to df,
+# the collection enriched so far
+
+def add_post_comment_stats(posts, colls_dfs, aggregates, date):
+    return merge_stats(posts, get_named_aggregate(aggregates, 'comments_by_post', colls_dfs), ['most_recent_comment'])
 
-    def num_commenters(commenters_list):
-        if commenters_list == commenters_list:  # check for isnan, works since nan == nan is false
-            if type(commenters_list) == str:
-                return len(
-                    [u.replace("'", '').replace('"', '').strip() for u in commenters_list.strip('[]').split(',')])
-            else:
-                return len(commenters_list)
-        else:
-            return 0
-
-    # comment stats
-    comment_stats = comments.groupby('postId').apply(lambda x: pd.Series(data={
-        'num_comments_rederived': x['_id'].nunique(),
-        'most_recent_comment': x['postedAt'].max()
-    }))
-
-    # vote stats for post
-    vote_stats = calculate_vote_stats_for_content(votes)
-
-    # view stats for post
-    view_date_stats = views.groupby('documentId').apply(lambda x: pd.Series(data={
-        'most_recent_view_logged': x['createdAt'].max(),
-        'viewCountLogged': x.shape[0]
-    }))
-    view_distinct_viewers = views.groupby('documentId')['userId'].nunique().to_frame('num_distinct_viewers')
-    view_stats = view_date_stats.merge(view_distinct_viewers, left_index=True, right_index=True, how='left')
-
-    posts = (posts
-             .merge(comment_stats, left_on='_id', right_index=True, how='left')
-             .merge(vote_stats, left_on='_id', right_index=True, how='left')
-             .merge(view_stats, left_on='_id', right_index=True, how='left')
-             )
-
-    # recent activity stats
-    recent_activity_cols = ['most_recent_vote', 'most_recent_view_logged', 'most_recent_comment']
-    for col in recent_activity_cols:
-        posts[col] = pd.to_datetime(posts[col])
-    posts['most_recent_activity'] = posts[recent_activity_cols].max(axis=1)
-
-    # further column additions
 
+def add_post_vote_stats(posts, colls_dfs, aggregates, date):
+    vote_stats = select_collection(get_named_aggregate(aggregates, 'votes_by_document', colls_dfs), 'Posts')
+    return merge_stats(posts, vote_stats, ['most_recent_vote'])
+
+
+def add_post_view_stats(posts, colls_dfs, aggregates, date):
+    return merge_stats(posts, get_named_aggregate(aggregates, 'views_by_post', colls_dfs),
+                       ['most_recent_view_logged'])
+
+
+def add_post_most_recent_activity(posts, colls_dfs, aggregates, date):
+    posts['most_recent_activity'] = posts[['most_recent_vote', 'most_recent_view_logged', 'most_recent_comment']].max(
+        axis=1)
+    return posts
+
+
+def add_post_flags(posts, colls_dfs, aggregates, date):
     # dfp['frontpageDate'] = dfp['frontpageDate'].replace(0, np.nan) #shouldn't be necessary, track upstream
     posts['frontpaged'] = posts['frontpageDate'].notnull()
-    posts['num_distinct_commenters'] = posts['commenters'].apply(num_commenters)
-    posts['gw'] = posts['userAgent'].astype(str).str.contains('drakma', case=False).fillna(False)
+    return posts
 
-    posts = users.set_index('_id')[['username', 'displayName']].merge(posts, left_index=True, right_on='userId',
-                                                                      how='right')  # add username to posts cols
 
+def add_post_num_distinct_commenters(posts, colls_dfs, aggregates, date):
+    # counted from the comments rather than the posts' commenters lists, which come back as strings from csv snapshots
+    posts = merge_stats(posts, get_named_aggregate(aggregates, 'commenters_by_post', colls_dfs))
+    posts['num_distinct_commenters'] = posts['num_distinct_commenters'].fillna(0).astype(int)
     return posts
 
 
-def enrich_comments(colls_dfs):  # dict(df) -> df
-    """Add extra data to comments dataframe."""
+def add_post_gw(posts, colls_dfs, aggregates, date):
+    posts['gw'] = posts['userAgent'].astype(str).str.contains('drakma', case=False).fillna(False)
+    return posts
+
+
+def add_post_usernames(posts, colls_dfs, aggregates, date):
+    return get_named_aggregate(aggregates, 'usernames', colls_dfs).merge(
+        posts, left_index=True, right_on='userId', how='right')  # add username to posts cols
 
-    users = colls_dfs['users']
-    comments = colls_dfs['comments']
-    votes = colls_dfs['votes']
 
-    vote_stats = calculate_vote_stats_for_content(votes)
-    comments = comments.merge(vote_stats, left_on='_id', right_index=True, how='left')
+def add_comment_vote_stats(comments, colls_dfs, aggregates, date):
+    vote_stats = select_collection(get_named_aggregate(aggregates, 'votes_by_document', colls_dfs), 'Comments')
+    return comments.merge(vote_stats, left_on='_id', right_index=True, how='left')
 
+
+def add_comment_top_level(comments, colls_dfs, aggregates, date):
     comments['top_level'] = comments['parentCommentId'].isnull()
-    comments['gw'] = comments['userAgent'].astype(str).str.contains('drakma', case=False)
-    comments = users.set_index('_id')[['username', 'displayName']].merge(comments, left_index=True,
-                                                                         right_on='userId')  # add username to comments collection
+    return comments
+
 
+def add_comment_gw(comments, colls_dfs, aggregates, date):
+    comments['gw'] = comments['userAgent'].astype(str).str.contains('drakma', case=False)
     return comments
 
 
-def enrich_users(colls_dfs, date_str):
-    """Takes in many dataframes and return one super-enriched users dataframe."""
+def add_comment_usernames(comments, colls_dfs, aggregates, date):
+    # inner merge: comments by users that aren't there are dropped
+    return get_named_aggregate(aggregates, 'usernames', colls_dfs).merge(
+        comments, left_index=True, right_on='userId')  # add username to comments collection
 
-    users = colls_dfs['users']
-    posts = colls_dfs['posts']
-    comments = colls_dfs['comments']
-    views = colls_dfs['views']
-    votes = colls_dfs['votes']
 
-    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+def add_user_post_stats(users, colls_dfs, aggregates, date):
+    return merge_stats(users, get_named_aggregate(aggregates, 'posts_by_user', colls_dfs))
+
+
+def add_user_comment_stats(users, colls_dfs, aggregates, date):
+    return merge_stats(users, get_named_aggregate(aggregates, 'comments_by_user', colls_dfs))
+
 
-    post_stats = calc_user_post_stats(posts)
-    comment_stats = calc_user_comment_stats(comments)
-    vote_stats = calculate_vote_stats_for_users(votes)
-    view_stats = calc_user_view_stats(views)
-    recent_activity = calc_user_recent_activity(posts, comments, votes, views, date)
+def add_user_vote_stats(users, colls_dfs, aggregates, date):
+    return merge_stats(users, get_named_aggregate(aggregates, 'votes_by_user', colls_dfs))
 
-    users = (users
-             .merge(post_stats, left_on='_id', right_index=True, how='left')
-             .merge(comment_stats, left_on='_id', right_index=True, how='left')
-             .merge(vote_stats, left_on='_id', right_index=True, how='left')
-             .merge(view_stats, left_on='_id', right_index=True, how='left')
-             .merge(recent_activity, left_on='_id', right_index=True, how='left')
-             )
 
+def add_user_view_stats(users, colls_dfs, aggregates, date):
+    return merge_stats(users, get_named_aggregate(aggregates, 'views_by_user', colls_dfs))
+
+
+def add_user_recent_activity(users, colls_dfs, aggregates, date):
+    # recent view and vote counts are taken from colls_dfs['user_recent_view_stats'] (see get_view_stats_pushdown)
+    # and colls_dfs['user_recent_vote_stats'] (see enrich_collections_incremental) when present
+    vote_activity = colls_dfs.get('user_recent_vote_stats')
+    recent_votes = colls_dfs['votes'] if vote_activity is None else None
+    if 'user_view_stats' in colls_dfs:
+        recent_activity = calc_user_recent_activity(colls_dfs['posts'], colls_dfs['comments'], recent_votes, None,
+                                                    date, view_activity=colls_dfs['user_recent_view_stats'],
+                                                    vote_activity=vote_activity)
+    else:
+        recent_activity = calc_user_recent_activity(colls_dfs['posts'], colls_dfs['comments'], recent_votes,
+                                                    colls_dfs['views'], date, vote_activity=vote_activity)
+    return merge_stats(users, recent_activity)
+
+
+def add_user_earliest_activity(users, colls_dfs, aggregates, date):
     users['earliest_activity'] = users[['earliest_post', 'earliest_comment', 'earliest_vote', 'earliest_view']].min(
         axis=1)
+    return users
+
+
+def add_user_true_earliest(users, colls_dfs, aggregates, date):
     users['true_earliest'] = users[['earliest_activity', 'createdAt']].min(axis=1)
+    return users
+
+
+def add_user_most_recent_activity(users, colls_dfs, aggregates, date):
     users['most_recent_activity'] = users[
         ['most_recent_post', 'most_recent_comment', 'most_recent_vote', 'most_recent_view', 'createdAt']].max(axis=1)
-    users['days_since_active'] = (date - users['most_recent_activity']).dt.days
+    return users
 
+
+def add_user_days_since_active(users, colls_dfs, aggregates, date):
+    users['days_since_active'] = (date - users['most_recent_activity']).dt.days
     return users
 
 
+VOTE_STAT_COLUMNS = VOTE_TYPES + ['num_votes', 'percent_downvotes', 'percent_bigvotes']
+
+# collection -> {step name: (columns it adds, steps it reads, aggregates it reads (see AGGREGATES), function)}, in
+# the order they're applied
+ENRICHMENT_STEPS = {
+    'users': {
+        'post_stats': (['total_posts', 'earliest_post', 'most_recent_post', 'num_drafts', 'percent_drafts',
+                        'num_frontpage_posts'], [], ['posts_by_user'], add_user_post_stats),
+        'comment_stats': (['total_comments', 'earliest_comment', 'most_recent_comment'], [], ['comments_by_user'],
+                          add_user_comment_stats),
+        'vote_stats': (['most_recent_vote', 'earliest_vote'] + VOTE_STAT_COLUMNS, [], ['votes_by_user'],
+                       add_user_vote_stats),
+        'view_stats': (['num_views', 'most_recent_view', 'earliest_view', 'num_distinct_posts_viewed',
+                        'num_days_present_last_30_days'], [], ['views_by_user'], add_user_view_stats),
+        'recent_activity': ([name.format(n) for n in sorted(ACTIVITY_WINDOWS) for name in [
+            'num_posts_last_{}_days', 'num_comments_last_{}_days', 'num_votes_last_{}_days', 'num_views_last_{}_days',
+            'num_distinct_posts_viewed_last_{}_days']], [], [], add_user_recent_activity),
+        'earliest_activity': (['earliest_activity'], ['post_stats', 'comment_stats', 'vote_stats', 'view_stats'], [],
+                              add_user_earliest_activity),
+        'true_earliest': (['true_earliest'], ['earliest_activity'], [], add_user_true_earliest),
+        'most_recent_activity': (['most_recent_activity'], ['post_stats', 'comment_stats', 'vote_stats',
+                                                            'view_stats'], [], add_user_most_recent_activity),
+        'days_since_active': (['days_since_active'], ['most_recent_activity'], [], add_user_days_since_active),
+    },
+    'posts': {
+        'comment_stats': (['num_comments_rederived', 'most_recent_comment'], [], ['comments_by_post'],
+                          add_post_comment_stats),
+        'vote_stats': (VOTE_STAT_COLUMNS + ['most_recent_vote'], [], ['votes_by_document'], add_post_vote_stats),
+        'view_stats': (['most_recent_view_logged', 'viewCountLogged', 'num_distinct_viewers'], [], ['views_by_post'],
+                       add_post_view_stats),
+        'most_recent_activity': (['most_recent_activity'], ['comment_stats', 'vote_stats', 'view_stats'], [],
+                                 add_post_most_recent_activity),
+        'frontpaged': (['frontpaged'], [], [], add_post_flags),
+        'num_distinct_commenters': (['num_distinct_commenters'], [], ['commenters_by_post'],
+                                    add_post_num_distinct_commenters),
+        'gw': (['gw'], [], [], add_post_gw),
+        'usernames': (['username', 'displayName'], [], ['usernames'], add_post_usernames),
+    },
+    'comments': {
+        'vote_stats': (VOTE_STAT_COLUMNS + ['most_recent_vote'], [], ['votes_by_document'], add_comment_vote_stats),
+        'top_level': (['top_level'], [], [], add_comment_top_level),
+        'gw': (['gw'], [], [], add_comment_gw),
+        'usernames': (['username', 'displayName'], [], ['usernames'], add_comment_usernames),
+    },
+}
+
+# steps that change which rows a collection has, so are always applied: the rows don't depend on the columns asked for
+ROW_FILTERING_STEPS = {'comments': ['usernames']}
+
+
+def get_enrichment_steps(coll_name, columns=None):
+    """
+    Returns the names of the enrichment steps of coll_name needed for columns (all if None), in the order they're
+    applied: those adding any of columns, those they read, and so on, plus the ROW_FILTERING_STEPS.
+    """
+
+    steps = ENRICHMENT_STEPS.get(coll_name, {})
+    if columns is None:
+        return list(steps)
+
+    needed = {name for name, (added, _, _, _) in steps.items() if set(added) & set(columns)}
+    needed |= set(ROW_FILTERING_STEPS.get(coll_name, []))
+    for name in reversed(list(steps)):  # a step only reads steps before it
+        if name in needed:
+            needed |= set(steps[name][1])
+
+    return [name for name in steps if name in needed]
+
+
+def get_enriched_columns():
+    """Returns all the columns enrichment adds (see ENRICHMENT_STEPS), by collection."""
+    return {coll_name: [col for added, _, _, _ in steps.values() for col in added]
+            for coll_name, steps in ENRICHMENT_STEPS.items()}
+
+
+def combine_columns(*sink_columns):
+    """Combines the columns (collection -> column names) several sinks read into the columns all of them read."""
+
+    combined = {}
+    for columns in sink_columns:
+        for coll_name, names in columns.items():
+            combined[coll_name] = sorted(set(combined.get(coll_name, [])) | set(names))
+
+    return combined
+
+
+def enrich_collection(coll_name, colls_dfs, date=None, aggregates=None, columns=None, timings=None):
+    """
+    Enriches colls_dfs[coll_name] with the steps needed for columns (see get_enrichment_steps), sharing aggregates
+    with the other steps, and adds the seconds each took to timings under '<collection>.<step>'.
+    """
+    if aggregates is None:
+        aggregates = {}
+    add_pushed_down_aggregates(aggregates, colls_dfs)
+
+    df = colls_dfs[coll_name]
+    for name in get_enrichment_steps(coll_name, columns):
+        start = time.time()
+        df = ENRICHMENT_STEPS[coll_name][name][3](df, colls_dfs, aggregates, date)
+        if timings is not None:
+            timings['{}.{}'.format(coll_name, name)] = time.time() - start
+
+    return df
+
+
+def log_enrichment_timings(timings):
+    num_steps = sum(len(steps) for steps in ENRICHMENT_STEPS.values())
+    print_and_log('Enrichment: {} of {} steps needed'.format(len(timings), num_steps))
+    for name, seconds in timings.items():
+        print_and_log('Enrichment step {}: {:.2f}s'.format(name, seconds))
+
+
+def enrich_posts(colls_dfs, aggregates=None, columns=None, timings=None):
+    """
+    Add extra data to posts dataframe. View statistics are taken from colls_dfs['post_view_stats'] when there (see
+    get_view_stats_pushdown).
+    """
+    return enrich_collection('posts', colls_dfs, aggregates=aggregates, columns=columns, timings=timings)
+
+
+def enrich_comments(colls_dfs, aggregates=None, columns=None, timings=None):  # dict(df) -> df
+    """Add extra data to comments dataframe."""
+    return enrich_collection('comments', colls_dfs, aggregates=aggregates, columns=columns, timings=timings)
+
+
+def enrich_users(colls_dfs, date_str, aggregates=None, columns=None, timings=None):
+    """
+    Takes in many dataframes and return one super-enriched users dataframe. View statistics are taken from
+    colls_dfs['user_view_stats'] and ['user_recent_view_stats'], and recent vote counts from
+    ['user_recent_vote_stats'], when there.
+    """
+    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    return enrich_collection('users', colls_dfs, date, aggregates=aggregates, columns=columns, timings=timings)
+
+
+def get_partitions(keys, num_partitions):
+    """Returns the partition (0 to num_partitions - 1) of each of a series of keys: by id code if ids are interned,
+    otherwise by hash."""
+    if pd.api.types.is_categorical_dtype(keys):
+        return keys.cat.codes.values % num_partitions
+    return pd.util.hash_pandas_object(keys, index=False).values % num_partitions
+
+
+def encode_ids(df):
+    """Returns df with its index as columns and interned id columns as their codes, so it pickles without the id
+    dictionary (see decode_ids)."""
+    df = df.reset_index()
+    return df.assign(**{col: df[col].cat.codes for col in df.columns
+                        if col in ID_COLUMN_NAMES and pd.api.types.is_categorical_dtype(df[col])})
+
+
+def decode_ids(df, index_names, id_dtype=None):
+    """Undoes encode_ids: id codes become categoricals of id_dtype and the first columns the index again."""
+    if id_dtype is not None:
+        for col in df.columns:
+            if col in ID_COLUMN_NAMES and pd.api.types.is_integer_dtype(df[col]):
+                df[col] = pd.Categorical.from_codes(df[col], dtype=id_dtype)
+    df = df.set_index(list(df.columns[:len(index_names)]))
+    df.index.names = index_names
+    return df
+
+
+SHARED_MEMORY_DIRECTORY = '/dev/shm'  # files here are kept in memory, so mapping them maps shared memory
+shared_id_dtypes = {}  # directory -> id dtype, so a worker process reads the id dictionary once
+
+
+def share_collections(colls_dfs, coll_columns, directory):
+    """
+    Writes columns of collections (collection -> column names) to arrow files in directory, with the id dictionary,
+    for worker processes to memory-map (see read_shared_collection).
+    """
+
+    for coll_name, columns in coll_columns.items():
+        df = colls_dfs[coll_name][columns]
+        df = df.assign(**{col: df[col].cat.codes for col in columns
+                          if col in ID_COLUMN_NAMES and pd.api.types.is_categorical_dtype(df[col])})
+        write_arrow_file(prepare_for_parquet(df), '{}/{}.arrow'.format(directory, coll_name))
+
+    id_dtype = get_id_dtype(colls_dfs)
+    if id_dtype is not None:
+        write_arrow_file(pa.Table.from_pandas(pd.DataFrame({'id': id_dtype.categories}), preserve_index=False),
+                         directory + '/ids.arrow')
+
+
+def read_shared_collection(directory, coll_name):
+    if directory not in shared_id_dtypes:
+        path = directory + '/ids.arrow'
+        shared_id_dtypes[directory] = (pd.api.types.CategoricalDtype(read_arrow_mapped(path)['id'])
+                                       if os.path.exists(path) else None)
+    return restore_dtypes(read_arrow_mapped('{}/{}.arrow'.format(directory, coll_name)), coll_name,
+                          shared_id_dtypes[directory])
+
+
+def compute_shared_aggregate(name, directory, partition=0, num_partitions=1):
+    """
+    Computes, in a worker process, the aggregate called name of one partition of a collection shared in directory.
+    Returns it encoded for pickling back (see encode_ids), or None if the partition is empty, and the seconds it took.
+    """
+
+    start = time.time()
+    func, coll_name, _, key = AGGREGATES[name]
+    df = read_shared_collection(directory, coll_name)
+    if num_partitions > 1:
+        df = df[get_partitions(df[key], num_partitions) == partition]
+    if df.shape[0] == 0:
+        return None, time.time() - start
+
+    result = func(df)
+    return (encode_ids(result), list(result.index.names)), time.time() - start
+
+
 @timed
-def enrich_collections(colls_dfs, date_str):  # dict[str:df] -> dict[str:df]
-    """Single function for collectively enriching all collection dataframes.
+def compute_aggregates_in_processes(colls_dfs, names, processes):
+    """
+    Computes the aggregates called names of colls_dfs in a pool of processes, a partition of the collection per
+    process where it can be partitioned (see get_partitions). Returns a dict of aggregates as get_aggregate keeps them.
+    """
+
+    coll_columns = {}
+    for name in names:
+        _, coll_name, columns, _ = AGGREGATES[name]
+        coll_columns[coll_name] = list(dict.fromkeys(coll_columns.get(coll_name, []) + columns))
+
+    directory = SHARED_MEMORY_DIRECTORY if os.path.isdir(SHARED_MEMORY_DIRECTORY) else None
+    with tempfile.TemporaryDirectory(prefix='enrichment-', dir=directory) as directory:
+        share_collections(colls_dfs, coll_columns, directory)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {}
+            for name in names:
+                num_partitions = processes if AGGREGATES[name][3] is not None else 1
+                futures[name] = [executor.submit(compute_shared_aggregate, name, directory, partition, num_partitions)
+                                 for partition in range(num_partitions)]
+            results = {name: [future.result() for future in name_futures] for name, name_futures in futures.items()}
+
+    id_dtype = get_id_dtype(colls_dfs)
+    aggregates = {}
+    for name, partials in results.items():
+        encoded = [partial for partial, _ in partials if partial is not None]
+        if encoded:
+            result = decode_ids(pd.concat([df for df, _ in encoded], ignore_index=True), encoded[0][1], id_dtype)
+        else:  # no rows at all
+            func, coll_name, _, _ = AGGREGATES[name]
+            result = func(colls_dfs[coll_name])
+        aggregates[name] = {'result': result, 'seconds': sum(seconds for _, seconds in partials), 'uses': 0}
+
+    return aggregates
+
+
+@timed
+def enrich_collections(colls_dfs, date_str, aggregates=None, columns=None,
+                       processes=1):  # dict[str:df] -> dict[str:df]
+    """
+    Single function for collectively enriching all collection dataframes.
 
     Input: dictionary of basic-parsed collection dataframes.
     Output: dictionary of enriched (fully processed) collection dataframe.
-
+    Given columns (collection -> column names, see combine_columns), only those are added (see get_enrichment_steps).
+    With processes > 1 the aggregates are computed in that many processes (see compute_aggregates_in_processes).
     """
 
+    # aggregates needed by more than one enrichment step are computed once and shared (see get_aggregate)
+    if aggregates is None:
+        aggregates = {}
+    add_pushed_down_aggregates(aggregates, colls_dfs)
+
+    def coll_columns(coll_name):
+        return None if columns is None else columns.get(coll_name, [])
+
+    if processes > 1:
+        names = [name for name in AGGREGATES if name not in aggregates and any(
+            name in ENRICHMENT_STEPS[coll_name][step][2]
+            for coll_name in ENRICHMENT_STEPS for step in get_enrichment_steps(coll_name, coll_columns(coll_name)))]
+        aggregates.update(compute_aggregates_in_processes(colls_dfs, names, processes))
+
+    timings = {}
     enriched_dfs = {
-        'users': enrich_users(colls_dfs, date_str=date_str),
-        'posts': enrich_posts(colls_dfs),
-        'comments': enrich_comments(colls_dfs),
-        'votes': colls_dfs['votes'],
-        'views': colls_dfs['views']
+        'users': enrich_users(colls_dfs, date_str=date_str, aggregates=aggregates, columns=coll_columns('users'),
+                              timings=timings),
+        'posts': enrich_posts(colls_dfs, aggregates=aggregates, columns=coll_columns('posts'), timings=timings),
+        'comments': enrich_comments(colls_dfs, aggregates=aggregates, columns=coll_columns('comments'),
+                                    timings=timings),
+    }
+    # raw views are left out when view statistics were pushed down to MongoDB, and raw votes and views when they're
+    # streamed from disk (see enrich_collections_out_of_core)
+    for coll_name in ['votes', 'views']:
+        if coll_name in colls_dfs:
+            enriched_dfs[coll_name] = colls_dfs[coll_name]
+    log_enrichment_timings(timings)
+    log_aggregate_usage(aggregates)
+
+    return enriched_dfs
+
+
+# aggregate states kept between incremental enrichment runs (see fold_aggregate_state): name -> (collection, time
+# column, group keys, {column: (source column, reduction)}), plus n and checksum columns (see aggregate_events). The
+# first key is the entity a state is repaired by; 'midnight' counts events at exactly midnight
+AGGREGATE_STATES = {
+    'votes_by_document_type': ('votes', 'votedAt', ['documentId', 'collectionName', 'voteType'],
+                               {'last': ('votedAt', 'max')}),
+    'votes_by_user_type': ('votes', 'votedAt', ['userId', 'voteType'],
+                           {'first': ('votedAt', 'min'), 'last': ('votedAt', 'max')}),
+    'votes_by_user_day': ('votes', 'votedAt', ['userId', 'day'], {'midnight': ('midnight', 'sum')}),
+    'views_by_document': ('views', 'createdAt', ['documentId'], {'last': ('createdAt', 'max')}),
+    'views_by_user': ('views', 'createdAt', ['userId'], {'first': ('createdAt', 'min'), 'last': ('createdAt', 'max')}),
+    'views_by_user_document': ('views', 'createdAt', ['userId', 'documentId'], {'last': ('createdAt', 'max')}),
+    'views_by_user_day': ('views', 'createdAt', ['userId', 'day'],
+                          {'midnight': ('midnight', 'sum'), 'last': ('createdAt', 'max')})
+}
+FOLD_REDUCTIONS = {'size': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}  # to combine two aggregates of a state
+# day buckets are kept for the longest activity window and the 30 day presence count, older ones expire
+AGGREGATE_HORIZON_DAYS = max(max(ACTIVITY_WINDOWS), 30)
+
+
+def get_aggregate_state_path(name):
+    return get_incremental_path('aggregate_{}.pkl'.format(name))
+
+
+def load_aggregate_states(colls_dfs):
+    """
+    Loads the aggregate states saved by the last incremental enrichment, with their keys cast back to the dtypes of
+    colls_dfs, and the watermark each collection's states are up to. Returns a dict of states and one of watermarks.
+    """
+
+    path = get_incremental_path('aggregate_watermarks.json')
+    if not os.path.exists(path):
+        return {}, {}
+    with open(path) as f:
+        metadata = json.load(f)
+
+    states = {}
+    for name, (coll_name, _, keys, _) in AGGREGATE_STATES.items():
+        if coll_name not in colls_dfs or not os.path.exists(get_aggregate_state_path(name)):
+            continue
+        if 'day' in keys and metadata['horizon_days'] < AGGREGATE_HORIZON_DAYS:
+            continue  # buckets the longer windows need have expired
+        state = pd.read_pickle(get_aggregate_state_path(name))
+        for key in keys:
+            if key != 'day':
+                state[key] = state[key].astype(colls_dfs[coll_name][key].dtype)
+        states[name] = state.set_index(keys)
+
+    return states, {coll_name: pd.Timestamp(ts) for coll_name, ts in metadata['watermarks'].items()}
+
+
+def save_aggregate_states(states, watermarks):
+    # saved with plain keys, since the categories of interned ids change from run to run
+    for name, state in states.items():
+        path = get_aggregate_state_path(name)
+        decode_dtypes(state.reset_index()).to_pickle(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    with open(get_incremental_path('aggregate_watermarks.json'), 'w') as f:
+        json.dump({'horizon_days': AGGREGATE_HORIZON_DAYS,
+                   'watermarks': {coll_name: ts.isoformat() for coll_name, ts in watermarks.items()}}, f, indent=2)
+
+
+def checksum_events(events):
+    """Returns a 24 bit hash of each event (row). Summed, they tell whether a group of events changed."""
+    return (pd.util.hash_pandas_object(events, index=False).values >> np.uint64(40)).astype('int64')
+
+
+def get_entity_codes(state_entities, event_entities):
+    """Returns integer codes for the entities of a state (an index) and of events (a series) that agree."""
+
+    if pd.api.types.is_categorical_dtype(event_entities):  # interned ids, with the same categories
+        return state_entities.codes, event_entities.cat.codes.values
+
+    codes, _ = pd.factorize(np.concatenate([state_entities.values, event_entities.values]))
+    return codes[:len(state_entities)], codes[len(state_entities):]
+
+
+def aggregate_events(events, name):
+    """
+    Aggregates events of the collection of an aggregate state to its keys and columns (see AGGREGATE_STATES), plus
+    the number of events n and their checksum (see checksum_events).
+    """
+
+    _, time_col, keys, columns = AGGREGATE_STATES[name]
+    events = events.assign(checksum=checksum_events(events))
+    if 'day' in keys:
+        day = events[time_col].dt.floor('D')
+        events = events.assign(day=day, midnight=(events[time_col] == day).astype(int))
+
+    return events.groupby(keys, observed=True).agg(n=(time_col, 'size'), checksum=('checksum', 'sum'), **columns)
+
+
+def fold_aggregate_state(name, state, events, watermark, horizon_start=None):
+    """
+    Brings an aggregate state holding events up to watermark up to date with events, the whole current collection:
+    later events are folded in, and entities whose earlier events no longer match the state's count and checksum (see
+    checksum_events) are aggregated again. Day buckets before horizon_start expire. Returns the new state.
+    """
+
+    _, time_col, keys, columns = AGGREGATE_STATES[name]
+    event_keys = [key for key in keys if key != 'day']
+    cols = event_keys + sorted(set([time_col] + [source for source, _ in columns.values() if source in events]))
+    entity = keys[0]
+
+    times = events[time_col]
+    has_keys = events[event_keys].notnull().all(axis=1)  # as groupbys drop null keys
+    if horizon_start is not None:
+        has_keys &= times >= horizon_start
+        if state is not None:
+            state = state[state.index.get_level_values('day') >= horizon_start]
+
+    if state is None or pd.isnull(watermark):  # NaT when the last run had no events
+        return aggregate_events(events.loc[has_keys & times.notnull(), cols], name)
+
+    # number of events and checksum per entity, in the state and in the events, summed over the entity codes
+    folded = events.loc[has_keys & (times <= watermark), cols]
+    state_codes, event_codes = get_entity_codes(state.index.get_level_values(entity), folded[entity])
+    size = max(state_codes.max(initial=-1), event_codes.max(initial=-1)) + 1
+    changed = ((np.bincount(state_codes, weights=state['n'], minlength=size) !=
+                np.bincount(event_codes, minlength=size)) |
+               (np.bincount(state_codes, weights=state['checksum'], minlength=size) !=
+                np.bincount(event_codes, weights=checksum_events(folded), minlength=size)))
+    if changed.any():
+        print_and_log('{}: aggregating {} {} values again, their events before the watermark changed.'.format(
+            name, changed.sum(), entity))
+        state = pd.concat([state[~changed[state_codes]], aggregate_events(folded[changed[event_codes]], name)])
+
+    new = has_keys & (times > watermark)
+    if not new.any():
+        return state
+    return combine_aggregates(name, [state, aggregate_events(events.loc[new, cols], name)])
+
+
+def combine_aggregates(name, aggregates):
+    """Combines aggregates of an aggregate state over disjoint sets of events (see aggregate_events) into the
+    aggregate of all of them: counts are added up, first and last times take the min and max."""
+
+    _, _, keys, columns = AGGREGATE_STATES[name]
+    reductions = {col: FOLD_REDUCTIONS[how] for col, (_, how) in columns.items()}
+    reductions.update(n='sum', checksum='sum')
+    return pd.concat(aggregates).groupby(level=keys, observed=True).agg(reductions)
+
+
+@timed
+def update_aggregate_states(colls_dfs, date):
+    """
+    Folds the events of colls_dfs since the last incremental enrichment into the saved aggregate states (see
+    fold_aggregate_state), saves them and returns them with the watermark of each collection.
+    """
+
+    states, watermarks = load_aggregate_states(colls_dfs)
+    horizon_start = date - pd.Timedelta(AGGREGATE_HORIZON_DAYS, unit='d')
+
+    for name, (coll_name, time_col, keys, _) in AGGREGATE_STATES.items():
+        if coll_name in colls_dfs:
+            states[name] = fold_aggregate_state(name, states.get(name), colls_dfs[coll_name],
+                                                watermarks.get(coll_name),
+                                                horizon_start=horizon_start if 'day' in keys else None)
+    for coll_name, time_col, _, _ in AGGREGATE_STATES.values():
+        if coll_name in colls_dfs:
+            watermarks[coll_name] = colls_dfs[coll_name][time_col].max()
+
+    save_aggregate_states(states, watermarks)
+
+    return states, watermarks
+
+
+def count_in_day_buckets(day_state, date, windows):
+    """
+    As count_in_windows, from an aggregate state counted per key and day. date must be a midnight; events exactly at a
+    window's start aren't in it.
+    """
+
+    keys = day_state.index.get_level_values(0)
+    days = day_state.index.get_level_values('day')
+    starts = {n: date - pd.Timedelta(n, unit='d') for n in windows}
+    counts = pd.DataFrame({n: np.where(days >= start, day_state['n'], 0) - np.where(days == start,
+                                                                                  day_state['midnight'], 0)
+                           for n, start in starts.items()}).groupby(keys, observed=True).sum()
+
+    return counts[counts[max(windows)] > 0]
+
+
+def derive_vote_stats(states, date, windows=ACTIVITY_WINDOWS):
+    """
+    Derives the vote statistics of enrichment from the vote aggregate states: 'votes_by_document', 'votes_by_user' and
+    'user_recent_vote_stats', the vote columns of calc_user_recent_activity.
+    """
+
+    windows = sorted(windows)
+
+    by_document = states['votes_by_document_type']
+    document_dates = by_document['last'].groupby(level=['collectionName', 'documentId'], observed=True).max()
+    document_stats = finish_vote_stats(
+        by_document['n'].unstack(level='voteType', fill_value=0).reorder_levels(['collectionName', 'documentId']),
+        document_dates.to_frame('max'))
+
+    by_user = states['votes_by_user_type'].groupby(level='userId', observed=True)
+    user_stats = put_vote_dates_first(finish_vote_stats(
+        states['votes_by_user_type']['n'].unstack(level='voteType', fill_value=0),
+        pd.DataFrame({'max': by_user['last'].max(), 'min': by_user['first'].min()})))
+
+    recent_votes = count_in_day_buckets(states['votes_by_user_day'], date, windows)
+    recent_votes.columns = ['num_votes_last_{}_days'.format(n) for n in windows]
+
+    return {'votes_by_document': document_stats, 'votes_by_user': user_stats, 'user_recent_vote_stats': recent_votes}
+
+
+def derive_view_stats(states, date, latest_view, windows=ACTIVITY_WINDOWS):
+    """
+    Derives the view statistics of enrichment from the view aggregate states, as get_view_stats_pushdown returns them.
+    """
+
+    windows = sorted(windows)
+    by_document, by_user = states['views_by_document'], states['views_by_user']
+    pairs, by_user_day = states['views_by_user_document'], states['views_by_user_day']
+
+    post_view_stats = pd.DataFrame({
+        'most_recent_view_logged': by_document['last'],
+        'viewCountLogged': by_document['n'],
+        'num_distinct_viewers': pairs.groupby(level='documentId', observed=True).size().reindex(
+            by_document.index, fill_value=0)
+    })
+
+    # a day is in the 30 days before the latest view if its latest view is
+    cutoff = latest_view - pd.Timedelta(30 - 1, unit='d')
+    days = by_user_day.index.get_level_values('day')
+    present = (days > cutoff.floor('D')) | ((days == cutoff.floor('D')) & (by_user_day['last'] >= cutoff))
+    user_view_stats = pd.DataFrame({
+        'num_views': by_user['n'],
+        'most_recent_view': by_user['last'],
+        'earliest_view': by_user['first'],
+        'num_distinct_posts_viewed': pairs.groupby(level='userId', observed=True).size().reindex(
+            by_user.index, fill_value=0)
+    }).merge(by_user_day[present].groupby(level='userId', observed=True).size().to_frame(
+        'num_days_present_last_30_days'), left_index=True, right_index=True, how='outer')
+
+    recent_views = count_in_day_buckets(by_user_day, date, windows)
+    recent_views.columns = ['num_views_last_{}_days'.format(n) for n in windows]
+    recent_posts_viewed = count_in_windows(pd.Series(pairs.index.get_level_values('userId'), name='userId'),
+                                           pairs['last'], date, windows)
+    recent_posts_viewed.columns = ['num_distinct_posts_viewed_last_{}_days'.format(n) for n in windows]
+
+    return {
+        'post_view_stats': post_view_stats,
+        'user_view_stats': user_view_stats,
+        'user_recent_view_stats': recent_views.merge(recent_posts_viewed, left_index=True, right_index=True,
+                                                     how='outer').fillna(0).astype(int)
+    }
+
+
+@timed
+def get_view_stats_sketched(views, date_str, precision, windows=ACTIVITY_WINDOWS):
+    """
+    Computes the view statistics of enrichment from views, as get_view_stats_pushdown returns them, but with distinct
+    counts estimated from sketches of each post's viewers and each user's posts viewed per day, merged over each
+    window. Returns the sketches too (see VIEW_SKETCHES).
+    """
+
+    windows = sorted(windows)
+    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    days = views['createdAt'].dt.floor('D').rename('day')
+    max_bytes = SKETCH_BUDGET_MB * 2 ** 20
+    post_sketches = build_sketches(pd.concat([views['documentId'], days], axis=1), views['userId'], precision,
+                                   max_bytes)
+    user_sketches = build_sketches(pd.concat([views['userId'], days], axis=1), views['documentId'], precision,
+                                   max_bytes)
+    for name, sketches in zip(VIEW_SKETCHES, [post_sketches, user_sketches]):
+        print_and_log('{}: {} sketches of {} registers'.format(name, sketches.shape[0],
+                                                               get_registers(sketches).shape[1]))
+
+    def estimate(sketches, key, index, in_window=None):
+        if in_window is not None:
+            sketches = sketches[in_window]
+        return estimate_distinct(merge_sketches(sketches, sketches[key]), key).reindex(index, fill_value=0)
+
+    by_post = views.groupby('documentId', observed=True)['createdAt']
+    post_view_stats = pd.DataFrame({'most_recent_view_logged': by_post.max(), 'viewCountLogged': by_post.size()})
+    post_view_stats['num_distinct_viewers'] = estimate(post_sketches, 'documentId', post_view_stats.index)
+
+    user_view_stats = views.groupby('userId', observed=True)['createdAt'].agg(
+        {'num_views': 'count', 'most_recent_view': 'max', 'earliest_view': 'min'})
+    user_view_stats['num_distinct_posts_viewed'] = estimate(user_sketches, 'userId', user_view_stats.index)
+    recent = views['createdAt'] >= views['createdAt'].max() - pd.Timedelta(30 - 1, unit='d')
+    user_view_stats = user_view_stats.merge(
+        days[recent].groupby(views['userId'][recent], observed=True).nunique().to_frame(
+            'num_days_present_last_30_days'), left_index=True, right_index=True, how='outer')
+
+    # a day is in a window if any of it is
+    recent_views = count_in_windows(views['userId'], views['createdAt'], date, windows)
+    recent_views.columns = ['num_views_last_{}_days'.format(n) for n in windows]
+    for n in windows:
+        recent_views['num_distinct_posts_viewed_last_{}_days'.format(n)] = estimate(
+            user_sketches, 'userId', recent_views.index, user_sketches['day'] >= date - pd.Timedelta(n, unit='d'))
+
+    return {
+        'post_view_stats': post_view_stats,
+        'user_view_stats': user_view_stats,
+        'user_recent_view_stats': recent_views,
+        'post_viewer_sketches': post_sketches,
+        'user_post_sketches': user_sketches
     }
 
+
+def diff_enriched(enriched_dfs, expected_dfs, max_examples=3):
+    """
+    Compares two dicts of enriched users, posts and comments value by value, matching rows on _id. Returns a row per
+    column that differs: how many rows do and a few of their _ids.
+    """
+
+    report = []
+    for coll_name in ['users', 'posts', 'comments']:
+        enriched = decode_dtypes(enriched_dfs[coll_name]).set_index('_id')
+        expected = decode_dtypes(expected_dfs[coll_name]).set_index('_id')
+        ids = expected.index.union(enriched.index)
+        for col in expected.columns.union(enriched.columns):
+            if col not in enriched.columns or col not in expected.columns:
+                report.append((coll_name, col, len(ids), 'missing from one side'))
+                continue
+            left, right = enriched[col].reindex(ids), expected[col].reindex(ids)
+            same = (left == right) | (left.isnull() & right.isnull())
+            if pd.api.types.is_numeric_dtype(left) and pd.api.types.is_numeric_dtype(right):
+                same |= np.isclose(left.astype(float), right.astype(float))
+            if not same.all():
+                report.append((coll_name, col, (~same).sum(), ', '.join(map(str, ids[~same][:max_examples]))))
+
+    return pd.DataFrame(report, columns=['collection', 'column', 'num_different', 'examples'])
+
+
+def enrich_from_aggregate_states(colls_dfs, date_str, states, latest, columns=None):
+    """
+    Enriches colls_dfs as enrich_collections does, with the vote and view statistics derived from their aggregate
+    states (see derive_vote_stats and derive_view_stats) rather than from votes and views.
+    """
+
+    def has_states(coll_name):
+        return all(name in states for name, (coll, _, _, _) in AGGREGATE_STATES.items() if coll == coll_name)
+
+    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    derived_dfs = dict(colls_dfs)
+    aggregates = {}
+    if has_states('votes'):
+        start = time.time()
+        vote_stats = derive_vote_stats(states, date)
+        derived_dfs['user_recent_vote_stats'] = vote_stats.pop('user_recent_vote_stats')
+        aggregates = {name: {'result': result, 'seconds': time.time() - start, 'uses': 0}
+                      for name, result in vote_stats.items()}
+    if has_states('views'):
+        derived_dfs.update(derive_view_stats(states, date, latest['views']))
+
+    return enrich_collections(derived_dfs, date_str, aggregates=aggregates, columns=columns)
+
+
+def log_enrichment_differences(enriched_dfs, expected_dfs, name):
+    """Logs the differences between enriched_dfs and expected_dfs, enriched in memory from scratch (see
+    diff_enriched). name is the kind of enrichment of enriched_dfs, e.g. 'Incremental'."""
+
+    report = diff_enriched(enriched_dfs, expected_dfs)
+    if report.shape[0] == 0:
+        print_and_log('{} enrichment matches enrichment from scratch.'.format(name))
+    else:
+        print_and_log('{} enrichment differs from enrichment from scratch:\n{}'.format(
+            name, report.to_string(index=False)))
+
+
+@timed
+def enrich_collections_incremental(colls_dfs, date_str, verify=False, columns=None):
+    """
+    As enrich_collections, with the vote and view statistics derived from aggregate states kept between runs that
+    only new events are folded into (see update_aggregate_states). colls_dfs must hold the whole collections. With
+    verify, the differences from enrich_collections are logged.
+    """
+
+    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    states, watermarks = update_aggregate_states(colls_dfs, date)
+
+    enriched_dfs = enrich_from_aggregate_states(colls_dfs, date_str, states, watermarks, columns=columns)
+
+    if verify:
+        log_enrichment_differences(enriched_dfs, enrich_collections(colls_dfs, date_str, columns=columns),
+                                   'Incremental')
+
     return enriched_dfs
 
 
+def iter_collection_chunks(path, coll_name, columns=None, id_dtype=None,
+                           memory_budget_mb=ENRICHMENT_MEMORY_BUDGET_MB):
+    """
+    Reads a collection from a snapshot's parquet file in chunks of row groups taking at most a quarter of
+    memory_budget_mb each. Yields dataframes with the dtypes load_from_file gives, ids as categoricals of id_dtype.
+    """
+
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    chunk_budget = memory_budget_mb * 2 ** 20 / 4
+
+    def row_group_bytes(i):
+        row_group = metadata.row_group(i)
+        return sum(row_group.column(j).total_uncompressed_size for j in range(row_group.num_columns)
+                   if columns is None or row_group.column(j).path_in_schema in columns)
+
+    def read_chunk(row_groups):
+        if row_groups:
+            table = parquet_file.read_row_groups(row_groups, columns=columns, use_pandas_metadata=True)
+        else:
+            table = parquet_file.schema.to_arrow_schema().empty_table()
+        df = table.to_pandas()
+        return restore_dtypes(df if columns is None else df[list(columns)], coll_name, id_dtype)
+
+    if metadata.num_row_groups == 0:
+        yield read_chunk([])
+        return
+
+    row_groups, chunk_bytes = [], 0
+    for i in range(metadata.num_row_groups):
+        if row_groups and chunk_bytes + row_group_bytes(i) > chunk_budget:
+            yield read_chunk(row_groups)
+            row_groups, chunk_bytes = [], 0
+        row_groups.append(i)
+        chunk_bytes += row_group_bytes(i)
+    yield read_chunk(row_groups)
+
+
+def get_state_columns(coll_name):
+    """Returns the columns of coll_name its aggregate states are computed from (see AGGREGATE_STATES)."""
+    return sorted({col for coll, time_col, keys, columns in AGGREGATE_STATES.values() if coll == coll_name
+                   for col in [time_col] + keys + [source for source, _ in columns.values()]} -
+                  {'day', 'midnight'})
+
+
+def fold_chunk(states, chunk, coll_name, horizon_start=None):
+    """
+    Aggregates a chunk of a collection's events into each of its aggregate states in states, in place, leaving out day
+    buckets before horizon_start.
+    """
+
+    for name, (coll, _, keys, _) in AGGREGATE_STATES.items():
+        if coll == coll_name:
+            aggregate = fold_aggregate_state(name, None, chunk, None,
+                                             horizon_start=horizon_start if 'day' in keys else None)
+            states[name] = aggregate if name not in states else combine_aggregates(name, [states[name], aggregate])
+
+
 @timed
-def run_etlw_pipeline(date_str, clean_up=False, plotly=False, gsheets=False,
-                      metrics=False, postgres=False, limit=None):
+def aggregate_states_from_files(paths, date, id_dtype=None, memory_budget_mb=ENRICHMENT_MEMORY_BUDGET_MB):
+    """
+    Computes the aggregate states of collections in parquet files (collection -> path), streamed in chunks within
+    memory_budget_mb. Returns a dict of states and the time of the latest event of each collection.
+    """
+
+    horizon_start = date - pd.Timedelta(AGGREGATE_HORIZON_DAYS, unit='d')
+    states, latest = {}, {}
+
+    for coll_name, path in paths.items():
+        names = [name for name, (coll, _, _, _) in AGGREGATE_STATES.items() if coll == coll_name]
+        time_col = AGGREGATE_STATES[names[0]][1]
+        num_rows, num_chunks, chunk_latest = 0, 0, []
+        for chunk in iter_collection_chunks(path, coll_name, columns=get_state_columns(coll_name), id_dtype=id_dtype,
+                                            memory_budget_mb=memory_budget_mb):
+            fold_chunk(states, chunk, coll_name, horizon_start=horizon_start)
+            chunk_latest.append(chunk[time_col].max())
+            num_rows += chunk.shape[0]
+            num_chunks += 1
+            del chunk
+        latest[coll_name] = pd.Series(chunk_latest, dtype='datetime64[ns]').max()
+        print_and_log('Aggregated {} {} in {} chunks, process peak memory {:.0f} MB'.format(
+            num_rows, coll_name, num_chunks, get_peak_memory_mb()))
+
+    return states, latest
+
+
+@timed
+def enrich_collections_out_of_core(colls_dfs, date_str, memory_budget_mb=ENRICHMENT_MEMORY_BUDGET_MB, columns=None,
+                                   verify=False):
+    """
+    As enrich_collections, for votes and views too big to enrich in memory: they're read from the snapshot in
+    processed/<date_str> in chunks within memory_budget_mb, aggregated into states (see aggregate_states_from_files),
+    and their statistics derived from those. With verify, the differences from enrich_collections are logged.
+    """
+
+    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+    directory = get_snapshot_directory(date_str)
+    paths = {coll_name: '{}/{}.parquet'.format(directory, coll_name) for coll_name in OUT_OF_CORE_COLLECTIONS
+             if os.path.exists('{}/{}.parquet'.format(directory, coll_name))}
+    id_dictionary = load_id_dictionary(date_str)
+    id_dtype = pd.api.types.CategoricalDtype(id_dictionary) if len(id_dictionary) else None
+
+    states, latest = aggregate_states_from_files(paths, date, id_dtype=id_dtype, memory_budget_mb=memory_budget_mb)
+    enriched_dfs = enrich_from_aggregate_states(colls_dfs, date_str, states, latest, columns=columns)
+
+    if verify:
+        expected_dfs = enrich_collections(dict(colls_dfs, **load_from_file(date_str, coll_names=list(paths))),
+                                          date_str, columns=columns)
+        log_enrichment_differences(enriched_dfs, expected_dfs, 'Out-of-core')
+
+    return enriched_dfs
+
+
+def get_stream_schema(coll_name):
+    """
+    Returns the arrow schema an event collection is streamed to a snapshot with: its _id as a string and its schema's
+    columns, ids as int32 codes into the id dictionary and categories as strings.
+    """
+    types = {'id': pa.int32(), 'category': pa.string()}
+    return pa.schema([pa.field('_id', pa.string())] +
+                     [pa.field(col, types[dtype] if dtype in types else pa.from_numpy_dtype(np.dtype(dtype)))
+                      for col, dtype in COLLECTION_SCHEMAS[coll_name].items()])
+
+
+def get_stream_batch_size(memory_budget_mb):
+    """Returns the number of documents per chunk that keeps the chunks streamed at once (one per partition of views,
+    plus votes) within a quarter of memory_budget_mb, as raw documents, but no more than DOWNLOAD_BATCH_SIZE."""
+    in_flight = DOWNLOAD_PARTITIONS + 1
+    return int(np.clip(memory_budget_mb * 2 ** 20 / 4 / (RAW_DOCUMENT_BYTES * in_flight), 1, DOWNLOAD_BATCH_SIZE))
+
+
+@timed
+def stream_events_out_of_core(coll_names, directory, id_dictionary, limit=None, batch_size=DOWNLOAD_BATCH_SIZE,
+                              partitions=DOWNLOAD_PARTITIONS):
+    """
+    Downloads votes and views without holding them whole: each cleaned chunk is folded into the aggregate states and
+    appended to <coll_name>.parquet and .arrow in directory, ids as codes into id_dictionary, extended as they turn
+    up. Returns the states, keyed by plain values, the time of the latest event and the extended id dictionary.
+    """
+
+    db = get_mongo_db_object()
+    lock = threading.Lock()  # views arrive from several partitions at once, and votes alongside
+    states, latest = {}, {}
+
+    def stream(coll_name):
+        nonlocal id_dictionary
+        schema = get_stream_schema(coll_name)
+        id_cols = INTERNED_ID_COLUMNS[coll_name]
+        time_col = SNAPSHOT_SORT_COLUMNS[coll_name]
+        writers = [pq.ParquetWriter('{}/{}.parquet'.format(directory, coll_name), schema,
+                                    compression=SNAPSHOT_COMPRESSION)]
+        if coll_name in MAPPED_COLLECTIONS:
+            writers.append(pa.ipc.new_file('{}/{}.arrow'.format(directory, coll_name), schema))
+        chunk_latest = []
+
+        def sink(chunk):
+            nonlocal id_dictionary
+            chunk = decode_dtypes(chunk)  # each chunk has its own categories
+            with lock:
+                fold_chunk(states, chunk, coll_name)
+                chunk_latest.append(chunk[time_col].max())
+                id_dictionary = build_id_dictionary({coll_name: chunk}, id_dictionary)
+                codes = {col: id_dictionary.get_indexer(chunk[col]).astype('int32') for col in id_cols}
+                table = pa.Table.from_pandas(chunk.assign(**codes)[schema.names], schema=schema, preserve_index=False)
+                for writer in writers:
+                    writer.write_table(table)
+
+        try:
+            empty = get_collection_cleaned(coll_name, db, limit, batch_size=batch_size, partitions=partitions,
+                                           chunk_sink=sink)
+            # so the states are there even if nothing was downloaded
+            fold_chunk(states, decode_dtypes(empty), coll_name)
+        finally:
+            for writer in writers:
+                writer.close()
+        latest[coll_name] = pd.Series(chunk_latest, dtype='datetime64[ns]').max()
+
+    map_in_threads(stream, coll_names, num_threads=DOWNLOAD_THREADS)
+
+    return states, latest, id_dictionary
+
+
+def finish_streamed_states(states, id_dtype, horizon_start):
+    """Casts the plain keys of states streamed from the download (see stream_events_out_of_core) to their schema
+    dtypes, ids to the interned id_dtype, and drops the day buckets before horizon_start. Returns the states."""
+
+    finished = {}
+    for name, state in states.items():
+        coll_name, _, keys, _ = AGGREGATE_STATES[name]
+        if 'day' in keys:
+            state = state[state.index.get_level_values('day') >= horizon_start]
+        state = state.reset_index()
+        for key in keys:
+            if key != 'day':
+                dtype = COLLECTION_SCHEMAS[coll_name][key]
+                state[key] = state[key].astype(id_dtype if dtype == 'id' else dtype)
+        finished[name] = state.set_index(keys)
+
+    return finished
+
+
+@timed
+def download_and_enrich_out_of_core(limit=None, pushdown=False, verify=False, columns=None,
+                                    memory_budget_mb=ENRICHMENT_MEMORY_BUDGET_MB):
+    """
+    As download_and_enrich, for votes and views too big to hold in memory. They're streamed into their aggregate
+    states and snapshot files in chunks sized to memory_budget_mb (see stream_events_out_of_core), which are moved to
+    processed/<date> and returned memory-mapped. With verify, the differences from enrich_collections are logged.
+    """
+
+    event_names = [coll_name for coll_name in OUT_OF_CORE_COLLECTIONS if not (pushdown and coll_name == 'views')]
+    dfs_cleaned = get_collections_cleaned(coll_names=('comments', 'posts', 'users'), limit=limit, interned=False)
+
+    staging = tempfile.mkdtemp(dir=BASE_PATH, prefix='streaming-')
+    try:
+        states, latest, id_dictionary = stream_events_out_of_core(
+            event_names, staging, load_id_dictionary(), limit=limit,
+            batch_size=get_stream_batch_size(memory_budget_mb))
+        dfs_cleaned = intern_ids(dfs_cleaned, id_dictionary=id_dictionary)
+        id_dtype = get_id_dtype(dfs_cleaned)
+
+        if pushdown:
+            db = get_mongo_db_object()
+            latest['views'] = get_field_range('lwevents', db, 'createdAt', {'name': 'post-view'})[1]
+        today = latest['views'].strftime('%Y-%m-%d')  # treat max date in collections as "today"
+        if pushdown:
+            dfs_cleaned.update(get_view_stats_pushdown(db, date_str=today, latest_view=latest['views']))
+        date = datetime.datetime.strptime(today, '%Y-%m-%d')
+        states = finish_streamed_states(states, id_dtype, date - pd.Timedelta(AGGREGATE_HORIZON_DAYS, unit='d'))
+
+        directory = get_snapshot_directory(today)
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        for file_name in os.listdir(staging):
+            os.replace(staging + '/' + file_name, directory + '/' + file_name)
+        write_id_dictionary(id_dtype.categories, today)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    print_and_log('Streamed {} into aggregate states, process peak memory {:.0f} MB'.format(
+        ', '.join(event_names), get_peak_memory_mb()))
+
+    enriched_dfs = enrich_from_aggregate_states(dfs_cleaned, today, states, latest, columns=columns)
+    enriched_dfs.update(load_from_file(today, coll_names=event_names))
+
+    if verify:
+        expected_dfs = enrich_collections(dict(dfs_cleaned, **load_from_file(today, coll_names=event_names)),
+                                          today, columns=columns)
+        log_enrichment_differences(enriched_dfs, expected_dfs, 'Out-of-core')
+
+    return today, enriched_dfs
+
+
+def add_unique_user_sketches(enriched_dfs, sketch_error):
+    """Adds the daily sketches of the unique user charts to enriched_dfs (see download_and_enrich) if sketch_error is
+    set and they have what the sketches need. Returns enriched_dfs."""
+
+    if (sketch_error is not None and 'views' in enriched_dfs and
+            has_columns({coll_name: list(df.columns) for coll_name, df in enriched_dfs.items()}, PLOTLINE_COLUMNS)):
+        enriched_dfs.update(build_unique_user_sketches(enriched_dfs, get_precision(sketch_error)))
+
+    return enriched_dfs
+
+
+@timed
+def download_and_enrich(limit=None, incremental=False, pushdown=False, verify=False, sketch_error=None,
+                        columns=None, processes=1, memory_budget_mb=None):
+    """
+    Downloads and enriches all collections, only the enriched columns in columns if given. Returns the data date (that
+    of the latest view) and a dict of enriched dataframes.
+
+    View statistics are computed on MongoDB with pushdown (see get_view_stats_pushdown), or from aggregate states
+    with incremental (see enrich_collections_incremental) or with memory_budget_mb (see
+    download_and_enrich_out_of_core). With sketch_error, the unique user charts' daily sketches are built (see
+    losttheplotly.build_unique_user_sketches) and, enriching from scratch, so are the distinct view counts' (see
+    get_view_stats_sketched).
+    """
+
+    if memory_budget_mb is not None and not incremental:
+        # ##0-2. DOWNLOAD DATA, votes and views straight into their aggregates, and ENRICH
+        today, enriched_dfs = download_and_enrich_out_of_core(limit=limit, pushdown=pushdown, verify=verify,
+                                                              columns=columns, memory_budget_mb=memory_budget_mb)
+        return today, add_unique_user_sketches(enriched_dfs, sketch_error)
+
     # ##0&1. DOWNLOAD DATA and BASIC PARSE
-    dfs_cleaned = get_collections_cleaned(limit=limit)
+    if pushdown:
+        dfs_cleaned = get_collections_cleaned(coll_names=('comments', 'votes', 'posts', 'users'), limit=limit,
+                                              incremental=incremental)
+        db = get_mongo_db_object()
+        latest_view = get_field_range('lwevents', db, 'createdAt', {'name': 'post-view'})[1]
+        today = latest_view.strftime('%Y-%m-%d')  # treat max date in collections as "today"
+        dfs_cleaned.update(get_view_stats_pushdown(db, date_str=today, latest_view=latest_view))
+    else:
+        dfs_cleaned = get_collections_cleaned(limit=limit, incremental=incremental)
+        today = dfs_cleaned['views']['createdAt'].max().strftime('%Y-%m-%d')  # treat max date in collections as "today"
+        if sketch_error is not None and not incremental:
+            dfs_cleaned.update(get_view_stats_sketched(dfs_cleaned['views'], today, get_precision(sketch_error)))
 
     # ##2. ENRICHING OF COLLECTIONS
-    today = dfs_cleaned['views']['createdAt'].max().strftime('%Y-%m-%d')  # treat max date in collections as "today"
-    dfs_enriched = enrich_collections(dfs_cleaned, date_str=today)
+    if incremental:
+        enriched_dfs = enrich_collections_incremental(dfs_cleaned, date_str=today, verify=verify, columns=columns)
+    else:
+        enriched_dfs = enrich_collections(dfs_cleaned, date_str=today, columns=columns, processes=processes)
+    enriched_dfs.update({name: dfs_cleaned[name] for name in VIEW_SKETCHES if name in dfs_cleaned})
 
-    # ##3. WRITE OUT ENRICHED COLLECTIONS
-    write_collections(dfs_enriched, date_str=today)
+    return today, add_unique_user_sketches(enriched_dfs, sketch_error)
+
+
+@timed
+def run_etlw_pipeline(date_str, clean_up=False, plotly=False, gsheets=False,
+                      metrics=False, postgres=False, limit=None, incremental=False, pushdown=False,
+                      max_age=SNAPSHOT_MAX_AGE, verify=False, sketch_error=None, processes=1, memory_budget_mb=None,
+                      karma_variants=None):
+    # ##0-3. DOWNLOAD, ENRICH AND WRITE OUT COLLECTIONS, or reuse a snapshot younger than max_age
+    # raw views are only needed by the plotly charts and the postgres export (which copies them in as they are);
+    # otherwise view statistics can be computed on MongoDB if pushdown is set
+    coll_names = ['users', 'posts', 'comments', 'votes']
+    if not pushdown or plotly or postgres:
+        coll_names.append('views')
+    # only the enriched columns the sinks that run read are computed (all of them if none does)
+    sink_columns = [columns for sink, columns in [(metrics, METRIC_COLUMNS), (plotly, PLOTLINE_COLUMNS),
+                                                  (gsheets, SHEETS_COLUMNS), (postgres, EXPORT_COLUMNS)] if sink]
+    today, dfs_enriched = get_snapshot(limit=limit, coll_names=coll_names, max_age=max_age,
+                                       incremental=incremental, pushdown=pushdown, verify=verify,
+                                       sketch_error=sketch_error,
+                                       columns=combine_columns(*sink_columns) if sink_columns else None,
+                                       processes=processes, memory_budget_mb=memory_budget_mb)
 
     # ##4 METRIC STUFF - PLOTS AND SHEETS
     if metrics:
-        run_metric_pipeline(dfs_enriched, online=True, sheets=gsheets, plots=True) # TODO; change a lot of these default options to respect input options
+        # TODO; change a lot of these default options to respect input options
+        # incremental runs have all the votes, so the karma metric can resume from its checkpoint
+        # karma_variants are (exponent, downvote multiplier) pairs to also compute the metric under
+        karma_frames = run_metric_pipeline(dfs_enriched, online=True, sheets=gsheets, plots=True, resume=incremental,
+                                           verify=verify, variants=karma_variants)
+        # saved with the snapshot, for notebooks to slice: load_from_file(today, ['karma_cube', 'karma_sweep'])
+        for coll_name, df in karma_frames.items():
+            add_to_snapshot(coll_name, df, today)
 
     # ##5. PLOT GRAPHS TO PLOTLY DASHBOARD
     if plotly:
-        run_plotline(dfs_enriched, start_date='2019-04-01', size=(700, 350), online=True)
+        run_plotline(dfs_enriched, start_date='2019-04-01', size=(700, 350), online=True, sketch_error=sketch_error)
 
     # ##6. PLOT GRAPHS TO PLOTLY DASHBOARD
     if gsheets:
@@ -2,142 +2,34 @@ import pandas as pd
 import configparser
 import sqlalchemy as sqa
 from utils import timed
+from schema import EXPORT_COLUMNS, decode_dtypes
 
 from IPython.display import display
 
 
 def prepare_users(dfu):
-    users_sql_cols = ['_id',
-                      'username',
-                      'displayName',
-                      'createdAt',
-                      'postCount',
-                      'commentCount',
-                      'karma',
-                      'afKarma',
-                      'legacyKarma',
-                      'deleted',
-                      'banned',
-                      'legacy',
-                      'shortformFeedId',
-                      'signUpReCaptchaRating',
-                      'reviewedByUserId',
-                      'earliest_activity',
-                      'true_earliest',
-                      'most_recent_activity',
-                      'days_since_active',
-                      'total_posts',
-                      'earliest_post',
-                      'most_recent_post',
-                      'num_drafts',
-                      'percent_drafts',
-                      'total_comments',
-                      'earliest_comment',
-                      'most_recent_comment',
-                      'total_votes',
-                      'most_recent_vote',
-                      'earliest_vote',
-                      'percent_downvotes',
-                      'percent_upvotes_big',
-                      'most_recent_view',
-                      'earliest_view',
-                      'num_distinct_posts_viewed',
-                      'num_days_present_last_30_days',
-                      'num_posts_last_30_days',
-                      'num_comments_last_30_days',
-                      'num_votes_last_30_days',
-                      'num_views_last_30_days',
-                      'num_distinct_posts_viewed_last_30_days',
-                      'num_posts_last_180_days',
-                      'num_comments_last_180_days',
-                      'num_votes_last_180_days',
-                      'num_views_last_180_days',
-                      'num_distinct_posts_viewed_last_180_days',
-                      'bio',
-                      'email']
-
-    users = dfu.loc[:,users_sql_cols]
-    users.loc[:,'afKarma'] = users['afKarma'].fillna(0).astype(int)
+    users = decode_dtypes(dfu.loc[:,EXPORT_COLUMNS['users']])
     users.loc[:,'num_drafts'] = users['num_drafts'].replace(False, 0).fillna(0).astype(int)
     users.loc[:,'percent_drafts'] = users['percent_drafts'].replace(False, 0).fillna(0)
     users.loc[:,'birth'] = pd.datetime.now()
     return users
 
 def prepare_posts(dfp):
-    posts_sql_cols = [
-        '_id',
-        'userId',
-        'postedAt',
-        'username',
-        'title',
-        'baseScore',
-        'afBaseScore',
-        'score',
-        'draft',
-        'question',
-        'isEvent',
-        'viewCount',
-        'viewCountLogged',
-        'clickCount',
-        'commentCount',
-        'num_distinct_viewers',
-        'num_distinct_commenters',
-        'wordCount',
-        'smallUpvote',
-        'bigUpvote',
-        'smallDownvote',
-        'bigDownvote',
-        'percent_downvotes',
-        'url',
-        'slug',
-        'canonicalCollectionSlug',
-        'website',
-        'gw',
-        'frontpaged',
-        'frontpageDate',
-        'curatedDate',
-        'moderationGuidelinesHtmlBody',
-        'status',
-        'legacySpam',
-        'authorIsUnreviewed',
-        'most_recent_comment',
-        'userAgent',
-    ]
-
-    posts = dfp[posts_sql_cols].sort_values('postedAt', ascending=False)
+    posts = decode_dtypes(dfp[EXPORT_COLUMNS['posts']].sort_values('postedAt', ascending=False))
     posts.loc[:,'birth'] = pd.datetime.now()
 
     return posts
 
 def prepare_comments(dfc):
-    comments_sql_cols = [
-        '_id',
-        'userId',
-        'username',
-        'postId',
-        'postedAt',
-        'baseScore',
-        'score',
-        'answer',
-        'parentAnswerId',
-        'wordCount',
-        'top_level',
-        'gw',
-        'num_votes',
-        'percent_downvotes',
-        'smallUpvote',
-        'bigUpvote',
-        'smallDownvote',
-        'bigDownvote',
-        'userAgent',
-        'createdAt'
-    ]
-
-    comments = dfc[comments_sql_cols].sort_values('postedAt', ascending=False)
+    comments = decode_dtypes(dfc[EXPORT_COLUMNS['comments']].sort_values('postedAt', ascending=False))
     comments.loc[:,'gw'] = comments['gw'].fillna(False)
     comments.loc[:,'birth'] = pd.datetime.now()
     return comments
 
+def prepare_views(dfv):
+    # the views table has the calendar date of each view too
+    return decode_dtypes(dfv).assign(date=dfv['createdAt'].dt.date)
+
 
 def get_pg_engine():
     config = configparser.ConfigParser()
@@ -152,16 +44,19 @@ def get_pg_engine():
 
 
 def prep_frames_for_db(dfs):
+    # votes and views go in as they are, with plain values; the processed snapshots are parquet, which COPY can't read
     prep_funcs = {
         'users': prepare_users,
         'posts': prepare_posts,
-        'comments': prepare_comments
+        'comments': prepare_comments,
+        'votes': decode_dtypes,
+        'views': prepare_views
     }
 
     [prep_funcs[coll](dfs[coll])
          .to_csv('/home/ubuntu/lesswrong-analytics/analytics_data_files/export/{}.csv'.format(coll),
                                                                                        index=False) for coll in
-     ['users', 'posts', 'comments']]
+     ['users', 'posts', 'comments', 'votes', 'views']]
 
 
 def truncate_tables(tables, conn):
@@ -174,13 +69,7 @@ def truncate_tables(tables, conn):
 
 
 def load_csvs_to_pg(date_str, conn):
-    for coll in ['votes', 'views']:
-        sql = "COPY {} FROM '/home/ubuntu/lesswrong-analytics/analytics_data_files/processed/{}/{}.csv' DELIMITER ',' CSV HEADER;".format(
-            coll, date_str, coll)
-        print(sql)
-        conn.execute(sql)
-
-    for coll in ['posts', 'comments', 'users']:
+    for coll in ['votes', 'views', 'posts', 'comments', 'users']:
         sql = "COPY {} FROM '/home/ubuntu/lesswrong-analytics/analytics_data_files/export/{}.csv' DELIMITER ',' CSV HEADER;".format(
             coll, coll)
         print(sql)
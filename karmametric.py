@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import numpy as np
 import plotly
@@ -5,7 +6,24 @@ import plotly.plotly as py
 import plotly.graph_objs as go
 from plotly.offline import init_notebook_mode, iplot
 from gspread_pandas import Spread, Client
-from utils import timed, get_config_field
+from utils import timed, get_config_field, print_and_log
+from schema import decode_dtypes
+
+# enriched columns the metric and its sheets read, so only those need computing (see etlw.get_snapshot)
+METRIC_COLUMNS = {
+    'posts': ['username', 'num_votes', 'percent_downvotes', 'num_distinct_viewers', 'num_comments_rederived'],
+    'comments': ['username', 'num_votes', 'percent_downvotes'],
+}
+
+VOTE_KEY_COLUMNS = ['documentId', 'userId', 'voteType', 'votedAt']  # identify a vote from run to run
+
+# the metric's formula: a document's score is its total power, with downvotes multiplied by DOWNVOTE_MULTIPLIER,
+# raised to KARMA_EXPONENT (see run_vote_algorithm; sweep_karma_metric tries others)
+KARMA_EXPONENT = 1.2
+DOWNVOTE_MULTIPLIER = 4
+
+# periods votes can be aggregated to (see agg_votes_to_period): pandas period code -> name in column names
+PERIOD_NAMES = {'D': 'day', 'W': 'week', 'M': 'month'}
 
 
 def filtered_and_enriched_votes(dfs):
@@ -15,7 +33,7 @@ def filtered_and_enriched_votes(dfs):
     dfv = dfs['votes']
 
     GP2_id = 'pgoCXxuzpkPXADTp2'
-    excluded_posts = dfp[(dfp['status'] != 2) | dfp['authorIsUnreviewed'] | dfp['draft']]['_id']
+    excluded_posts = dfp[~dfp['status'].isin([2]) | dfp['authorIsUnreviewed'] | dfp['draft']]['_id']
     lw_team = dfu[dfu['username'].isin(['Benito', 'habryka4', 'Raemon', 'jimrandomh', 'Ruby'])]['_id']
 
     dfvv = dfv[(~dfv['userId'].isin(lw_team)) & (~dfv['documentId'].isin(excluded_posts)) & (
@@ -24,46 +42,224 @@ def filtered_and_enriched_votes(dfs):
     dfvv['downvote'] = dfvv['power'] < 0  # create boolean column for later convenience
 
     dfvv.loc[:, 'power_d4'] = dfvv['power'].copy()  # create a copy of the power (karma) column
-    dfvv.loc[dfvv['power'] < 0, 'power_d4'] = dfvv.loc[dfvv[
-                                                           'power'] < 0, 'power'] * 4  # multiply all rows with negative power by 4
+    # multiply all rows with negative power by DOWNVOTE_MULTIPLIER
+    dfvv.loc[dfvv['power'] < 0, 'power_d4'] = dfvv.loc[dfvv['power'] < 0, 'power'] * DOWNVOTE_MULTIPLIER
 
-    dfvv = dfvv.sort_values('votedAt')
-    dfvv['voteId'] = (
-            dfvv['documentId'] + dfvv['userId'] + dfvv['voteType'].astype(str) +
-            dfvv['votedAt'].astype(int).astype('str')
-    ).apply(lambda x: hex(hash(x))).astype('str')
-    dfvv = dfvv.set_index(dfvv['voteId'])
+    # stable, so votes at the same time keep their order. Votes are identified by their position in this order (the
+    # vote algorithm's effects line up with it), or across runs by get_vote_keys
+    dfvv = dfvv.sort_values('votedAt', kind='mergesort').reset_index(drop=True)
 
     return dfvv
 
 
-def run_incremental_vote_algorithm(votes):
-    def fancy_power(x, power):
-        return np.sign(x) * np.abs(x) ** power
+def fancy_power(x, power):
+    """Raises the magnitude of x (a number or an array) to power, keeping its sign."""
+    return np.sign(x) * np.abs(x) ** power
+
+
+def get_score_changes(new_totals, power_d4, exponent=KARMA_EXPONENT):
+    """Returns the change in score each vote made, given its power_d4 and its document's running total after it."""
+    return fancy_power(new_totals, exponent) - fancy_power(new_totals - power_d4, exponent)
+
+
+def get_vote_effects(power_d4, document_codes, start_totals=0, exponent=KARMA_EXPONENT):
+    """
+    Returns the running total of power_d4 of each vote's document after it (starting from start_totals, one per
+    vote) and the vote's effect, taking votes in the order given. document_codes are integer codes of the documents.
+    """
+    new_totals = pd.Series(power_d4).groupby(document_codes).cumsum().values + start_totals
+    return new_totals, get_score_changes(new_totals, power_d4, exponent)
+
+
+def get_document_totals(power_d4, document_codes, num_documents):
+    """Returns the total power_d4 of each of num_documents documents (votes with a missing document, code -1, left
+    out)."""
+    has_document = document_codes >= 0
+    return np.bincount(document_codes[has_document], weights=power_d4[has_document],
+                       minlength=num_documents).astype('int64')
+
+
+def run_vote_algorithm(votes, exponent=KARMA_EXPONENT):
+    """
+    Computes the karma metric's score of each document and the effect each vote had on it. A document's score is its
+    running total of power_d4 raised to exponent (see fancy_power), and a vote's effect the change in score it
+    made, taking votes in the order given (that of votedAt). The running totals are cumulative sums per document, so
+    every vote is computed at once.
+
+    Returns series of the final total power_d4 and score of each document, indexed by documentId, and an array of
+    the effect of each vote.
+    """
+
+    power_d4 = votes['power_d4'].values.astype('int64')
+    codes, documents = pd.factorize(votes['documentId'])  # documents in order of first vote, missing ones are -1
+    _, effects = get_vote_effects(power_d4, codes, exponent=exponent)
+
+    base_scores_d4 = pd.Series(get_document_totals(power_d4, codes, len(documents)),
+                               index=pd.Index(documents, name='documentId'))
+
+    return base_scores_d4, fancy_power(base_scores_d4, exponent), effects
+
+
+def get_vote_keys(votes):
+    """Returns a 64 bit hash of each vote's VOTE_KEY_COLUMNS, the same from run to run (whatever the id dtypes)."""
+    return pd.util.hash_pandas_object(votes[VOTE_KEY_COLUMNS], index=False).values
+
+
+def fingerprint_documents(keys, document_codes, num_documents, rows=None):
+    """Returns the number of votes of each document and a checksum of their keys (see get_vote_keys), over rows
+    (a mask, all votes if None). Votes whose document is missing are left out."""
+
+    selected = document_codes >= 0 if rows is None else rows & (document_codes >= 0)
+    return (np.bincount(document_codes[selected], minlength=num_documents),
+            np.bincount(document_codes[selected], weights=(keys[selected] >> np.uint64(40)).astype(float),
+                        minlength=num_documents))
+
+
+def get_karma_checkpoint_path():
+    """The state of the vote algorithm after the last run, to resume from (see run_vote_algorithm_resumed)."""
+    import etlw  # etlw imports this module, so it's only imported once both are loaded
+    return etlw.get_incremental_path('karma_checkpoint.pkl')
+
+
+def load_karma_checkpoint():
+    """Loads the checkpoint saved by run_vote_algorithm_resumed, or returns None if there isn't one."""
+    path = get_karma_checkpoint_path()
+    if not os.path.exists(path):
+        return None
+    return pd.read_pickle(path)
+
+
+def save_karma_checkpoint(checkpoint):
+    path = get_karma_checkpoint_path()
+    pd.to_pickle(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def run_vote_algorithm_resumed(votes):
+    """
+    As run_vote_algorithm, but continuing from a checkpoint of the last run, so only votes since then are computed.
+    votes must be all the (filtered) votes, not a sample. The checkpoint holds the effect of every vote up to the
+    watermark (the latest vote it had), by key (see get_vote_keys), and the running total of each document.
 
-    baseScoresD4 = {}
-    docScores = {}
-    voteEffects = {}
+    Votes before the watermark can still change: late votes arrive, votes are cancelled, and which users, posts
+    and comments are excluded changes. Each document's votes up to the watermark are checked against its number and
+    checksum of votes in the checkpoint, and documents that don't match have all their votes computed again.
+    Documents with two votes with the same key are always computed again, as their effects can't be told apart.
 
-    for vote in votes.itertuples(index=False, name='Vote'):
-        oldScore = fancy_power(baseScoresD4.get(vote.documentId, 0), 1.2)
-        newScore = fancy_power(baseScoresD4.get(vote.documentId, 0) + vote.power_d4, 1.2)
-        voteEffects[vote.voteId] = newScore - oldScore
+    Saves the checkpoint of this run and returns the same as run_vote_algorithm.
+    """
 
-        baseScoresD4[vote.documentId] = baseScoresD4.get(vote.documentId, 0) + vote.power_d4
-        docScores[vote.documentId] = newScore
+    checkpoint = load_karma_checkpoint()
+    keys = get_vote_keys(votes)
+    power_d4 = votes['power_d4'].values.astype('int64')
+    codes, documents = pd.factorize(votes['documentId'])
+    document_names = pd.Index(documents).astype(str)  # checkpoints are keyed by plain ids, like aggregate states
 
-    return baseScoresD4, docScores, voteEffects
+    effects = np.zeros(len(votes))
+    start_totals = np.zeros(len(documents), dtype='int64')
+    reused = np.zeros(len(votes), dtype=bool)
+    changed = np.ones(len(documents), dtype=bool)
 
+    if checkpoint is not None:
+        state = checkpoint['documents'].reindex(document_names, fill_value=0)
+        before = votes['votedAt'].values <= np.datetime64(checkpoint['watermark'])
+        num_votes, checksum = fingerprint_documents(keys, codes, len(documents), rows=before)
+        changed = (num_votes != state['num_votes'].values) | (checksum != state['checksum'].values)
+        changed[np.unique(codes[pd.Index(keys).duplicated(keep=False) & (codes >= 0)])] = True
+
+        reused = before & (codes >= 0) & ~changed[codes]
+        positions = pd.Index(checkpoint['effects'].index).get_indexer(keys[reused])
+        if (positions < 0).any():  # a key collision, most likely
+            changed[np.unique(codes[reused][positions < 0])] = True
+            reused = before & (codes >= 0) & ~changed[codes]
+            positions = pd.Index(checkpoint['effects'].index).get_indexer(keys[reused])
+        effects[reused] = checkpoint['effects'].values[positions]
+        start_totals = np.where(changed, 0, state['total'].values).astype('int64')
+
+    computed = ~reused
+    _, effects[computed] = get_vote_effects(power_d4[computed], codes[computed],
+                                            np.where(codes[computed] >= 0, start_totals[codes[computed]], 0))
+    print_and_log('Karma metric: {} vote effects reused from the checkpoint, {} computed ({} of {} documents from '
+                  'scratch).'.format(reused.sum(), computed.sum(), changed.sum(), len(documents)))
+
+    totals = get_document_totals(power_d4, codes, len(documents))
+    num_votes, checksum = fingerprint_documents(keys, codes, len(documents))
+    save_karma_checkpoint({
+        'watermark': votes['votedAt'].max(),
+        'documents': pd.DataFrame({'total': totals, 'num_votes': num_votes, 'checksum': checksum},
+                                  index=document_names),
+        'effects': pd.Series(effects, index=keys)[~pd.Index(keys).duplicated()]
+    })
+
+    base_scores_d4 = pd.Series(totals, index=pd.Index(documents, name='documentId'))
+    return base_scores_d4, fancy_power(base_scores_d4, KARMA_EXPONENT), effects
+
+
+def compute_karma_metric(dfs, resume=False, verify=False):
+    """
+    Filters the votes and computes the effect of each of them on the karma metric, and the score of each document.
+    With resume, the algorithm continues from the checkpoint of the last run (see run_vote_algorithm_resumed), so
+    dfs must hold all votes. With verify, the resumed effects are checked against running it from scratch.
+    """
 
-def compute_karma_metric(dfs):
     allVotes = filtered_and_enriched_votes(dfs)
-    baseScoresD4, docScores, voteEffects = run_incremental_vote_algorithm(allVotes)
-    allVotes = allVotes.merge(pd.Series(voteEffects).to_frame('effect'), left_index=True, right_index=True)
+    if resume:
+        baseScoresD4, docScores, effects = run_vote_algorithm_resumed(allVotes)
+        if verify:
+            _, _, expected = run_vote_algorithm(allVotes)
+            num_different = (effects != expected).sum()
+            print_and_log('Karma metric: resumed effects {} the effects computed from scratch{}.'.format(
+                'match' if num_different == 0 else 'differ from',
+                '' if num_different == 0 else ' for {} votes'.format(num_different)))
+    else:
+        baseScoresD4, docScores, effects = run_vote_algorithm(allVotes)
+    allVotes['effect'] = effects  # in the order of the votes
 
     return allVotes, baseScoresD4, docScores
 
 
+def sweep_karma_metric(votes, variants, pr='D'):
+    """
+    Computes the karma metric's net effect per period pr (see get_period_labels) under each of variants, pairs of
+    (exponent, downvote multiplier) to use instead of KARMA_EXPONENT and DOWNVOTE_MULTIPLIER. votes are the filtered,
+    sorted votes (see filtered_and_enriched_votes).
+
+    Votes are sorted by time, so a document's votes in one period are consecutive and their effects add up to the
+    change in its score over them: the score of its running total after the last of them less that before the
+    first. Those totals are aggregated once per document and period, as upvote and downvote power (a vote's power_d4
+    under any multiplier is its upvote power plus the multiplier times its downvote power). Each variant then only
+    costs arithmetic over the document-periods, not the votes.
+
+    Returns a long frame with columns exponent, downvote_multiplier, votedAt and effect, a row per variant and period
+    with votes.
+    """
+
+    power = votes['power'].values.astype('int64')
+    down_power = np.minimum(power, 0)
+    codes, _ = pd.factorize(votes['documentId'])
+    period_codes, periods = pd.factorize(get_period_labels(votes['votedAt'], pr), sort=True)
+
+    cells = pd.DataFrame({'document': codes, 'period': period_codes, 'up': power - down_power, 'down': down_power})
+    running = cells.groupby('document')[['up', 'down']].cumsum()
+    cells = cells.assign(up_total=running['up'], down_total=running['down'])
+    # votes without a time are left out, as resampling does
+    cells = cells[cells['period'] >= 0].groupby(['document', 'period'], sort=False).agg(
+        up=('up', 'sum'), down=('down', 'sum'), up_total=('up_total', 'last'), down_total=('down_total', 'last'))
+    cell_periods = cells.index.get_level_values('period').values
+
+    series = []
+    for exponent, multiplier in variants:
+        end_totals = (cells['up_total'] + multiplier * cells['down_total']).values
+        start_totals = end_totals - (cells['up'] + multiplier * cells['down']).values
+        effects = fancy_power(end_totals, exponent) - fancy_power(start_totals, exponent)
+        series.append(pd.DataFrame({
+            'exponent': exponent, 'downvote_multiplier': multiplier, 'votedAt': periods,
+            'effect': np.bincount(cell_periods, weights=effects, minlength=len(periods))
+        }))
+
+    return pd.concat(series, ignore_index=True)
+
+
 def create_trend_frame():
     def growth_series(trend_range, growth_rate, initial_value):
         return [initial_value * growth_rate ** i for i in range(len(trend_range))]
@@ -82,9 +278,9 @@ def create_trend_frame():
     return trends
 
 
-def plot_karma_metric(allVotes, online=False):
+def plot_karma_metric(cube, online=False):
     pr = 'D'
-    votes_ts = allVotes.set_index('votedAt').resample(pr)['effect'].sum()
+    votes_ts = cube.groupby('votedAt')['effect'].sum().resample(pr).sum()  # days without votes count as 0
     print(' ______ PRINTING ________')
     print(votes_ts)
     print(' ______________')
@@ -119,7 +315,7 @@ def plot_karma_metric(allVotes, online=False):
 
     layout = go.Layout(
         autosize=True, width=size[0], height=size[1],
-        title='Net Karma, 4x Downvote, Daily, 1.2 item exponent',
+        title='Net Karma, {}x Downvote, Daily, {} item exponent'.format(DOWNVOTE_MULTIPLIER, KARMA_EXPONENT),
         xaxis={'range': [start_date, end_date], 'title': None},
         yaxis={'range': [0, votes_ts.set_index(date_col)[start_date:]['effect'].max() * 1.1],
                'title': 'net karma'}
@@ -136,25 +332,86 @@ def plot_karma_metric(allVotes, online=False):
         iplot(fig, filename='Net Karma Metric')
 
 
-def agg_votes_to_period(dfvv, pr='D', start_date='2019-06'):
-    pr_dict = {'D': 'day', 'W': 'week'}
+def get_period_labels(times, pr):
+    """
+    Returns the label resample(pr) gives the period each of times falls in: its start for periods of fixed length
+    (e.g. 'D'), and its last day for calendar periods ('W' weeks ending on Sunday, 'M' months). For those, times are
+    floored to days once and only the distinct days are labelled.
+    """
 
-    post_cols = ['_id', 'postedAt', 'username', 'title', 'baseScore', 'num_votes', 'percent_downvotes',
-                 'num_distinct_viewers']
-    comment_cols = ['_id', 'postId', 'postedAt', 'username', 'baseScore', 'num_votes', 'percent_downvotes']
+    if isinstance(pd.tseries.frequencies.to_offset(pr), pd.tseries.offsets.Tick):
+        return times.dt.floor(pr)
+
+    codes, days = pd.factorize(times.dt.floor('D'))  # missing times are -1, and get the NaT appended
+    labels = pd.Series(days).dt.to_period(pr).dt.end_time.dt.floor('D').values
+    return pd.Series(np.append(labels, np.datetime64('NaT', 'ns'))[codes], index=times.index)
+
+
+def build_karma_cube(allVotes, dfp, dfc):
+    """
+    Aggregates the votes of the karma metric (see compute_karma_metric) to each document and day: their total
+    power_d4 and effect, number of votes and of downvotes. Each document also has the post it's on (itself for
+    posts, and for comments not in dfc) and its author, authorId.
+
+    Every view of the karma metric is a roll-up of the cube (see roll_up_karma_cube), so votes are only aggregated
+    once per run. It's saved with the snapshot (see etlw.run_etlw_pipeline) for slicing in notebooks.
+    """
+
+    keys = ['collectionName', 'documentId', 'votedAt']
+    votes = allVotes.assign(votedAt=allVotes['votedAt'].dt.floor('D'), power_d4=allVotes['power_d4'].astype('int64'),
+                            downvote=allVotes['downvote'].astype(int))
+    cube = votes.groupby(keys, observed=True).agg(
+        power_d4=('power_d4', 'sum'), effect=('effect', 'sum'), num_votes=('power_d4', 'size'),
+        num_downvotes=('downvote', 'sum')).reset_index()
+    cube = cube.astype({key: votes[key].dtype for key in keys})  # grouping no votes loses the keys' dtypes
+
+    documents = pd.concat([dfp[['_id', 'userId']].assign(postId=dfp['_id']), dfc[['_id', 'postId', 'userId']]],
+                          ignore_index=True, sort=False).rename(columns={'_id': 'documentId', 'userId': 'authorId'})
+    cube = cube.merge(documents.drop_duplicates('documentId'), on='documentId', how='left')
+    cube['postId'] = cube['postId'].fillna(cube['documentId'])
 
-    d = dfvv.set_index('votedAt').sort_index()[start_date:].groupby(['collectionName', 'documentId']).resample(pr).agg(
-        {'power_d4': 'sum', 'effect': 'sum', 'legacy': 'size', 'downvote': 'mean'}
-    ).round(1).reset_index()
+    return cube
+
+
+def roll_up_karma_cube(cube, by, pr='D', start_date=None):
+    """
+    Rolls the karma cube (see build_karma_cube) up to the columns in by (e.g. ['postId'], ['authorId'] or
+    ['collectionName']) and periods pr (a pandas period code, see PERIOD_NAMES) from start_date on, labelled as
+    resample labels them (see get_period_labels) in votedAt. Periods without votes have no row.
+    """
+
+    if start_date is not None:
+        cube = cube[cube['votedAt'] >= pd.Timestamp(start_date)]
+    cube = cube.assign(votedAt=get_period_labels(cube['votedAt'], pr))
+
+    keys = list(by) + ['votedAt']
+    rolled = cube.groupby(keys, observed=True)[['power_d4', 'effect', 'num_votes', 'num_downvotes']].sum().reset_index()
+
+    # sorted explicitly, as groupby doesn't sort by several categorical keys with observed=True. Sorted on the decoded
+    # ids, not their codes, which differ from snapshot to snapshot, so ties later ranked by order stay the same
+    order = decode_dtypes(rolled[keys]).sort_values(keys, kind='mergesort').index
+    return rolled.loc[order].reset_index(drop=True)
+
+
+def agg_votes_to_period(cube, pr='D', start_date='2019-06'):
+    """
+    Aggregates votes from start_date on to each document and period pr (see roll_up_karma_cube), with their
+    number and share of downvotes, rounded. Only periods whose votes' power_d4 doesn't add up to 0 are kept.
+    """
+
+    d = roll_up_karma_cube(cube, ['collectionName', 'documentId'], pr, start_date)
+    d = d.assign(effect=d['effect'].round(1),
+                 downvote=(d['num_downvotes'] / d['num_votes']).round(1)).drop(columns='num_downvotes')
     d = d.rename(
-        columns={'legacy': 'num_votes_{}'.format(pr_dict[pr]), 'downvote': 'percent_downvotes_{}'.format(pr_dict[pr])})
-    d = d[d['power_d4'] != 0]  # introduced by resampling function
+        columns={'num_votes': 'num_votes_{}'.format(PERIOD_NAMES[pr]),
+                 'downvote': 'percent_downvotes_{}'.format(PERIOD_NAMES[pr])})
+    d = d[d['power_d4'] != 0]
     return d
 
 
 # add total effects
 def add_total_effect_cumulative_and_ranks(dd, pr='D'):
-    pr_dict = {'D': 'day', 'W': 'week'}
+    pr_dict = PERIOD_NAMES
 
     dd['effect'] = dd['effect'].round(1)
     dd['abs_effect'] = dd['effect'].abs()
@@ -195,7 +452,7 @@ def add_url_column(dd):
 
 
 def item_agg_select_columns(dd, pr):
-    pr_dict = {'D': 'day', 'W': 'week'}
+    pr_dict = PERIOD_NAMES
     cols = ['votedAt', 'collectionName', 'title', 'username_post', 'baseScore_post', 'username_comment',
             'baseScore_comment',
             'effect', 'effect_over_abs', 'cum_effect', 'cum_over_abs',
@@ -209,7 +466,7 @@ def item_agg_select_columns(dd, pr):
 
 
 def post_agg_select_columns(dd, pr):
-    pr_dict = {'D': 'day', 'W': 'week'}
+    pr_dict = PERIOD_NAMES
     cols = ['votedAt', 'title', 'username', 'baseScore', 'num_comments_voted_on_{}'.format(pr_dict[pr]),
             'num_votes_thread_{}'.format(pr_dict[pr]), 'num_downvotes_{}'.format(pr_dict[pr]),
             'effect', 'effect_over_abs', 'cum_effect', 'cum_over_abs',
@@ -221,12 +478,12 @@ def post_agg_select_columns(dd, pr):
     return dd[cols].set_index(['votedAt', 'title'])
 
 
-def agg_votes_to_items(dfvv, dfp, dfc, pr='D', start_date='2019-06-01'):
+def agg_votes_to_items(cube, dfp, dfc, pr='D', start_date='2019-06-01'):
     post_cols = ['_id', 'postedAt', 'username', 'title', 'baseScore', 'num_votes', 'percent_downvotes',
                  'num_distinct_viewers']
     comment_cols = ['_id', 'postId', 'postedAt', 'username', 'baseScore', 'num_votes', 'percent_downvotes']
 
-    d = agg_votes_to_period(dfvv, pr, start_date)
+    d = agg_votes_to_period(cube, pr, start_date)
 
     # add in post and comment details
     dd = d.merge(dfc[comment_cols], left_on='documentId', right_on='_id', how='left', suffixes=['', '_comment'])
@@ -243,28 +500,23 @@ def agg_votes_to_items(dfvv, dfp, dfc, pr='D', start_date='2019-06-01'):
     return dd
 
 
-def agg_votes_to_posts(dfvv, dfp, dfc, pr='D', start_date='2019-06-01'):
-    pr_dict = {'D': 'day', 'W': 'week'}
-    d = agg_votes_to_period(dfvv, pr, start_date)
-
-    # add in comments
+def agg_votes_to_posts(cube, dfp, dfc, pr='D', start_date='2019-06-01'):
+    pr_dict = PERIOD_NAMES
     post_cols = ['_id', 'postedAt', 'username', 'title', 'baseScore', 'num_votes', 'percent_downvotes',
                  'num_distinct_viewers']
-    comment_cols = ['_id', 'postId', 'postedAt', 'username', 'baseScore', 'num_votes', 'percent_downvotes']
-    dd = d.merge(dfc[comment_cols], left_on='documentId', right_on='_id', how='left', suffixes=['', '_comment'])
+
+    # the documents' periods, as for items, rolled up to the posts they're on
+    d = roll_up_karma_cube(cube, ['collectionName', 'documentId', 'postId'], pr, start_date)
+    d = d[d['power_d4'] != 0]
+    d['effect'] = d['effect'].round(1)
 
     # aggregate to post level
-    dd['postId'] = dd['postId'].fillna(dd['documentId'])
-    dd['num_downvotes_{}'.format(pr_dict[pr])] = (
-            dd['num_votes_{}'.format(pr_dict[pr])] * dd['percent_downvotes_{}'.format(pr_dict[pr])]).round().astype(
-        int)
-    dd = dd.groupby(['votedAt', 'postId']).agg({'power_d4': 'sum', 'effect': 'sum', 'username': 'size',
-                                                'num_votes_{}'.format(pr_dict[pr]): 'sum',
-                                                'num_downvotes_{}'.format(pr_dict[pr]): 'sum'
-                                                })
-    dd['num_comments_voted_on_{}'.format(pr_dict[pr])] = dd['username'] - 1
-    dd = dd.rename(columns={'username': 'num_items',
-                            'num_votes_{}'.format(pr_dict[pr]): 'num_votes_thread_{}'.format(pr_dict[pr])})
+    dd = d.groupby(['votedAt', 'postId'], observed=True).agg({'power_d4': 'sum', 'effect': 'sum', 'documentId': 'size',
+                                                              'num_votes': 'sum', 'num_downvotes': 'sum'})
+    dd['num_comments_voted_on_{}'.format(pr_dict[pr])] = dd['documentId'] - 1
+    dd = dd.rename(columns={'documentId': 'num_items',
+                            'num_votes': 'num_votes_thread_{}'.format(pr_dict[pr]),
+                            'num_downvotes': 'num_downvotes_{}'.format(pr_dict[pr])})
     dd = dd.reset_index()
 
     # add in post details
@@ -282,14 +534,21 @@ def agg_votes_to_posts(dfvv, dfp, dfc, pr='D', start_date='2019-06-01'):
 
 
 @timed
-def run_metric_pipeline(dfs, online=False, sheets=False, plots=False):
+def run_metric_pipeline(dfs, online=False, sheets=False, plots=False, resume=False, verify=False, variants=None):
+    """Computes the karma metric, plots it and writes its sheets. Returns the frames to save with the snapshot: the
+    karma cube everything is derived from (see build_karma_cube) and, given variants, the daily metric under each of
+    them (see sweep_karma_metric)."""
     dfp = dfs['posts']
     dfc = dfs['comments']
 
-    allVotes, baseScoresD4, docScores = compute_karma_metric(dfs)
+    allVotes, baseScoresD4, docScores = compute_karma_metric(dfs, resume=resume, verify=verify)
+    cube = build_karma_cube(allVotes, dfp, dfc)
+    frames = {'karma_cube': cube}
+    if variants:
+        frames['karma_sweep'] = sweep_karma_metric(allVotes, variants)
 
     if plots:
-        plot_karma_metric(allVotes, online=online)
+        plot_karma_metric(cube, online=online)
 
     if sheets:
         spreadsheet_name = get_config_field('GSHEETS', 'spreadsheet_name')
@@ -299,14 +558,16 @@ def run_metric_pipeline(dfs, online=False, sheets=False, plots=False):
         pr_dict = {'D': 'Daily', 'W': 'Weekly'}
 
         for pr in ['D', 'W']:
-            votes2posts = agg_votes_to_posts(allVotes, dfp, dfc, pr=pr)
-            data = votes2posts.reset_index().sort_values(['votedAt', 'rank'], ascending=[False, True]).copy()
+            votes2posts = agg_votes_to_posts(cube, dfp, dfc, pr=pr)
+            data = decode_dtypes(votes2posts.reset_index().sort_values(['votedAt', 'rank'], ascending=[False, True]))
             data['birth'] = pd.datetime.now()
             data.columns = [col.replace('_', ' ').title() for col in data.columns]
             s.df_to_sheet(data, replace=True, sheet='KM: Posts/{}'.format(pr_dict[pr]), index=False)
 
-            votes2items = agg_votes_to_items(allVotes, dfp, dfc, pr=pr)
-            data = votes2items.reset_index().sort_values(['votedAt', 'rank'], ascending=[False, True]).copy()
+            votes2items = agg_votes_to_items(cube, dfp, dfc, pr=pr)
+            data = decode_dtypes(votes2items.reset_index().sort_values(['votedAt', 'rank'], ascending=[False, True]))
             data['birth'] = pd.datetime.now()
             data.columns = [col.replace('_', ' ').title() for col in data.columns]
             s.df_to_sheet(data, replace=True, sheet='KM: Items/{}'.format(pr_dict[pr]), index=False)
+
+    return frames
@@ -5,8 +5,18 @@ import plotly.graph_objs as go
 from plotly.offline import init_notebook_mode, iplot
 
 from utils import timed, get_config_field
+from sketches import build_sketches, estimate_distinct, merge_sketches
 from lwdash import downvote_monitoring
 
+# enriched columns the charts read, so only those need computing (see etlw.get_snapshot)
+PLOTLINE_COLUMNS = {
+    'users': ['num_distinct_posts_viewed', 'true_earliest'],
+    'posts': ['smallUpvote', 'bigUpvote', 'username'],
+}
+
+# daily sketches of the users the unique user charts count (see build_unique_user_sketches), saved with snapshots
+UNIQUE_USER_SKETCHES = ('logged_in_user_sketches', 'voter_sketches')
+
 
 def plotly_ts(ss=None, title='missing', color='yellow', dd=None, start_date=None, end_date=pd.datetime.today(),
               ma=1, pr='D', date_col='postedAt', size=(700, 400), online=False, exclude_last_period=True,):
@@ -101,8 +111,18 @@ def plotly_ts_ma(ss=None, title='missing', color='yellow', dd=None, start_date=N
         iplot(fig, filename=title)
 
 
-def plotly_ds_uniques(df, date_col, title, start_date, color, size, online, pr='D', ma=7):
-    dd = df.set_index(date_col)['2009':].resample(pr)['userId'].nunique().to_frame(title).reset_index()
+def plotly_ds_uniques(df, date_col, title, start_date, color, size, online, pr='D', ma=7, sketches=None):
+    """Plots the number of unique users per period. Given sketches, daily sketches of the users (see
+    build_unique_user_sketches), they're estimated by merging those into one per period instead, and df isn't
+    read."""
+    if sketches is None:
+        dd = df.set_index(date_col)['2009':].resample(pr)['userId'].nunique().to_frame(title).reset_index()
+    else:
+        sketches = sketches[sketches['day'] >= '2009']
+        # labelled as resample labels periods: the day for days, the last day for weeks and months
+        periods = sketches['day'].dt.to_period(pr).dt.end_time.dt.floor('D').rename(date_col)
+        dd = (estimate_distinct(merge_sketches(sketches, periods), date_col)
+              .resample(pr).sum().to_frame(title).reset_index())
     plotly_ts_ma(dd=dd, date_col=date_col, title=title, start_date=start_date, color=color, size=size,
                  online=online, pr=pr, ma=ma)
 
@@ -136,8 +156,38 @@ def get_valid_non_self_votes(dfv, dfp, dfc, dfu):
     return b[~b['self_vote']]
 
 
+def get_valid_users(dfu):
+    return dfu[(~dfu['banned'])&(~dfu['deleted'])&(dfu['num_distinct_posts_viewed']>=5)]
+
+
+@timed
+def build_unique_user_sketches(dfs, precision):
+    """
+    Sketches the users the unique user charts count each day (see plotly_ds_uniques): valid users viewing posts and
+    voters. Built once when the snapshot is (see etlw.download_and_enrich) and saved with it, so the charts don't
+    go through views or votes.
+
+    Returns a dict of dataframes of sketches by day, keyed by UNIQUE_USER_SKETCHES.
+    """
+
+    dpv = dfs['views']
+    logged_in_views = dpv[dpv['userId'].isin(get_valid_users(dfs['users'])['_id'])]
+    valid_votes = get_valid_non_self_votes(dfs['votes'], dfs['posts'], dfs['comments'], dfs['users'])
+
+    return {
+        'logged_in_user_sketches': build_sketches(logged_in_views['createdAt'].dt.floor('D').rename('day'),
+                                                  logged_in_views['userId'], precision),
+        'voter_sketches': build_sketches(valid_votes['votedAt'].dt.floor('D').rename('day'), valid_votes['userId'],
+                                         precision)
+    }
+
+
 @timed
-def run_plotline(dfs, online=False, start_date=None, size=(1000, 400), pr='D', ma=7):
+def run_plotline(dfs, online=False, start_date=None, size=(1000, 400), pr='D', ma=7, sketch_error=None):
+    """
+    With sketch_error, the unique user charts are estimated from the daily sketches saved with the snapshot when it
+    has them (see build_unique_user_sketches), rather than counted from all views and votes.
+    """
 
     plotly.tools.set_credentials_file(username=get_config_field('PLOTLY', 'username'),
                                       api_key=get_config_field('PLOTLY', 'api_key'))
@@ -149,14 +199,20 @@ def run_plotline(dfs, online=False, start_date=None, size=(1000, 400), pr='D', m
     dfv = dfs['votes']
     dpv = dfs['views']  # pv = post-views
 
-    valid_users = dfu[(~dfu['banned'])&(~dfu['deleted'])&(dfu['num_distinct_posts_viewed']>=5)]
+    valid_users = get_valid_users(dfu)
     valid_posts = dfp[(dfp[['smallUpvote', 'bigUpvote']].sum(axis=1) >= 2)&~dfp['draft']&~dfp['legacySpam']]
     valid_comments = dfc[dfc['userId']!='pgoCXxuzpkPXADTp2'] #remove GPT-2
     valid_votes = get_valid_non_self_votes(dfv,dfp, dfc, dfu)
 
-    # logged-in users
-    plotly_ds_uniques(dpv[dpv['userId'].isin(valid_users['_id'])], date_col='createdAt', title='Num Logged-In Users',
-                      start_date=start_date, online=online, size=size, color='black', pr=pr, ma=ma)
+    sketches = {name: dfs.get(name) if sketch_error is not None else None for name in UNIQUE_USER_SKETCHES}
+
+    # logged-in users, whose views aren't needed if they're sketched
+    logged_in_views = None
+    if sketches['logged_in_user_sketches'] is None:
+        logged_in_views = dpv[dpv['userId'].isin(valid_users['_id'])]
+    plotly_ds_uniques(logged_in_views, date_col='createdAt', title='Num Logged-In Users',
+                      start_date=start_date, online=online, size=size, color='black', pr=pr, ma=ma,
+                      sketches=sketches['logged_in_user_sketches'])
     # posts
     plotly_ts_ma(valid_posts, 'Num Posts with 2+ upvotes', 'blue', start_date=start_date, online=online, size=size, pr=pr, ma=ma)
     # comments
@@ -174,6 +230,7 @@ def run_plotline(dfs, online=False, start_date=None, size=(1000, 400), pr='D', m
 
     # unique voters
     plotly_ds_uniques(valid_votes, 'votedAt', title='Num Unique Voters', start_date=start_date,
-                            size=size, color='darkorange', online=online, pr=pr, ma=ma)
+                            size=size, color='darkorange', online=online, pr=pr, ma=ma,
+                            sketches=sketches['voter_sketches'])
 
     plot_table(downvote_monitoring(dfv, dfp, dfc, dfu, 2, ), title='Downvote Monitoring', online=online)
@@ -6,7 +6,7 @@ def downvote_monitoring(dfv, dfp, dfc, dfu, num_days, num_rows=5):
 
     data = dfv[~dfv['cancelled']].set_index('votedAt').sort_index()[n_days_ago:]
 
-    document_votes = data.groupby([data['documentId'], data['power'] < 0]).size().unstack(1).fillna(0)
+    document_votes = data.groupby([data['documentId'], data['power'] < 0], observed=True).size().unstack(1).fillna(0)
     document_votes['total'] = document_votes.sum(axis=1)
     document_votes.columns = ['upvote', 'downvote', 'total_votes']
 
@@ -16,7 +16,7 @@ def downvote_monitoring(dfv, dfp, dfc, dfu, num_days, num_rows=5):
     b['userId'] = b['userId_x'].fillna(b['userId_y'])
     c = b[['documentId', 'upvote', 'downvote', 'total_votes', 'userId']]
 
-    d = c.groupby('userId')[['upvote', 'downvote', 'total_votes']].sum().sort_values('total_votes', ascending=False)
+    d = c.groupby('userId', observed=True)[['upvote', 'downvote', 'total_votes']].sum().sort_values('total_votes', ascending=False)
     e = d.merge(dfu[['_id', 'username']], left_index=True, right_on='_id', how='left')
 
     # e[['_id', 'username', 'upvote', 'downvote', 'total_votes']].sort_values('upvote', ascending=False).head(3)
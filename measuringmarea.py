@@ -8,6 +8,9 @@ from utils import get_config_field
 
 post_id_regex = r"/posts/(\w+)/"
 
+# enriched columns the metric reads (see etlw.get_snapshot): none, it only reads downloaded posts and views columns
+EA_METRIC_COLUMNS = {'posts': [], 'views': []}
+
 
 def get_id_from_link(link):
     matches = re.finditer(post_id_regex, link, re.MULTILINE)
@@ -0,0 +1,300 @@
+import pandas as pd
+
+# Columns downloaded for each collection and the dtype each is stored as, in download order. dtypes are pandas dtype
+# names plus 'id' for Mongo ids, which are interned as categoricals sharing one id dictionary (see etlw.intern_ids).
+# Fields that documents can lack are nullable ints (Int32), which keep them missing. Missing values in non-nullable
+# int and bool columns are filled with 0/False. 'object' columns (free text, lists, dicts) are left as they come.
+COLLECTION_SCHEMAS = {
+    'posts': {
+        'af': 'bool',
+        '_id': 'id',
+        'userId': 'id',
+        'title': 'object',
+        'postedAt': 'datetime64[ns]',
+        'excerpt': 'object',
+        # 'contents': 'object', #not using at present, is large.
+        'baseScore': 'Int32',
+        'afBaseScore': 'Int32',
+        'score': 'float64',  # the ranking score, exported at full precision
+        'viewCount': 'Int32',
+        'clickCount': 'Int32',
+        'commentCount': 'Int32',
+        'wordCount': 'Int32',
+        'commenters': 'object',
+        'createdAt': 'datetime64[ns]',
+        'frontpageDate': 'datetime64[ns]',
+        'curatedDate': 'datetime64[ns]',
+        'draft': 'bool',
+        'url': 'object',
+        'slug': 'object',
+        'legacy': 'bool',
+        'question': 'bool',
+        'userAgent': 'object',
+        'canonicalCollectionSlug': 'category',
+        # 'moderationGuidelinesHtmlBody': 'object',
+        # 'deleted': 'bool', #there's only a single post with this flag, remove so as make sampling posts not fail
+        'legacySpam': 'bool',
+        'isEvent': 'bool',
+        'plaintextExcerpt': 'object',
+        'website': 'object',
+        'authorIsUnreviewed': 'bool',
+        'status': 'category'
+    },
+    'comments': {
+        '_id': 'id',
+        'af': 'bool',
+        'userId': 'id',
+        'postId': 'id',
+        'postedAt': 'datetime64[ns]',
+        'createdAt': 'datetime64[ns]',
+        'baseScore': 'Int32',
+        'afBaseScore': 'Int32',
+        'score': 'float64',  # the ranking score, exported at full precision
+        'deleted': 'bool',
+        'parentCommentId': 'id',
+        'legacy': 'bool',
+        'draft': 'bool',
+        'answer': 'bool',
+        'parentAnswerId': 'id',
+        'userAgent': 'object',
+        'wordCount': 'Int32',
+        # 'contents': 'object'
+    },
+    'users': {
+        '_id': 'id',
+        'username': 'object',
+        'displayName': 'object',
+        'createdAt': 'datetime64[ns]',
+        'postCount': 'Int32',
+        'commentCount': 'Int32',
+        'frontpagePostCount': 'Int32',
+        'karma': 'Int32',
+        'legacyKarma': 'Int32',
+        'bio': 'object',
+        'deleted': 'bool',
+        'banned': 'bool',
+        'email': 'object',
+        'legacy': 'bool',
+        'afKarma': 'Int32',
+        'moderationGuidelinesHtmlBody': 'object',
+        'subscribers': 'object',
+        'shortformFeedId': 'object',
+        'signUpReCaptchaRating': 'float64',
+        'reviewedByUserId': 'object'
+    },
+    'votes': {
+        'afPower': 'int8',
+        'collectionName': 'category',
+        'documentId': 'id',
+        'legacy': 'bool',
+        'power': 'int8',
+        'userId': 'id',
+        'voteType': 'category',
+        'votedAt': 'datetime64[ns]',
+        'cancelled': 'bool',
+        'isUnvote': 'bool'
+    },
+    'views': {
+        'userId': 'id',
+        'documentId': 'id',
+        'createdAt': 'datetime64[ns]',
+        # 'name': 'category', #only ever contains "post-view"
+        # 'legacy': 'bool', #never use it, but want to remember it's there
+        # 'important': 'object',
+        # 'intercom': 'object',
+    },
+    'logins': {
+        '_id': 'object',  # not joined on, so not worth interning
+        'userId': 'id',
+        'properties': 'object',
+        'createdAt': 'datetime64[ns]',
+        'schema': 'object'
+    }
+}
+
+INTERNED_ID_COLUMNS = {coll_name: [col for col, dtype in schema.items() if dtype == 'id']
+                       for coll_name, schema in COLLECTION_SCHEMAS.items()}
+ID_COLUMN_NAMES = set(col for cols in INTERNED_ID_COLUMNS.values() for col in cols)
+
+# datetime columns added by enrichment, on top of the downloaded ones
+ENRICHED_DATETIME_COLUMNS = ['startTime', 'endTime', 'earliest_comment', 'most_recent_comment', 'earliest_vote',
+                             'most_recent_vote', 'most_recent_post', 'earliest_post', 'most_recent_activity',
+                             'earliest_activity', 'true_earliest', 'curatedAt', 'earliest_view', 'most_recent_view']
+DATETIME_COLUMNS = sorted(set([col for schema in COLLECTION_SCHEMAS.values()
+                               for col, dtype in schema.items() if dtype == 'datetime64[ns]'] +
+                              ENRICHED_DATETIME_COLUMNS))
+
+# columns of the enriched collections exported to postgres, in table column order
+EXPORT_COLUMNS = {
+    'users': [
+        '_id',
+        'username',
+        'displayName',
+        'createdAt',
+        'postCount',
+        'commentCount',
+        'karma',
+        'afKarma',
+        'legacyKarma',
+        'deleted',
+        'banned',
+        'legacy',
+        'shortformFeedId',
+        'signUpReCaptchaRating',
+        'reviewedByUserId',
+        'earliest_activity',
+        'true_earliest',
+        'most_recent_activity',
+        'days_since_active',
+        'total_posts',
+        'earliest_post',
+        'most_recent_post',
+        'num_drafts',
+        'percent_drafts',
+        'total_comments',
+        'earliest_comment',
+        'most_recent_comment',
+        'total_votes',
+        'most_recent_vote',
+        'earliest_vote',
+        'percent_downvotes',
+        'percent_upvotes_big',
+        'most_recent_view',
+        'earliest_view',
+        'num_distinct_posts_viewed',
+        'num_days_present_last_30_days',
+        'num_posts_last_30_days',
+        'num_comments_last_30_days',
+        'num_votes_last_30_days',
+        'num_views_last_30_days',
+        'num_distinct_posts_viewed_last_30_days',
+        'num_posts_last_180_days',
+        'num_comments_last_180_days',
+        'num_votes_last_180_days',
+        'num_views_last_180_days',
+        'num_distinct_posts_viewed_last_180_days',
+        'bio',
+        'email'
+    ],
+    'posts': [
+        '_id',
+        'userId',
+        'postedAt',
+        'username',
+        'title',
+        'baseScore',
+        'afBaseScore',
+        'score',
+        'draft',
+        'question',
+        'isEvent',
+        'viewCount',
+        'viewCountLogged',
+        'clickCount',
+        'commentCount',
+        'num_distinct_viewers',
+        'num_distinct_commenters',
+        'wordCount',
+        'smallUpvote',
+        'bigUpvote',
+        'smallDownvote',
+        'bigDownvote',
+        'percent_downvotes',
+        'url',
+        'slug',
+        'canonicalCollectionSlug',
+        'website',
+        'gw',
+        'frontpaged',
+        'frontpageDate',
+        'curatedDate',
+        'moderationGuidelinesHtmlBody',
+        'status',
+        'legacySpam',
+        'authorIsUnreviewed',
+        'most_recent_comment',
+        'userAgent',
+    ],
+    'comments': [
+        '_id',
+        'userId',
+        'username',
+        'postId',
+        'postedAt',
+        'baseScore',
+        'score',
+        'answer',
+        'parentAnswerId',
+        'wordCount',
+        'top_level',
+        'gw',
+        'num_votes',
+        'percent_downvotes',
+        'smallUpvote',
+        'bigUpvote',
+        'smallDownvote',
+        'bigDownvote',
+        'userAgent',
+        'createdAt'
+    ]
+}
+
+
+def get_columns(coll_name):
+    """Returns the list of columns downloaded for a collection."""
+    return list(COLLECTION_SCHEMAS[coll_name])
+
+
+def cast_column(series, dtype):
+    """Casts a series to a schema dtype (see COLLECTION_SCHEMAS)."""
+
+    if dtype in ('id', 'object'):
+        return series
+    if dtype == 'datetime64[ns]':
+        return pd.to_datetime(series)
+    if dtype == 'bool':
+        return series.fillna(False).astype(bool)
+    if dtype.startswith('int'):
+        return series.fillna(0).astype(dtype)
+    if dtype.startswith('Int') and series.dtype == object:
+        series = series.astype(float)  # nullable ints can't be cast to from python objects directly
+    if dtype == 'category' and pd.api.types.is_float_dtype(series):
+        series = series.astype('Int64')  # so integer codes like status stay integers rather than 2.0
+    return series.astype(dtype)
+
+
+def cast_to_schema(df, coll_name, add_missing=True):
+    """
+    Casts the columns of a collection's dataframe to the dtypes in its schema. Columns that already have the right
+    dtype are left alone, so this is cheap on dataframes that were cast before (e.g. loaded from a snapshot).
+
+    add_missing adds schema columns missing from df as all-missing columns. When only a few documents are pulled,
+    some fields aren't present in any of them.
+
+    Modifies df in place and returns it.
+    """
+
+    for col, dtype in COLLECTION_SCHEMAS[coll_name].items():
+        if col not in df.columns:
+            if not add_missing:
+                continue
+            df[col] = pd.Series(index=df.index, dtype=object)
+        if dtype in ('id', 'object') or str(df[col].dtype) == dtype:
+            continue
+        df[col] = cast_column(df[col], dtype)
+
+    return df
+
+
+def is_nullable_int(series):
+    return pd.api.types.is_extension_array_dtype(series) and pd.api.types.is_integer_dtype(series)
+
+
+def decode_dtypes(df):
+    """
+    Turns the compact dtypes used in memory back into plain object columns, for output (sheets, csv) that needs
+    plain values: categoricals (interned ids included) become their values and nullable ints become ints and NaN.
+    """
+
+    cols = [col for col in df.columns if pd.api.types.is_categorical_dtype(df[col]) or is_nullable_int(df[col])]
+    return df.assign(**{col: df[col].astype(object) for col in cols})
@@ -0,0 +1,137 @@
+"""
+HyperLogLog sketches for approximate distinct counts (Flajolet et al., 2007).
+
+A sketch is a set of 2^precision registers, each holding the highest rank (position of the first 1 bit) of the hashes
+of the values falling in it. Sketches are dense: a group's registers are one uint8 array, kept as bytes in a
+dataframe with a row per group (e.g. per day, or per post and day), which is how they're saved with snapshots. That's
+2^precision bytes per group however many values it has, so they pay off for few groups with many values each (e.g.
+the users active each day), and many small groups are sketched at a lower precision (see build_sketches). Merging
+sketches is taking the highest rank per register, so e.g. daily sketches merge into a sketch of any window of days.
+"""
+import numpy as np
+import pandas as pd
+
+SKETCH_ERROR = 0.01  # default relative standard error of estimates
+
+
+def get_precision(error=SKETCH_ERROR):
+    """Returns the smallest precision (number of register index bits) whose standard error 1.04 / sqrt(2^precision)
+    is at most error, between 4 and 18."""
+    return int(np.clip(np.ceil(np.log2((1.04 / error) ** 2)), 4, 18))
+
+
+def get_bit_lengths(values):
+    """Returns the number of bits needed to write each of an array of uint64 values (0 for 0)."""
+
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype='int8')
+    for shift in [32, 16, 8, 4, 2, 1]:
+        is_long = values >= np.uint64(1 << shift)
+        lengths[is_long] += shift
+        values[is_long] >>= np.uint64(shift)
+
+    return lengths + (values > 0)
+
+
+def get_registers(sketches):
+    """Returns the registers of sketches as a (number of sketches, 2^precision) uint8 array."""
+    if sketches.shape[0] == 0:
+        return np.zeros((0, 0), dtype='uint8')
+    return np.frombuffer(b''.join(sketches['registers']), dtype='uint8').reshape(sketches.shape[0], -1)
+
+
+def to_sketches(registers, groups):
+    """Returns a dataframe of sketches from their registers (see get_registers) and groups (a named index or
+    multi-index, one per row), with a column per level of groups."""
+    return groups.to_frame(index=False).assign(registers=[row.tobytes() for row in registers])
+
+
+def factorize_groups(groups):
+    """Returns the code of each row's group in groups (a named series, or a dataframe with a column per label, e.g.
+    documentId and day), -1 if any of its labels is missing, and the groups, sorted, as an index."""
+
+    if isinstance(groups, pd.Series):
+        codes, labels = pd.factorize(groups.values, sort=True)
+        return codes, pd.Index(labels, name=groups.name)
+
+    level_codes, levels = zip(*[pd.factorize(groups[col].values, sort=True) for col in groups.columns])
+    level_codes = np.array(level_codes, dtype='int64').reshape(len(levels), -1)
+    shape = [len(level) for level in levels]
+    is_labelled = (level_codes >= 0).all(axis=0)
+    codes = np.full(groups.shape[0], -1, dtype='int64')
+    combined, codes[is_labelled] = np.unique(np.ravel_multi_index(level_codes[:, is_labelled], shape),
+                                             return_inverse=True)
+
+    return codes, pd.MultiIndex(levels=[pd.Index(level) for level in levels],
+                                codes=np.unravel_index(combined, shape), names=list(groups.columns))
+
+
+def build_sketches(groups, values, precision, max_bytes=None):
+    """
+    Sketches the distinct values (a series, e.g. userId) of each group, given by a named series of labels or a
+    dataframe of them (e.g. documentId and day) positionally aligned with values. Missing values aren't counted and
+    rows with a missing label dropped, as with nunique.
+
+    With max_bytes, precision is lowered (down to 4) until the registers of all the groups take at most that much.
+
+    Returns a dataframe with a row per group, sorted: its labels and its registers.
+    """
+
+    is_value = values.notnull().values
+    codes, labels = factorize_groups(groups[is_value])
+    if max_bytes is not None and len(labels) > 0:
+        precision = int(np.clip(np.floor(np.log2(max_bytes / len(labels))), 4, precision))
+    hashes = pd.util.hash_pandas_object(values[is_value], index=False).values
+    rest_bits = 64 - precision
+    ranks = rest_bits + 1 - get_bit_lengths(hashes & np.uint64((1 << rest_bits) - 1))
+
+    num_registers = 2 ** precision
+    cells = codes[codes >= 0].astype('int64') * num_registers + (hashes[codes >= 0] >> np.uint64(rest_bits)).astype(
+        'int64')
+    highest = pd.Series(ranks[codes >= 0]).groupby(cells).max()
+
+    registers = np.zeros((len(labels), num_registers), dtype='uint8')
+    registers.ravel()[highest.index.values] = highest.values
+
+    return to_sketches(registers, labels)
+
+
+def merge_sketches(sketches, by):
+    """
+    Merges the sketches of all rows with the same by (a named series of labels aligned with the rows, e.g. the week
+    of each daily sketch). Rows whose label is missing are dropped.
+
+    Returns a dataframe of sketches with a row per label, sorted.
+    """
+
+    codes, labels = pd.factorize(by.values if isinstance(by, pd.Series) else np.asarray(by), sort=True)
+    registers = get_registers(sketches)[codes >= 0]
+    codes = codes[codes >= 0]
+    if len(codes) == 0:
+        return to_sketches(registers, pd.Index(labels, name=by.name))
+
+    order = np.argsort(codes, kind='mergesort')
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    return to_sketches(np.maximum.reduceat(registers[order], starts, axis=0),
+                       pd.Index(labels[np.unique(codes)], name=by.name))
+
+
+def estimate_distinct(sketches, key):
+    """
+    Estimates the number of distinct values of each sketch. Small counts, where many registers are still empty, are
+    estimated by linear counting.
+
+    Returns an int series indexed by the sketches' key column.
+    """
+
+    registers = get_registers(sketches)
+    num_registers = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / max(num_registers, 1))
+
+    empty = (registers == 0).sum(axis=1)
+    raw = alpha * num_registers ** 2 / np.ldexp(1.0, -registers.astype('int64')).sum(axis=1)
+    with np.errstate(divide='ignore'):
+        linear = num_registers * np.log(num_registers / np.where(empty > 0, empty, np.nan))
+    estimates = np.where((raw > 2.5 * num_registers) | (empty == 0), raw, linear)
+
+    return pd.Series(np.round(estimates).astype(int), index=pd.Index(sketches[key], name=key))
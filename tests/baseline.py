@@ -0,0 +1,325 @@
+"""
+The enrichment and karma metric functions as they were before the vectorised, incremental, parallel and out-of-core
+paths replaced them (the repository's first commit), copied unchanged, for the tests and benchmarks to check the new
+paths against. They run on collections as that version cleaned them: plain string ids (see schema.decode_dtypes).
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from utils import timed
+
+
+def calculate_vote_stats_for_content(votes_df):
+    """Accepts dataframe on votes, aggregates to document level and returns stats.
+
+    Returns stats about kinds of votes placed (small/big,up/down) and when last vote was made.
+    """
+
+    votes_df['voteType'] = votes_df['voteType'].astype(str)
+
+    vote_type_stats = votes_df.groupby(['documentId', 'voteType']).size().unstack(level='voteType').fillna(0).astype(
+        int)
+
+    for col in ['smallUpvote', 'smallDownvote', 'bigUpvote', 'bigDownvote']:
+        if col not in vote_type_stats.columns:
+            vote_type_stats[col] = 0
+
+    vote_type_stats['num_votes'] = vote_type_stats.sum(axis=1)
+    vote_type_stats['percent_downvotes'] = (
+            vote_type_stats[['smallDownvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
+    vote_type_stats['percent_bigvotes'] = (
+            vote_type_stats[['bigUpvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
+    vote_date_stats = votes_df.groupby('documentId').apply(
+        lambda x: pd.Series(data={'most_recent_vote': x['votedAt'].max()}))
+
+    vote_stats = vote_type_stats.merge(vote_date_stats, left_index=True, right_index=True)
+
+    return vote_stats
+
+
+def calculate_vote_stats_for_users(votes_df):
+    """Accepts dataframe on votes, aggregates to users and returns stats for users.
+
+    Returns stats about kinds of votes placed (small/big,up/down) and when last and earliest votes were made.
+    """
+
+    votes_df['voteType'] = votes_df['voteType'].astype(str)
+
+    vote_date_stats = votes_df.groupby('userId').apply(lambda x: pd.Series(data={ 'most_recent_vote': x['votedAt'].max(),
+                                                                                 'earliest_vote': x['votedAt'].min()}))
+
+    vote_type_stats = votes_df.groupby(['userId', 'voteType']).size().unstack(level='voteType').fillna(0).astype(int)
+    for col in ['smallUpvote', 'smallDownvote', 'bigUpvote', 'bigDownvote']:
+        if col not in vote_type_stats.columns:
+            vote_type_stats[col] = 0
+
+    vote_type_stats['num_votes'] = vote_type_stats.sum(axis=1)
+
+    vote_type_stats['percent_downvotes'] = (
+            vote_type_stats[['smallDownvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
+    vote_type_stats['percent_bigvotes'] = (
+            vote_type_stats[['bigUpvote', 'bigDownvote']].sum(axis=1) / vote_type_stats['num_votes']).round(2)
+
+    vote_stats = vote_date_stats.merge(vote_type_stats, left_index=True, right_index=True)
+
+    return vote_stats
+
+
+def calc_user_view_stats(views_df):
+    view_date_stats = views_df.groupby('userId')['createdAt'].agg(
+        {'num_views': 'count', 'most_recent_view': 'max', 'earliest_view': 'min'})
+    view_post_stats = views_df.groupby('userId')['documentId'].nunique().to_frame('num_distinct_posts_viewed')
+
+    views_df['date'] = views_df['createdAt'].dt.date
+    views_last_30 = views_df[views_df['createdAt'] >= views_df['createdAt'].max() - pd.Timedelta(30 - 1, unit='d')]
+    view_presence_stats = views_last_30.groupby('userId')['date'].nunique().to_frame('num_days_present_last_30_days')
+    view_presence_stats['num_days_present_last_30_days'] = view_presence_stats['num_days_present_last_30_days'].fillna(
+        0)
+
+    view_stats = (
+        view_date_stats
+            .merge(view_post_stats, left_index=True, right_index=True, how='outer')
+            .merge(view_presence_stats, left_index=True, right_index=True, how='outer')
+    )
+
+    return view_stats
+
+
+def calc_user_comment_stats(comments):  # df -> df
+    """Calculates aggregates statistics over a user's comments."""
+
+    comment_stats = comments.groupby('userId')['postedAt'].agg({'total_comments': 'size',
+                                                                'earliest_comment': 'min',
+                                                                'most_recent_comment': 'max'})
+
+    return comment_stats
+
+
+def calc_user_post_stats(posts):  # df -> df
+    """Calculates aggregate statistics over a user's posts."""
+
+    # currently comment out all word character related stuff due to mess.
+    # dfp['characters'] = dfp['body'].str.len()
+    # dfp['words'] = (dfp['characters']/6).round(2)
+    # dfp.loc[dfp['body'].str.contains('image/png|image/jpeg') == True, 'characters'] = np.nan
+
+    # dfp['frontpageDate'] = dfp['frontpageDate'].replace(0, np.nan) # this should *not* be necessary. Remember to track it upstream.
+    posts['frontpaged'] = posts['frontpageDate'].notnull()
+    postsByUser = posts[~posts['draft']].groupby('userId')
+
+    post_date_stats = postsByUser['postedAt'].agg(
+        {'total_posts': 'size', 'earliest_post': 'min', 'most_recent_post': 'max'})
+    post_draft_stats = postsByUser['draft'].agg({'num_drafts': 'sum', 'percent_drafts': 'mean'})
+    post_frontpage_stats = postsByUser['frontpaged'].sum().to_frame('num_frontpage_posts')
+
+    post_stats = (
+        post_date_stats
+            .merge(post_draft_stats, left_index=True, right_index=True)
+            .merge(post_frontpage_stats, left_index=True, right_index=True)
+    )
+
+    return post_stats
+
+
+def calc_user_recent_activity(posts, comments, votes, views, present_date):
+    def activity_last_n(n, date):
+        # could be made to contain another function called repeatedly, but it's fine. It works.
+
+        n_days_ago = date - pd.to_timedelta(n, 'days')
+
+        comments_ln = comments[(comments['postedAt'] > n_days_ago)].groupby('userId').size().to_frame(
+            'num_comments_last_{}_days'.format(n))
+        posts_ln = posts[(posts['postedAt'] > n_days_ago) & (~posts['draft'])].groupby('userId').size().to_frame(
+            'num_posts_last_{}_days'.format(n))
+        votes_ln = votes[(votes['votedAt'] > n_days_ago)].groupby('userId').size().to_frame(
+            'num_votes_last_{}_days'.format(n))
+        views_ln = views[(views['createdAt'] > n_days_ago)].groupby('userId').size().to_frame(
+            'num_views_last_{}_days'.format(n))
+        distinct_posts_viewed_ln = views[(views['createdAt'] > n_days_ago)].groupby('userId')[
+            'documentId'].nunique().to_frame('num_distinct_posts_viewed_last_{}_days'.format(n))
+
+        ln_stats = (
+            posts_ln
+                .merge(comments_ln, left_index=True, right_index=True, how='outer')
+                .merge(votes_ln, left_index=True, right_index=True, how='outer')
+                .merge(views_ln, left_index=True, right_index=True, how='outer')
+                .merge(distinct_posts_viewed_ln, left_index=True, right_index=True, how='outer')
+
+        )
+
+        return ln_stats
+
+    recent_activity = (activity_last_n(30, present_date).merge(activity_last_n(180, present_date),
+                                                               left_index=True, right_index=True, how='outer')
+                       ).fillna(0).astype(int)
+
+    return recent_activity
+
+
+def enrich_posts(colls_dfs):
+    users = colls_dfs['users']
+    posts = colls_dfs['posts']
+    comments = colls_dfs['comments']
+    views = colls_dfs['views']
+    votes = colls_dfs['votes']
+
+    def num_commenters(commenters_list):
+        if commenters_list == commenters_list:  # check for isnan, works since nan == nan is false
+            if type(commenters_list) == str:
+                return len(
+                    [u.replace("'", '').replace('"', '').strip() for u in commenters_list.strip('[]').split(',')])
+            else:
+                return len(commenters_list)
+        else:
+            return 0
+
+    # comment stats
+    comment_stats = comments.groupby('postId').apply(lambda x: pd.Series(data={
+        'num_comments_rederived': x['_id'].nunique(),
+        'most_recent_comment': x['postedAt'].max()
+    }))
+
+    # vote stats for post
+    vote_stats = calculate_vote_stats_for_content(votes)
+
+    # view stats for post
+    view_date_stats = views.groupby('documentId').apply(lambda x: pd.Series(data={
+        'most_recent_view_logged': x['createdAt'].max(),
+        'viewCountLogged': x.shape[0]
+    }))
+    view_distinct_viewers = views.groupby('documentId')['userId'].nunique().to_frame('num_distinct_viewers')
+    view_stats = view_date_stats.merge(view_distinct_viewers, left_index=True, right_index=True, how='left')
+
+    posts = (posts
+             .merge(comment_stats, left_on='_id', right_index=True, how='left')
+             .merge(vote_stats, left_on='_id', right_index=True, how='left')
+             .merge(view_stats, left_on='_id', right_index=True, how='left')
+             )
+
+    # recent activity stats
+    recent_activity_cols = ['most_recent_vote', 'most_recent_view_logged', 'most_recent_comment']
+    for col in recent_activity_cols:
+        posts[col] = pd.to_datetime(posts[col])
+    posts['most_recent_activity'] = posts[recent_activity_cols].max(axis=1)
+
+    # further column additions
+
+    # dfp['frontpageDate'] = dfp['frontpageDate'].replace(0, np.nan) #shouldn't be necessary, track upstream
+    posts['frontpaged'] = posts['frontpageDate'].notnull()
+    posts['num_distinct_commenters'] = posts['commenters'].apply(num_commenters)
+    posts['gw'] = posts['userAgent'].astype(str).str.contains('drakma', case=False).fillna(False)
+
+    posts = users.set_index('_id')[['username', 'displayName']].merge(posts, left_index=True, right_on='userId',
+                                                                      how='right')  # add username to posts cols
+
+    return posts
+
+
+def enrich_comments(colls_dfs):  # dict(df) -> df
+    """Add extra data to comments dataframe."""
+
+    users = colls_dfs['users']
+    comments = colls_dfs['comments']
+    votes = colls_dfs['votes']
+
+    vote_stats = calculate_vote_stats_for_content(votes)
+    comments = comments.merge(vote_stats, left_on='_id', right_index=True, how='left')
+
+    comments['top_level'] = comments['parentCommentId'].isnull()
+    comments['gw'] = comments['userAgent'].astype(str).str.contains('drakma', case=False)
+    comments = users.set_index('_id')[['username', 'displayName']].merge(comments, left_index=True,
+                                                                         right_on='userId')  # add username to comments collection
+
+    return comments
+
+
+def enrich_users(colls_dfs, date_str):
+    """Takes in many dataframes and return one super-enriched users dataframe."""
+
+    users = colls_dfs['users']
+    posts = colls_dfs['posts']
+    comments = colls_dfs['comments']
+    views = colls_dfs['views']
+    votes = colls_dfs['votes']
+
+    date = datetime.datetime.strptime(date_str, '%Y-%m-%d')
+
+    post_stats = calc_user_post_stats(posts)
+    comment_stats = calc_user_comment_stats(comments)
+    vote_stats = calculate_vote_stats_for_users(votes)
+    view_stats = calc_user_view_stats(views)
+    recent_activity = calc_user_recent_activity(posts, comments, votes, views, date)
+
+    users = (users
+             .merge(post_stats, left_on='_id', right_index=True, how='left')
+             .merge(comment_stats, left_on='_id', right_index=True, how='left')
+             .merge(vote_stats, left_on='_id', right_index=True, how='left')
+             .merge(view_stats, left_on='_id', right_index=True, how='left')
+             .merge(recent_activity, left_on='_id', right_index=True, how='left')
+             )
+
+    users['earliest_activity'] = users[['earliest_post', 'earliest_comment', 'earliest_vote', 'earliest_view']].min(
+        axis=1)
+    users['true_earliest'] = users[['earliest_activity', 'createdAt']].min(axis=1)
+    users['most_recent_activity'] = users[
+        ['most_recent_post', 'most_recent_comment', 'most_recent_vote', 'most_recent_view', 'createdAt']].max(axis=1)
+    users['days_since_active'] = (date - users['most_recent_activity']).dt.days
+
+    return users
+
+
+@timed
+def enrich_collections(colls_dfs, date_str):  # dict[str:df] -> dict[str:df]
+    """Single function for collectively enriching all collection dataframes.
+
+    Input: dictionary of basic-parsed collection dataframes.
+    Output: dictionary of enriched (fully processed) collection dataframe.
+
+    """
+
+    enriched_dfs = {
+        'users': enrich_users(colls_dfs, date_str=date_str),
+        'posts': enrich_posts(colls_dfs),
+        'comments': enrich_comments(colls_dfs),
+        'votes': colls_dfs['votes'],
+        'views': colls_dfs['views']
+    }
+
+    return enriched_dfs
+
+
+def run_incremental_vote_algorithm(votes):
+    def fancy_power(x, power):
+        return np.sign(x) * np.abs(x) ** power
+
+    baseScoresD4 = {}
+    docScores = {}
+    voteEffects = {}
+
+    for vote in votes.itertuples(index=False, name='Vote'):
+        oldScore = fancy_power(baseScoresD4.get(vote.documentId, 0), 1.2)
+        newScore = fancy_power(baseScoresD4.get(vote.documentId, 0) + vote.power_d4, 1.2)
+        voteEffects[vote.voteId] = newScore - oldScore
+
+        baseScoresD4[vote.documentId] = baseScoresD4.get(vote.documentId, 0) + vote.power_d4
+        docScores[vote.documentId] = newScore
+
+    return baseScoresD4, docScores, voteEffects
+
+
+def agg_votes_to_period(dfvv, pr='D', start_date='2019-06'):
+    pr_dict = {'D': 'day', 'W': 'week'}
+
+    post_cols = ['_id', 'postedAt', 'username', 'title', 'baseScore', 'num_votes', 'percent_downvotes',
+                 'num_distinct_viewers']
+    comment_cols = ['_id', 'postId', 'postedAt', 'username', 'baseScore', 'num_votes', 'percent_downvotes']
+
+    d = dfvv.set_index('votedAt').sort_index()[start_date:].groupby(['collectionName', 'documentId']).resample(pr).agg(
+        {'power_d4': 'sum', 'effect': 'sum', 'legacy': 'size', 'downvote': 'mean'}
+    ).round(1).reset_index()
+    d = d.rename(
+        columns={'legacy': 'num_votes_{}'.format(pr_dict[pr]), 'downvote': 'percent_downvotes_{}'.format(pr_dict[pr])})
+    d = d[d['power_d4'] != 0]  # introduced by resampling function
+    return d
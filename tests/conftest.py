@@ -0,0 +1,18 @@
+import pathlib
+import sys
+
+import pytest
+
+# the modules live at the repository root, which isn't a package
+sys.path.insert(0, str(pathlib.Path(__file__).absolute().parent.parent))
+
+
+@pytest.fixture
+def mongo_db(monkeypatch):
+    """An in-memory MongoDB database (mongomock) that etlw downloads from instead of the real one."""
+    mongomock = pytest.importorskip('mongomock')
+    import etlw
+
+    db = mongomock.MongoClient()['lesswrong']
+    monkeypatch.setattr(etlw, 'get_mongo_db_object', lambda: db)
+    return db
@@ -0,0 +1,48 @@
+"""Synthetic LessWrong documents, as MongoDB holds them, for the tests that download from a fake database."""
+import datetime
+import random
+
+VOTE_POWERS = {'smallUpvote': 1, 'smallDownvote': -1, 'bigUpvote': 5, 'bigDownvote': -5}
+START = datetime.datetime(2020, 1, 1)
+
+
+def insert_documents(db, num_users=20, num_posts=15, num_comments=60, num_votes=600, num_views=1000, start=START,
+                     days=180, seed=0):
+    """Inserts users, posts, comments, votes, post-views and logins with random times over days from start, and
+    returns the inserted documents of each collection."""
+
+    rng = random.Random(seed)
+
+    def ids(prefix, num):
+        return ['{}{}{:05d}'.format(prefix, seed, i) for i in range(num)]
+
+    def time():
+        return start + datetime.timedelta(seconds=rng.randint(0, days * 86400))
+
+    users = [dict(_id=user_id, username='name{}'.format(user_id), displayName=user_id, createdAt=time(),
+                  karma=rng.randint(0, 500), deleted=False, banned=False, legacy=False)
+             for user_id in ids('u', num_users)]
+    posts = [dict(_id=post_id, userId=rng.choice(users)['_id'], title=post_id, postedAt=time(), createdAt=time(),
+                  baseScore=rng.randint(0, 100), draft=rng.random() < 0.1, status=2, authorIsUnreviewed=False,
+                  viewCount=rng.randint(0, 100)) for post_id in ids('p', num_posts)]
+    comments = [dict(_id=comment_id, userId=rng.choice(users)['_id'], postId=rng.choice(posts)['_id'],
+                     postedAt=time(), createdAt=time(), baseScore=rng.randint(-3, 30), deleted=rng.random() < 0.05)
+                for comment_id in ids('c', num_comments)]
+    votes = []
+    for vote_id in ids('v', num_votes):
+        document, vote_type = rng.choice(posts + comments), rng.choice(list(VOTE_POWERS))
+        votes.append(dict(_id=vote_id, documentId=document['_id'],
+                          collectionName='Posts' if 'title' in document else 'Comments',
+                          userId=rng.choice(users)['_id'], voteType=vote_type, power=VOTE_POWERS[vote_type],
+                          afPower=0, votedAt=time(), cancelled=False, legacy=False, isUnvote=False))
+    views = [dict(_id=view_id, name='post-view', userId=rng.choice(users)['_id'], documentId=rng.choice(posts)['_id'],
+                  createdAt=time()) for view_id in ids('e', num_views)]
+    logins = [dict(_id=login_id, name='login', userId=rng.choice(users)['_id'], createdAt=time(), properties={})
+              for login_id in ids('l', 50)]
+
+    for coll_name, documents in [('users', users), ('posts', posts), ('comments', comments), ('votes', votes),
+                                 ('lwevents', views + logins)]:
+        if documents:
+            db[coll_name].insert_many(documents)
+
+    return {'users': users, 'posts': posts, 'comments': comments, 'votes': votes, 'views': views}
@@ -0,0 +1,241 @@
+"""
+Checks the enrichment paths (in memory, in a process pool, for some columns, incremental and out of core) and the
+karma metric against the functions they replaced (see baseline), on small synthetic collections.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import baseline
+import etlw
+from karmametric import (DOWNVOTE_MULTIPLIER, KARMA_EXPONENT, agg_votes_to_period, build_karma_cube,
+                         run_metric_pipeline, run_vote_algorithm, sweep_karma_metric)
+from schema import cast_to_schema, decode_dtypes
+from sketches import get_precision
+
+VOTE_POWERS = {'smallUpvote': 1, 'smallDownvote': -1, 'bigUpvote': 5, 'bigDownvote': -5}
+DATE_STR = '2020-07-01'
+
+
+def make_collections(num_users=40, num_posts=30, num_comments=120, num_votes=1500, num_views=3000, seed=0):
+    """
+    Returns cleaned users, posts, comments, votes and views with plain string ids, as downloaded and cast to their
+    schemas. Posts' commenters are the users who commented on them, as LessWrong keeps them.
+    """
+
+    rng = np.random.RandomState(seed)
+
+    def ids(prefix, num):
+        return ['{}{:05d}'.format(prefix, i) for i in range(num)]
+
+    def times(num):
+        return pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.randint(0, 180 * 86400, num), unit='s')
+
+    user_ids, post_ids, comment_ids = ids('user', num_users), ids('post', num_posts), ids('comment', num_comments)
+    users = pd.DataFrame({
+        '_id': user_ids,
+        'username': ['name{}'.format(i) for i in range(num_users)],
+        'displayName': ['Name {}'.format(i) for i in range(num_users)],
+        'createdAt': times(num_users),
+        'karma': rng.randint(0, 1000, num_users)
+    })
+    comments = pd.DataFrame({
+        '_id': comment_ids,
+        'userId': rng.choice(user_ids, num_comments),
+        'postId': rng.choice(post_ids, num_comments),
+        'postedAt': times(num_comments),
+        'deleted': rng.rand(num_comments) < 0.05,
+        'parentCommentId': pd.Series(rng.choice(comment_ids, num_comments)).where(rng.rand(num_comments) < 0.5),
+        'userAgent': rng.choice(['Mozilla/5.0', 'Drakma/2.0'], num_comments)
+    })
+    commenters = comments.groupby('postId')['userId'].unique().map(list)
+    posts = pd.DataFrame({
+        '_id': post_ids,
+        'userId': rng.choice(user_ids, num_posts),
+        'postedAt': times(num_posts),
+        'draft': rng.rand(num_posts) < 0.1,
+        'frontpageDate': pd.Series(times(num_posts)).where(rng.rand(num_posts) < 0.3),
+        'commenters': [commenters.get(post_id, np.nan) for post_id in post_ids],
+        'userAgent': rng.choice(['Mozilla/5.0', 'Drakma/2.0'], num_posts),
+        'status': 2
+    })
+    documents = rng.randint(0, num_posts + num_comments, num_votes)
+    vote_types = rng.choice(list(VOTE_POWERS), num_votes)
+    votes = pd.DataFrame({
+        'collectionName': np.where(documents < num_posts, 'Posts', 'Comments'),
+        'documentId': np.array(post_ids + comment_ids, dtype=object)[documents] if num_votes else [],
+        'power': [VOTE_POWERS[vote_type] for vote_type in vote_types],
+        'userId': rng.choice(user_ids, num_votes),
+        'voteType': vote_types,
+        'votedAt': times(num_votes)
+    })
+    views = pd.DataFrame({
+        'userId': rng.choice(user_ids, num_views),
+        'documentId': rng.choice(post_ids, num_views),
+        'createdAt': times(num_views)
+    })
+
+    return {coll_name: cast_to_schema(df, coll_name) for coll_name, df in
+            [('users', users), ('posts', posts), ('comments', comments), ('votes', votes), ('views', views)]}
+
+
+COLLECTIONS = {
+    'synthetic': lambda: make_collections(),
+    'no_events': lambda: make_collections(num_votes=0, num_views=0),
+    'single_document': lambda: make_collections(num_users=1, num_posts=1, num_comments=1, num_votes=5, num_views=5)
+}
+
+
+@pytest.fixture(params=list(COLLECTIONS))
+def collections(request):
+    return COLLECTIONS[request.param]()
+
+
+def interned(colls_dfs):
+    return etlw.intern_ids(colls_dfs, id_dictionary=pd.Index([], dtype=object))
+
+
+def enrich_baseline(colls_dfs):
+    """Enriches copies of colls_dfs with the baseline functions, or returns None if they can't enrich them."""
+    try:
+        return baseline.enrich_collections({coll_name: decode_dtypes(df.copy()) for coll_name, df in colls_dfs.items()},
+                                           DATE_STR)
+    except (KeyError, ValueError, TypeError):  # e.g. no votes to aggregate
+        return None
+
+
+def assert_same_values(result, expected, columns=None):
+    """Checks the enriched users, posts and comments of result have the values of those of expected (rows matched
+    on _id), in expected's columns or those given (collection -> column names). Missing values compare equal, numbers
+    up to rounding."""
+
+    for coll_name in ['users', 'posts', 'comments']:
+        left = decode_dtypes(result[coll_name]).set_index('_id').sort_index()
+        right = decode_dtypes(expected[coll_name]).set_index('_id').sort_index()
+        assert list(left.index) == list(right.index), coll_name
+        for col in right.columns if columns is None else columns.get(coll_name, []):
+            if pd.api.types.is_numeric_dtype(left[col]) and pd.api.types.is_numeric_dtype(right[col]):
+                np.testing.assert_allclose(left[col].astype(float), right[col].astype(float),
+                                           err_msg='{}.{}'.format(coll_name, col))
+            else:
+                same = (left[col] == right[col]) | (left[col].isnull() & right[col].isnull())
+                assert same.all(), '{}.{}'.format(coll_name, col)
+
+
+def assert_enrichment_matches_baseline(result, colls_dfs, columns=None):
+    """Checks result against the baseline enrichment of colls_dfs, or, where the baseline can't enrich them (no
+    votes or views), that it has a row per document and no event statistics."""
+
+    expected = enrich_baseline(colls_dfs)
+    if expected is not None:
+        assert_same_values(result, expected, columns)
+        return
+
+    assert result['users'].shape[0] == colls_dfs['users'].shape[0]
+    assert result['posts'].shape[0] == colls_dfs['posts'].shape[0]
+    for coll_name, col in [('users', 'num_votes'), ('users', 'num_views'), ('posts', 'num_votes'),
+                           ('posts', 'viewCountLogged'), ('comments', 'num_votes')]:
+        if col in result[coll_name]:
+            assert result[coll_name][col].fillna(0).eq(0).all(), '{}.{}'.format(coll_name, col)
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_enrichment_matches_baseline(collections, processes):
+    result = etlw.enrich_collections(interned(collections), DATE_STR, processes=processes)
+    assert_enrichment_matches_baseline(result, collections)
+
+
+def test_enrichment_of_some_columns_matches_baseline(collections):
+    columns = {'users': ['num_votes', 'most_recent_view', 'num_views_last_30_days'],
+               'posts': ['num_votes', 'num_distinct_viewers'], 'comments': ['percent_downvotes']}
+    result = etlw.enrich_collections(interned(collections), DATE_STR, columns=columns)
+    assert_enrichment_matches_baseline(result, collections, columns)
+
+
+def test_incremental_enrichment_matches_baseline(collections, tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    # the first run aggregates the events from scratch, the second folds in those since (and a cancelled vote)
+    earlier = dict(collections, votes=collections['votes'].iloc[:-50], views=collections['views'].iloc[:-50])
+    etlw.enrich_collections_incremental(interned(earlier), DATE_STR)
+    later = dict(collections, votes=collections['votes'].iloc[1:])
+
+    result = etlw.enrich_collections_incremental(interned(later), DATE_STR)
+    assert_enrichment_matches_baseline(result, later)
+
+
+def test_out_of_core_enrichment_matches_baseline(collections, tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    monkeypatch.setattr(etlw, 'SNAPSHOT_ROW_GROUP_SIZE', 100)
+    colls_dfs = interned(collections)
+    etlw.write_collections({coll_name: colls_dfs.pop(coll_name) for coll_name in ['votes', 'views']}, DATE_STR)
+    etlw.write_id_dictionary(etlw.get_id_dtype(colls_dfs).categories, DATE_STR)
+
+    result = etlw.enrich_collections_out_of_core(colls_dfs, DATE_STR, memory_budget_mb=0.01)
+    assert_enrichment_matches_baseline(result, collections)
+
+
+def test_sketched_view_stats_match_baseline(collections):
+    colls_dfs = interned(collections)
+    colls_dfs.update(etlw.get_view_stats_sketched(colls_dfs['views'], DATE_STR, get_precision(0.01)))
+    result = etlw.enrich_collections(colls_dfs, DATE_STR)
+
+    # counts this small are estimated exactly
+    assert_enrichment_matches_baseline(result, collections)
+
+
+def get_karma_votes(colls_dfs):
+    """Votes with the columns the karma metric adds, in time order, as filtered_and_enriched_votes leaves them."""
+    votes = colls_dfs['votes'].sort_values('votedAt', kind='mergesort').reset_index(drop=True)
+    return votes.assign(downvote=votes['power'] < 0,
+                        power_d4=votes['power'].where(votes['power'] >= 0, votes['power'] * 4))
+
+
+def test_vote_algorithm_matches_baseline(collections):
+    votes = get_karma_votes(interned(collections))
+    base_scores, scores, effects = run_vote_algorithm(votes)
+
+    expected_base_scores, expected_scores, expected_effects = baseline.run_incremental_vote_algorithm(
+        decode_dtypes(votes).assign(voteId=np.arange(votes.shape[0])))
+    assert {document: total for document, total in base_scores.items()} == expected_base_scores
+    assert {document: score for document, score in scores.items()} == pytest.approx(expected_scores)
+    assert list(effects) == pytest.approx([expected_effects[vote_id] for vote_id in range(votes.shape[0])])
+
+
+def test_sweep_matches_baseline(collections):
+    votes = get_karma_votes(interned(collections))
+    swept = sweep_karma_metric(votes, [(1.2, 4)])
+
+    vote_effects = baseline.run_incremental_vote_algorithm(
+        decode_dtypes(votes).assign(voteId=np.arange(votes.shape[0])))[2]
+    expected = pd.Series(vote_effects, dtype=float).groupby(votes['votedAt'].dt.floor('D').values).sum()
+    assert list(swept['votedAt']) == list(expected.index)
+    assert list(swept['effect']) == pytest.approx(list(expected))
+
+
+def test_metric_pipeline_sweep_matches_cube(collections):
+    frames = run_metric_pipeline(interned(collections), variants=[(KARMA_EXPONENT, DOWNVOTE_MULTIPLIER), (1, 1)])
+    swept = frames['karma_sweep']
+
+    # the metric as configured is the one the cube holds
+    expected = frames['karma_cube'].groupby('votedAt')['effect'].sum()
+    current = swept[(swept['exponent'] == KARMA_EXPONENT) & (swept['downvote_multiplier'] == DOWNVOTE_MULTIPLIER)]
+    assert list(current['votedAt']) == list(expected.index)
+    assert list(current['effect']) == pytest.approx(list(expected))
+
+
+@pytest.mark.parametrize('pr', ['D', 'W'])
+def test_period_aggregation_matches_baseline(collections, pr):
+    colls_dfs = interned(collections)
+    votes = get_karma_votes(colls_dfs)
+    votes['effect'] = run_vote_algorithm(votes)[2]
+    cube = build_karma_cube(votes, colls_dfs['posts'], colls_dfs['comments'])
+
+    result = decode_dtypes(agg_votes_to_period(cube, pr, start_date='2020-01'))
+    if votes.shape[0] == 0:
+        assert result.shape[0] == 0
+        return
+    expected = baseline.agg_votes_to_period(decode_dtypes(votes), pr, start_date='2020-01')
+    keys = ['collectionName', 'documentId', 'votedAt']
+    pd.testing.assert_frame_equal(result.sort_values(keys).reset_index(drop=True)[list(expected.columns)],
+                                  decode_dtypes(expected).sort_values(keys).reset_index(drop=True),
+                                  check_dtype=False)
@@ -0,0 +1,97 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+import etlw
+from lwdocuments import insert_documents
+from schema import decode_dtypes
+
+COLL_NAMES = ('comments', 'views', 'votes', 'posts', 'users')
+
+
+def make_votes(rows):
+    """Votes (or unvotes) from (documentId, userId, voteType, votedAt) rows."""
+    return pd.DataFrame(rows, columns=['documentId', 'userId', 'voteType', 'votedAt']).assign(
+        votedAt=lambda df: pd.to_datetime(df['votedAt']))
+
+
+def test_unvote_removes_earlier_votes_only():
+    votes = make_votes([('d1', 'u1', 'smallUpvote', '2020-01-01'),  # cancelled
+                        ('d1', 'u1', 'smallUpvote', '2020-01-03'),  # voted again after the unvote
+                        ('d1', 'u1', 'bigUpvote', '2020-01-01'),  # another type
+                        ('d2', 'u1', 'smallUpvote', '2020-01-01')])  # another document
+    unvotes = make_votes([('d1', 'u1', 'smallUpvote', '2020-01-02')])
+
+    kept = etlw.remove_unvoted(votes, unvotes)
+    assert list(kept.index) == [1, 2, 3]
+
+
+def test_upsert_replaces_matching_ids_and_appends_the_rest():
+    snapshot = pd.DataFrame({'_id': ['a', 'b'], 'baseScore': [1, 2]})
+    updates = pd.DataFrame({'_id': ['b', 'c'], 'baseScore': [20, 3]})
+
+    result = etlw.upsert_documents(snapshot, updates)
+    assert result.sort_values('_id')['baseScore'].tolist() == [1, 20, 3]
+    assert etlw.upsert_documents(None, updates) is updates
+
+
+def test_touched_ids_follow_new_events():
+    new_docs = {
+        'votes': pd.DataFrame({'documentId': ['p1', 'c1'], 'collectionName': ['Posts', 'Comments']}),
+        'comments': pd.DataFrame({'_id': ['c2'], 'postId': ['p2'], 'userId': ['u2']}),
+        'views': pd.DataFrame({'documentId': ['p3']}),
+        'posts': pd.DataFrame({'_id': [], 'userId': []})
+    }
+    snapshots = {'posts': pd.DataFrame({'_id': ['p1'], 'userId': ['u1']}),
+                 'comments': pd.DataFrame({'_id': ['c1'], 'userId': ['u3']})}
+
+    assert etlw.get_touched_ids('posts', new_docs, snapshots) == {'p1', 'p2', 'p3'}
+    assert etlw.get_touched_ids('comments', new_docs, snapshots) == {'c1'}
+    assert etlw.get_touched_ids('users', new_docs, snapshots) == {'u1', 'u2', 'u3'}
+
+
+def assert_same_collections(result, expected):
+    for coll_name in COLL_NAMES:
+        left = decode_dtypes(result[coll_name]).sort_values('_id').reset_index(drop=True)
+        right = decode_dtypes(expected[coll_name]).sort_values('_id').reset_index(drop=True)
+        pd.testing.assert_frame_equal(left, right[left.columns], check_dtype=False, obj=coll_name)
+
+
+@pytest.mark.parametrize('reconcile', ['full', 'touched'])
+def test_incremental_download_matches_full_download(mongo_db, tmp_path, monkeypatch, reconcile):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    documents = insert_documents(mongo_db)
+    etlw.get_collections_incremental(COLL_NAMES, reconcile=reconcile, partitions=2)
+    watermark = max(vote['votedAt'] for vote in documents['votes'])
+
+    # within the overlap re-read before the watermark: a vote already downloaded and a late one that wasn't
+    mongo_db.votes.update_one({'_id': documents['votes'][0]['_id']},
+                              {'$set': {'votedAt': watermark - datetime.timedelta(minutes=10)}})
+    late_vote = dict(documents['votes'][1], _id='late', votedAt=watermark - datetime.timedelta(minutes=5))
+    # a vote cancelled by an unvote, then cast again
+    vote = documents['votes'][2]
+    mongo_db.votes.update_one({'_id': vote['_id']}, {'$set': {'cancelled': True}})
+    unvote = dict(vote, _id='unvote', votedAt=watermark + datetime.timedelta(hours=1), cancelled=True, isUnvote=True)
+    revote = dict(vote, _id='revote', votedAt=watermark + datetime.timedelta(hours=2))
+    mongo_db.votes.insert_many([late_vote, unvote, revote])
+    # and new documents of every collection
+    insert_documents(mongo_db, num_users=2, num_posts=2, num_comments=5, num_votes=50, num_views=50,
+                     start=watermark + datetime.timedelta(hours=3), days=10, seed=1)
+
+    result = etlw.get_collections_incremental(COLL_NAMES, reconcile=reconcile, partitions=2)
+    assert result['votes']['_id'].is_unique and result['views']['_id'].is_unique
+    assert {'late', 'revote'} <= set(result['votes']['_id']) and vote['_id'] not in set(result['votes']['_id'])
+    assert_same_collections(result, etlw.get_collections_cleaned(COLL_NAMES, interned=False))
+
+
+def test_full_reconcile_refreshes_documents_without_new_events(mongo_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    documents = insert_documents(mongo_db)
+    etlw.get_collections_incremental(COLL_NAMES)
+
+    mongo_db.users.update_one({'_id': documents['users'][0]['_id']}, {'$set': {'banned': True}})
+    mongo_db.posts.update_one({'_id': documents['posts'][0]['_id']}, {'$set': {'draft': True}})
+
+    result = etlw.get_collections_incremental(COLL_NAMES)
+    assert_same_collections(result, etlw.get_collections_cleaned(COLL_NAMES, interned=False))
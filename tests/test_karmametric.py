@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import etlw
+import karmametric
+from karmametric import get_period_labels, roll_up_karma_cube, run_vote_algorithm, sweep_karma_metric
+from schema import decode_dtypes
+
+
+def make_cube(categories):
+    """A karma cube of two documents with the same votes, their ids interned with categories in the given order."""
+    return pd.DataFrame({
+        'documentId': pd.Categorical(['b', 'a', 'b', 'a'], categories=categories),
+        'votedAt': pd.to_datetime(['2020-01-01', '2020-01-01', '2020-01-02', '2020-01-02']),
+        'power_d4': [1, 1, 2, 2],
+        'effect': [1.0, 1.0, 2.0, 2.0],
+        'num_votes': [1, 1, 1, 1],
+        'num_downvotes': [0, 0, 0, 0]
+    })
+
+
+def test_roll_up_order_does_not_depend_on_id_codes():
+    rolled = [decode_dtypes(roll_up_karma_cube(make_cube(categories), ['documentId']))
+              for categories in (['a', 'b'], ['b', 'a'])]
+
+    pd.testing.assert_frame_equal(rolled[0], rolled[1])
+    assert list(rolled[0]['documentId']) == ['a', 'a', 'b', 'b']
+
+
+def make_votes(num_votes=2000, seed=0):
+    rng = np.random.RandomState(seed)
+    votes = pd.DataFrame({
+        'documentId': pd.Series(rng.randint(0, 30, num_votes)).map('doc{}'.format),
+        'power': rng.choice([1, -1, 2, -2, 5, -5], num_votes),
+        'votedAt': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.randint(0, 90 * 86400, num_votes), unit='s')
+    }).sort_values('votedAt', kind='mergesort').reset_index(drop=True)
+    votes.loc[votes.index[-3:], 'votedAt'] = pd.NaT  # sorted last, as votes without a time are
+    return votes
+
+
+def test_sweep_matches_summed_vote_effects():
+    votes = make_votes()
+    variants = [(1, 1), (1.2, 4), (1.5, 8)]
+
+    for pr in ['D', 'W', 'M']:
+        swept = sweep_karma_metric(votes, variants, pr).set_index(['exponent', 'downvote_multiplier', 'votedAt'])
+        for exponent, multiplier in variants:
+            power_d4 = votes['power'].where(votes['power'] >= 0, votes['power'] * multiplier)
+            effects = run_vote_algorithm(votes.assign(power_d4=power_d4), exponent)[2]
+            expected = pd.Series(effects).groupby(get_period_labels(votes['votedAt'], pr).values).sum()
+            assert np.allclose(swept.loc[(exponent, multiplier), 'effect'].values, expected.values)
+
+
+def test_sweep_of_no_votes_is_empty():
+    assert sweep_karma_metric(make_votes().iloc[:0], [(1.2, 4)]).shape[0] == 0
+
+
+def make_keyed_votes(num_votes=2000, seed=0):
+    """Filtered votes as filtered_and_enriched_votes leaves them, with the columns that identify them across runs."""
+    rng = np.random.RandomState(seed)
+    power = rng.choice([1, -1, 2, -2], num_votes)
+    return pd.DataFrame({
+        'documentId': pd.Series(rng.randint(0, 40, num_votes)).map('doc{}'.format),
+        'userId': pd.Series(rng.randint(0, 50, num_votes)).map('user{}'.format),
+        'voteType': np.where(np.abs(power) > 1, 'big', 'small'),
+        'votedAt': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.randint(0, 90 * 86400, num_votes), unit='s'),
+        'power_d4': np.where(power < 0, power * 4, power)
+    }).sort_values('votedAt', kind='mergesort').reset_index(drop=True)
+
+
+def sort_votes(votes):
+    return votes.sort_values('votedAt', kind='mergesort').reset_index(drop=True)
+
+
+def assert_resumed_matches_replay(votes):
+    base_scores, _, effects = karmametric.run_vote_algorithm_resumed(votes)
+    expected_base_scores, _, expected_effects = run_vote_algorithm(votes)
+
+    assert np.allclose(effects, expected_effects)
+    pd.testing.assert_series_equal(base_scores, expected_base_scores, check_names=False)
+
+
+def checkpoint_until(votes, watermark='2020-03-01'):
+    """Runs the resumed algorithm on the votes before watermark, leaving its checkpoint, and returns all votes."""
+    karmametric.run_vote_algorithm_resumed(votes[votes['votedAt'] < pd.Timestamp(watermark)])
+    return votes
+
+
+@pytest.fixture
+def checkpointed_votes(tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    return checkpoint_until(make_keyed_votes())
+
+
+def test_resumed_with_new_votes_matches_replay(checkpointed_votes):
+    assert_resumed_matches_replay(checkpointed_votes)
+    assert_resumed_matches_replay(checkpointed_votes)  # and again with no new votes
+
+
+def test_resumed_with_late_votes_matches_replay(checkpointed_votes):
+    late = make_keyed_votes(50, seed=1)
+    assert_resumed_matches_replay(sort_votes(pd.concat([checkpointed_votes, late], ignore_index=True)))
+
+
+def test_resumed_with_cancelled_votes_matches_replay(checkpointed_votes):
+    assert_resumed_matches_replay(checkpointed_votes.drop(index=[3, 500, 1000]).reset_index(drop=True))
+
+
+def test_resumed_with_changed_exclusions_matches_replay(checkpointed_votes):
+    excluded = checkpointed_votes['userId'].isin(['user1', 'user2']) | (checkpointed_votes['documentId'] == 'doc3')
+    assert_resumed_matches_replay(checkpointed_votes[~excluded].reset_index(drop=True))
+
+
+def test_resumed_with_duplicated_keys_matches_replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    votes = make_keyed_votes()
+    # already duplicated at the checkpoint, so the document's number and checksum of votes still match
+    votes = checkpoint_until(sort_votes(pd.concat([votes, votes.iloc[[10, 700]]], ignore_index=True)))
+    assert_resumed_matches_replay(votes)
+
+
+def test_resumed_with_key_missing_from_checkpoint_matches_replay(checkpointed_votes):
+    # as if a vote's key had collided with another's: the document's counts match, but the key isn't there
+    checkpoint = karmametric.load_karma_checkpoint()
+    checkpoint['effects'] = checkpoint['effects'].drop(karmametric.get_vote_keys(checkpointed_votes.iloc[[5]]))
+    karmametric.save_karma_checkpoint(checkpoint)
+
+    assert_resumed_matches_replay(checkpointed_votes)
@@ -0,0 +1,43 @@
+import pandas as pd
+
+from etlw import get_partition_edges
+
+MS = pd.Timedelta(1, unit='ms')
+
+
+def assert_covers(edges, lower, upper):
+    """Checks edges are increasing ranges that together hold every millisecond from lower to upper."""
+    assert len(edges) >= 2
+    assert all(start < end for start, end in zip(edges[:-1], edges[1:]))
+    assert edges[0] <= pd.Timestamp(lower) and edges[-1] > pd.Timestamp(upper)
+
+
+def test_equal_width_ranges():
+    lower, upper = pd.Timestamp('2020-01-01'), pd.Timestamp('2020-01-09')
+    edges = get_partition_edges(lower, upper, 8)
+    assert_covers(edges, lower, upper)
+    assert edges[:-1] == list(pd.date_range(lower, periods=8, freq='D'))
+    assert edges[-1] == upper + MS
+
+
+def test_lower_equals_upper():
+    # e.g. a single new view since the watermark
+    instant = pd.Timestamp('2020-01-01 12:00:00.124567')
+    edges = get_partition_edges(instant, instant, 8)
+    assert edges == [pd.Timestamp('2020-01-01 12:00:00.124'), pd.Timestamp('2020-01-01 12:00:00.125')]
+
+
+def test_range_narrower_than_partitions():
+    lower = pd.Timestamp('2020-01-01 12:00:00.124')
+    upper = lower + 3 * MS
+    edges = get_partition_edges(lower, upper, 10)
+    assert_covers(edges, lower, upper)
+    # the last range takes upper's millisecond in with the one before it
+    assert edges == [lower, lower + MS, lower + 2 * MS, upper + MS]
+
+
+def test_sub_millisecond_range():
+    lower = pd.Timestamp('2020-01-01 12:00:00.124100')
+    upper = pd.Timestamp('2020-01-01 12:00:00.124900')
+    edges = get_partition_edges(lower, upper, 4)
+    assert edges == [lower.floor('ms'), lower.floor('ms') + MS]
@@ -0,0 +1,29 @@
+import datetime
+
+import pandas as pd
+
+import etlw
+from lwdocuments import insert_documents
+from schema import decode_dtypes
+
+
+def assert_same_enrichment(result, expected):
+    for coll_name in ['users', 'posts', 'comments']:
+        left = decode_dtypes(result[coll_name]).sort_values('_id').reset_index(drop=True)
+        right = decode_dtypes(expected[coll_name]).sort_values('_id').reset_index(drop=True)
+        pd.testing.assert_frame_equal(left, right[left.columns], check_dtype=False, obj=coll_name)
+
+
+def test_pushed_down_view_stats_match_downloaded_views(mongo_db, tmp_path, monkeypatch):
+    """Enrichment with the view statistics computed by MongoDB's pipelines, including the windowed distinct
+    counts, is the same as with them computed from the downloaded views."""
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    documents = insert_documents(mongo_db)
+    # views without a user (logged out readers) count towards posts' views but not any user's
+    mongo_db.lwevents.insert_one(dict(documents['views'][0], _id='anonymous', userId=None,
+                                      createdAt=documents['views'][0]['createdAt'] + datetime.timedelta(hours=1)))
+
+    today, pushed_down = etlw.download_and_enrich(pushdown=True)
+    expected_today, expected = etlw.download_and_enrich()
+    assert today == expected_today
+    assert_same_enrichment(pushed_down, expected)
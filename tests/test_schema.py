@@ -0,0 +1,28 @@
+import pandas as pd
+
+from schema import cast_to_schema, decode_dtypes
+
+
+def test_cast_keeps_score_precision():
+    posts = cast_to_schema(pd.DataFrame({'score': [0.123456789012345, None]}), 'posts')
+    assert posts['score'].dtype == 'float64'
+    assert posts['score'].iloc[0] == 0.123456789012345
+
+
+def test_missing_columns_added():
+    votes = cast_to_schema(pd.DataFrame({'power': [1, -1]}), 'votes')
+    assert votes['power'].dtype == 'int8'
+    assert not votes['cancelled'].any() and votes['votedAt'].isnull().all()
+
+
+def test_decode_dtypes():
+    posts = cast_to_schema(pd.DataFrame({'baseScore': [3, None]}), 'posts')
+    decoded = decode_dtypes(posts[['baseScore']])
+    assert decoded['baseScore'].iloc[0] == 3 and pd.isnull(decoded['baseScore'].iloc[1])
+
+
+def test_absent_counts_stay_missing():
+    users = cast_to_schema(pd.DataFrame({'karma': [12, None], 'signUpReCaptchaRating': [0.123456789012345, None]}),
+                           'users')
+    assert users['karma'].dtype == 'Int32' and users['karma'].isnull().tolist() == [False, True]
+    assert users['signUpReCaptchaRating'].iloc[0] == 0.123456789012345
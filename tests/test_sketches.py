@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from sketches import build_sketches, estimate_distinct, get_precision, get_registers, merge_sketches
+
+
+def make_events(num_events=200000, num_users=20000, num_days=30, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'day': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.randint(0, num_days, num_events), unit='D'),
+        'userId': pd.Series(rng.randint(0, num_users, num_events)).map('user{}'.format)
+    })
+
+
+def test_estimates_within_error():
+    events = make_events()
+    precision = get_precision(0.01)
+    sketches = build_sketches(events['day'], events['userId'], precision)
+
+    assert get_registers(sketches).shape == (30, 2 ** precision)
+    exact = events.groupby('day')['userId'].nunique()
+    estimated = estimate_distinct(sketches, 'day')
+    assert (estimated.index == exact.index).all()
+    assert (np.abs(estimated / exact - 1) < 0.05).all()
+
+
+def test_merged_sketches_estimate_union():
+    events = make_events()
+    precision = get_precision(0.01)
+    daily = build_sketches(events['day'], events['userId'], precision)
+
+    weeks = daily['day'].dt.to_period('W').dt.end_time.dt.floor('D').rename('week')
+    estimated = estimate_distinct(merge_sketches(daily, weeks), 'week')
+    exact = events.groupby(events['day'].dt.to_period('W').dt.end_time.dt.floor('D'))['userId'].nunique()
+    assert list(estimated.index) == list(exact.index)
+    assert (np.abs(estimated.values / exact.values - 1) < 0.05).all()
+
+    # merging is the same as sketching the union directly
+    union = build_sketches(pd.Series(0, index=events.index, name='all'), events['userId'], precision)
+    merged = merge_sketches(daily, pd.Series(0, index=daily.index, name='all'))
+    assert np.array_equal(get_registers(merged), get_registers(union))
+
+
+def test_small_and_missing():
+    groups = pd.Series(['a', 'a', 'a', 'b', None], name='group')
+    values = pd.Series(['x', 'y', None, 'x', 'z'])
+    estimated = estimate_distinct(build_sketches(groups, values, get_precision(0.05)), 'group')
+    assert estimated.to_dict() == {'a': 2, 'b': 1}
+
+    empty = build_sketches(groups[:0], values[:0], 8)
+    assert empty.shape[0] == 0 and estimate_distinct(empty, 'group').empty
+
+
+def test_sketches_per_group_and_day():
+    events = make_events(num_users=2000).assign(documentId=lambda df: df['userId'].str.len().map('post{}'.format))
+    sketches = build_sketches(events[['documentId', 'day']], events['userId'], get_precision(0.01))
+    assert list(sketches.columns) == ['documentId', 'day', 'registers']
+
+    estimated = estimate_distinct(merge_sketches(sketches, sketches['documentId']), 'documentId')
+    exact = events.groupby('documentId')['userId'].nunique()
+    assert list(estimated.index) == list(exact.index)
+    assert (np.abs(estimated / exact - 1) < 0.05).all()
+
+
+def test_precision_lowered_to_fit():
+    events = make_events()
+    sketches = build_sketches(events['day'], events['userId'], 14, max_bytes=30 * 2 ** 10)
+    assert get_registers(sketches).shape == (30, 2 ** 10)
+    assert build_sketches(events['day'], events['userId'], 14, max_bytes=1).shape[0] == 30  # but not below 4
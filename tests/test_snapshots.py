@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import etlw
+from etlw import get_statistics_bounds, row_group_may_match, read_parquet_filtered
+
+Statistics = namedtuple('Statistics', ['has_min_max', 'min', 'max', 'logical_type'])
+
+
+def write_votes(path, row_group_size=10):
+    votes = pd.DataFrame({'votedAt': pd.date_range('2020-01-01', periods=50, freq='D'), 'power': range(50)})
+    pq.write_table(pa.Table.from_pandas(votes, preserve_index=False), path, row_group_size=row_group_size)
+    return votes
+
+
+def test_timestamp_statistics_prune_row_groups(tmp_path):
+    path = str(tmp_path / 'votes.parquet')
+    write_votes(path)
+    metadata = pq.ParquetFile(path).metadata
+
+    may_match = [row_group_may_match(metadata.row_group(i), [('votedAt', '>=', pd.Timestamp('2020-02-01'))])
+                 for i in range(metadata.num_row_groups)]
+    assert may_match == [False, False, False, True, True]
+
+
+def test_int_timestamp_statistics():
+    logical_type = 'Timestamp(isAdjustedToUTC=false, timeUnit=nanoseconds, is_from_converted_type=false)'
+    start, end = pd.Timestamp('2020-01-01'), pd.Timestamp('2020-01-02')
+    assert get_statistics_bounds(Statistics(True, start.value, end.value, logical_type)) == [start, end]
+    assert get_statistics_bounds(Statistics(False, None, None, logical_type)) is None
+
+
+def test_read_parquet_filtered(tmp_path):
+    path = str(tmp_path / 'votes.parquet')
+    votes = write_votes(path)
+
+    result = read_parquet_filtered(path, columns=['power'], filters=[('votedAt', '>=', '2020-02-01'),
+                                                                     ('power', '<', 40)])
+    expected = votes.loc[(votes['votedAt'] >= '2020-02-01') & (votes['power'] < 40), ['power']]
+    pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
+
+
+def test_added_collection_is_listed_after_it_is_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    users = pd.DataFrame({'username': ['a', 'b']})
+    etlw.write_collection('users', users, '2020-01-01')
+    etlw.save_snapshot_metadata('2020-01-01', None, ['users'], pd.Timestamp('2020-01-02'),
+                                columns={'users': ['username']})
+
+    cube = pd.DataFrame({'votedAt': pd.to_datetime(['2020-01-01']), 'effect': [1.5]})
+    etlw.add_to_snapshot('karma_cube', cube, '2020-01-01')
+
+    metadata = etlw.load_snapshot_metadata('2020-01-01')
+    assert metadata['collections'] == ['users', 'karma_cube']
+    assert metadata['columns'] == {'users': ['username'], 'karma_cube': ['votedAt', 'effect']}
+    assert metadata['created'] == pd.Timestamp('2020-01-02')
+    pd.testing.assert_frame_equal(etlw.load_from_file('2020-01-01', ['karma_cube'])['karma_cube'], cube)
+
+
+def test_only_mapped_collections_get_an_arrow_copy(tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    for date_str in ['2020-01-01', '2020-01-02', '2020-01-03']:
+        etlw.write_collections({'users': pd.DataFrame({'username': ['a']}),
+                                'votes': pd.DataFrame({'votedAt': pd.to_datetime(['2020-01-01']), 'power': [1]})},
+                               date_str)
+    assert sorted(path.name for path in (tmp_path / 'processed' / '2020-01-03').iterdir()) == [
+        'users.parquet', 'votes.arrow', 'votes.parquet']
+
+    etlw.clean_up_old_files(days_to_keep=2)
+    snapshots = [path.name for path in (tmp_path / 'processed').iterdir() if path.is_dir()]
+    assert sorted(snapshots) == ['2020-01-02', '2020-01-03']
+    assert not (tmp_path / 'processed' / '2020-01-02' / 'votes.arrow').exists()
+    assert (tmp_path / 'processed' / '2020-01-03' / 'votes.arrow').exists()
+    # the older snapshot's votes are read from parquet instead
+    assert etlw.load_from_file('2020-01-02', ['votes'])['votes']['power'].tolist() == [1]
+
+
+@pytest.fixture
+def snapshot_store(tmp_path, monkeypatch):
+    """An empty snapshot directory and cache, and a stand-in for download_and_enrich that counts its calls."""
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    monkeypatch.setattr(etlw, 'snapshot_cache', {})
+    downloads = []
+
+    def download_and_enrich(**kwargs):
+        time.sleep(0.2)  # long enough for another pipeline to ask for the snapshot meanwhile
+        downloads.append(kwargs)
+        return '2020-01-0{}'.format(len(downloads)), {'users': pd.DataFrame({'username': ['a', 'b']})}
+
+    monkeypatch.setattr(etlw, 'download_and_enrich', download_and_enrich)
+    return downloads
+
+
+def get_users_snapshot(max_age=etlw.SNAPSHOT_MAX_AGE):
+    return etlw.get_snapshot(coll_names=('users',), columns={'users': ['username']}, max_age=max_age)
+
+
+def test_snapshot_is_reused_within_max_age(snapshot_store):
+    date_str, dfs = get_users_snapshot()
+    assert get_users_snapshot()[0] == date_str
+
+    etlw.snapshot_cache.clear()  # as another process would, reading it back from disk
+    reused_date_str, reused_dfs = get_users_snapshot()
+    assert reused_date_str == date_str and len(snapshot_store) == 1
+    pd.testing.assert_frame_equal(reused_dfs['users'], dfs['users'])
+
+
+def test_stale_snapshot_is_rebuilt(snapshot_store):
+    date_str, _ = get_users_snapshot()
+    assert get_users_snapshot(max_age=pd.Timedelta(0))[0] != date_str
+    assert len(snapshot_store) == 2
+
+
+def test_concurrent_pipelines_build_one_snapshot(snapshot_store):
+    with ThreadPoolExecutor(2) as executor:
+        date_strs = list(executor.map(lambda _: get_users_snapshot()[0], range(2)))
+    assert date_strs[0] == date_strs[1] and len(snapshot_store) == 1
+
+
+def hold_snapshot_lock(base_path, seconds, locked):
+    etlw.BASE_PATH = base_path
+    with etlw.locked_snapshots():
+        locked.set()
+        time.sleep(seconds)
+
+
+def test_snapshot_lock_excludes_other_processes(tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    context = multiprocessing.get_context('fork')
+    locked = context.Event()
+    process = context.Process(target=hold_snapshot_lock, args=(str(tmp_path) + '/', 0.5, locked))
+    process.start()
+    locked.wait()
+
+    start = time.perf_counter()
+    with etlw.locked_snapshots():
+        waited = time.perf_counter() - start
+    process.join()
+    assert waited > 0.2
+
+
+def test_clean_up_keeps_the_newest_and_loaded_snapshots(tmp_path, monkeypatch):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    votes = pd.DataFrame({'votedAt': pd.date_range('2020-01-01', periods=3), 'power': [1, 2, 3]})
+    for date_str in ['2020-01-01', '2020-01-02']:
+        etlw.write_collections({'votes': votes}, date_str)
+        etlw.save_snapshot_metadata(date_str, None, ['votes'], pd.Timestamp(date_str))
+    loaded = etlw.load_from_file('2020-01-01', ['votes'])['votes']  # memory-mapped
+
+    etlw.clean_up_old_files(days_to_keep=1)
+    assert [os.path.basename(folder) for folder in etlw.get_list_of_dates()] == ['2020-01-02']
+    assert etlw.load_snapshot_metadata('2020-01-02') is not None
+    pd.testing.assert_frame_equal(loaded, votes, check_dtype=False)
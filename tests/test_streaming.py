@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+from pymongo.errors import AutoReconnect
+
+import etlw
+from lwdocuments import insert_documents
+from schema import decode_dtypes
+
+
+def sort_rows(df):
+    df = decode_dtypes(df)
+    return df.sort_values('_id').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('pushdown', [False, True])
+def test_streamed_enrichment_matches_in_memory(mongo_db, tmp_path, monkeypatch, pushdown):
+    monkeypatch.setattr(etlw, 'BASE_PATH', str(tmp_path) + '/')
+    insert_documents(mongo_db)
+
+    # a small budget, so votes and views arrive in many chunks (from several partitions at once)
+    today, streamed = etlw.download_and_enrich(pushdown=pushdown, memory_budget_mb=1)
+    expected_today, expected = etlw.download_and_enrich()
+    assert today == expected_today
+    assert not list(tmp_path.glob('streaming-*'))  # the staging directory is cleaned up
+
+    for coll_name in ['users', 'posts', 'comments'] + ([] if pushdown else ['votes', 'views']):
+        left, right = sort_rows(streamed[coll_name]), sort_rows(expected[coll_name])
+        pd.testing.assert_frame_equal(left, right[left.columns], check_dtype=False, obj=coll_name)
+
+
+class FlakyCollection:
+    """Delegates to a collection, but the first query for each datetime range of a partitioned download fails."""
+
+    def __init__(self, collection, failed):
+        self.collection, self.failed = collection, failed
+
+    def find(self, query_filter=None, *args, **kwargs):
+        if "'$lt'" in str(query_filter) and str(query_filter) not in self.failed:
+            self.failed.add(str(query_filter))
+            raise AutoReconnect('connection lost')
+        return self.collection.find(query_filter, *args, **kwargs)
+
+
+class FlakyDb:
+    def __init__(self, db):
+        self.db, self.failed = db, set()
+
+    def __getitem__(self, coll_name):
+        return FlakyCollection(self.db[coll_name], self.failed)
+
+
+def test_partitions_are_retried_unless_streamed(mongo_db, monkeypatch):
+    monkeypatch.setattr(etlw.time, 'sleep', lambda seconds: None)
+    documents = insert_documents(mongo_db)
+
+    views = etlw.get_collection_cleaned('views', FlakyDb(mongo_db), batch_size=100, partitions=4)
+    assert sorted(views['_id']) == sorted(view['_id'] for view in documents['views'])
+
+    # chunks already given to the sink can't be taken back, so a failed partition fails the download
+    with pytest.raises(AutoReconnect):
+        etlw.get_collection_cleaned('views', FlakyDb(mongo_db), batch_size=100, partitions=4,
+                                    chunk_sink=lambda chunk: None)
@@ -2,8 +2,11 @@ import datetime
 import pytz
 import logging
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 import pathlib
+import resource
+import sys
 
 
 
@@ -44,6 +47,28 @@ def timed(func):
     return wrapper
 
 
+def map_in_threads(func, items, num_threads=1):
+    """Applies func to every item, in a thread pool if num_threads > 1. Returns a list of results in item order."""
+
+    items = list(items)
+    if num_threads > 1 and len(items) > 1:
+        with ThreadPoolExecutor(max_workers=min(num_threads, len(items))) as executor:
+            return list(executor.map(func, items))
+
+    return [func(item) for item in items]
+
+
+def get_peak_memory_mb():
+    """
+    Returns the peak resident memory of the current process so far, in MB. It's a high-water mark over the whole run
+    and all threads, so it never decreases and can't be attributed to whatever step logs it.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
 def mem_and_info(df):
     """Convenience function to display the memory usage and data types of dataframes during development"""
 